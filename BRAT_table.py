@@ -11,16 +11,40 @@
 
 import arcpy
 from arcpy.sa import *
+import numpy as np
 import os
 import sys
 import projectxml
 import datetime
+import time
 import uuid
 import FindBraidedNetwork
 import BRAT_Braid_Handler
+import Zonal_Engine
+import Distance_Engine
 
 reload(FindBraidedNetwork)
 reload(BRAT_Braid_Handler)
+reload(Zonal_Engine)
+reload(Distance_Engine)
+
+# how zonalStatsWithinBuffer gets raster values within each buffer: "NATIVE" reads them with Zonal_Engine, and
+# "COLOURED" runs ZonalStatisticsAsTable once per group of buffers that do not overlap
+ZONAL_STATS_METHOD = "NATIVE"
+
+# name of the flow direction raster written next to DrainArea_sqkm.tif in the Flow folder, which BDWS defaults to
+FLOW_DIRECTION_NAME = "FlowDir.tif"
+
+# distance in meters around each reach endpoint that iGeo_ElMax and iGeo_ElMin take the minimum DEM value within
+ENDPOINT_RADIUS = 30.0
+
+# distance in meters from each reach that iGeo_DA also takes drainage area cells from, so that reaches that do not
+# quite follow the flow paths of the DEM still find them
+DA_SNAP_DISTANCE = 30.0
+
+# size in meters of the cells whose centres distances to roads, railroads and canals are measured from, as with the
+# Euclidean distance rasters these once came from
+DISTANCE_CELL_SIZE = 5.0
 
 
 def main(
@@ -73,43 +97,34 @@ def main(
     # create 'Buffers' folder if it doesn't exist
     buffersFolder = makeFolder(intermediateFolder, "01_Buffers")
 
-    # create network segment midpoints
-    if is_verbose:
-        arcpy.AddMessage("Finding midpoints...")
-    midpoints = arcpy.FeatureVerticesToPoints_management(seg_network_copy, scratch + "/midpoints", "MID")
-    # remove unwanted fields from midpoints
-    fields = arcpy.ListFields(midpoints)
-    keep = ['ReachID']
-    drop = []
-    for field in fields:
-        if not field.required and field.name not in keep and field.type != 'Geometry':
-            drop.append(field.name)
-    if len(drop) > 0:
-        arcpy.DeleteField_management(midpoints, drop)
-
     if is_verbose:
         arcpy.AddMessage("Making buffers...")
-    # create midpoint 100 m buffer
-    midpoint_buffer = arcpy.Buffer_analysis(midpoints, scratch + "/midpoint_buffer", "100 Meters")
     # create network 30 m buffer
     buf_30m = os.path.join(buffersFolder, "buffer_30m.shp")
     arcpy.Buffer_analysis(seg_network_copy, buf_30m, "30 Meters", "", "ROUND")
     # create network 100 m buffer
     buf_100m = os.path.join(buffersFolder, "buffer_100m.shp")
     arcpy.Buffer_analysis(seg_network_copy, buf_100m, "100 Meters", "", "ROUND")
+    # the cells in each buffer are indexed once and kept with the project, for every raster on the same grid
+    cellIndexFolder = os.path.join(projPath, "CellIndex")
+    runStart = time.time()
 
     # run geo attributes function
     arcpy.AddMessage('Adding "iGeo" attributes to network')
-    igeo_attributes(seg_network_copy, inDEM, FlowAcc, midpoint_buffer, scratch, is_verbose)
+    igeo_attributes(seg_network_copy, inDEM, FlowAcc, scratch, is_verbose)
 
     # run vegetation attributes function
     arcpy.AddMessage('Adding "iVeg" attributes to network')
-    iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, seg_network_copy, scratch, is_verbose)
+    iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, seg_network_copy, scratch, is_verbose, cellIndexFolder)
 
     # run ipc attributes function if conflict layers are defined by user
     if road is not None and valley_bottom is not None:
         arcpy.AddMessage('Adding "iPC" attributes to network')
-        ipc_attributes(seg_network_copy, road, railroad, canal, valley_bottom, buf_30m, buf_100m, landuse, scratch, projPath, is_verbose)
+        ipc_attributes(seg_network_copy, road, railroad, canal, valley_bottom, buf_30m, buf_100m, landuse, scratch, projPath, is_verbose,
+                       cellIndexFolder)
+
+    # indexes this run didn't use belong to an earlier network, and would never be used again
+    Zonal_Engine.CellIndex.prune_cache(cellIndexFolder, runStart)
 
     handle_braids(seg_network_copy, canal, projPath, findClusters, is_verbose)
 
@@ -240,90 +255,84 @@ def addReachDist(seg_network, seg_network_copy, is_verbose):
 
 # zonal statistics within buffer function
 # dictionary join field function
-def zonalStatsWithinBuffer(buffer, ras, statType, statField, outFC, outFCField, scratch):
-    # get input raster stat value within each buffer
-    # note: zonal stats as table does not support overlapping polygons so we will check which
-    #       reach buffers output was produced for and which we need to run tool on again
-    statTbl = arcpy.sa.ZonalStatisticsAsTable(buffer, 'ReachID', ras, os.path.join(scratch, 'statTbl'), 'DATA', statType)
-    # get list of segment buffers where zonal stats tool produced output
-    haveStatList = [row[0] for row in arcpy.da.SearchCursor(statTbl, 'ReachID')]
-    # create dictionary to hold all reach buffer min dem z values
-    statDict = {}
-    # add buffer raster stat values to dictionary
-    with arcpy.da.SearchCursor(statTbl, ['ReachID', statField]) as cursor:
-        for row in cursor:
-            statDict[row[0]] = row[1]
-    # create list of overlapping buffer reaches (i.e., where zonal stats tool did not produce output)
-    needStatList = []
-    with arcpy.da.SearchCursor(buffer, ['ReachID']) as cursor:
-        for row in cursor:
-            if row[0] not in haveStatList:
-                needStatList.append(row[0])
-    # run zonal stats until we have output for each overlapping buffer segment
-    stat = None
-    tmp_buff_lyr = None
-    num_broken_repetitions = 0
-    BROKEN_REPS_ALLOWED = 5
-    while len(needStatList) > 0:
-        # create tuple of segment ids where still need raster values
-        needStat = ()
-        for reach in needStatList:
-            if reach not in needStat:
-                needStat += (reach,)
-        # use the segment id tuple to create selection query and run zonal stats tool
-        if len(needStat) == 1:
-            quer = '"ReachID" = ' + str(needStat[0])
+def zonalStatsWithinBuffer(buffer, ras, statType, statField, outFC, outFCField, scratch, cache_folder=None):
+    """
+    Gets the raster stat value within each reach buffer and writes it to the network. With the NATIVE method the
+    cells in every buffer are indexed first, so overlapping buffers are handled in one read of the raster
+    :param buffer: The buffer polygons, with one feature per ReachID
+    :param ras: The raster to get values from
+    :param statType: One of 'MEAN', 'MINIMUM', 'MAXIMUM' or 'SUM'
+    :param statField: The name ZonalStatisticsAsTable gives the stat
+    :param outFC: The network to write the stat values to
+    :param outFCField: The field to write the stat values to
+    :param scratch: The scratch workspace
+    :param cache_folder: If given, the folder to keep cell indexes in, so that later rasters on the same grid reuse them
+    :return:
+    """
+    if ZONAL_STATS_METHOD == "COLOURED":
+        reach_ids, stat_values = colouredZonalStats(buffer, ras, statType, statField, scratch)
+    else:
+        grid = Zonal_Engine.RasterGrid.from_raster(ras)
+        if cache_folder:
+            cell_index = Zonal_Engine.CellIndex.load_or_build(buffer, grid, cache_folder)
         else:
-            quer = '"ReachID" IN ' + str(needStat)
-        tmp_buff_lyr = arcpy.MakeFeatureLayer_management(buffer, 'tmp_buff_lyr')
-        arcpy.SelectLayerByAttribute_management(tmp_buff_lyr, 'NEW_SELECTION', quer)
-        stat = arcpy.sa.ZonalStatisticsAsTable(tmp_buff_lyr, 'ReachID', ras, os.path.join(scratch, 'stat'), 'DATA', statType)
-        # add segment stat values from zonal stats table to main dictionary
-        with arcpy.da.SearchCursor(stat, ['ReachID', statField]) as cursor:
-            for row in cursor:
-                statDict[row[0]] = row[1]
-        # create list of reaches that were run and remove from 'need to run' list
-        haveStatList2 = [row[0] for row in arcpy.da.SearchCursor(stat, 'ReachID')]
-
-        if len(haveStatList2) == 0:
-            num_broken_repetitions += 1
-            if num_broken_repetitions >= BROKEN_REPS_ALLOWED:
-                warning_message = "While calculating " + outFCField + ", the tool ran into an error. The following "
-                warning_message += "ReachIDs did not recieve correct values:\n"
-                for reachID in needStatList:
-                    if reachID == needStatList[-1]:
-                        warning_message += "and "
-                    warning_message += str(reachID)
-                    if reachID != needStatList[-1]:
-                        warning_message += ", "
-                warning_message += "\n"
-                arcpy.AddWarning(warning_message)
-                for reachID in needStatList:
-                    statDict[reachID] = 0
-                needStatList = []
-        for reach in haveStatList2:
-            needStatList.remove(reach)
+            cell_index = Zonal_Engine.CellIndex.build(buffer, grid)
+        reach_ids = cell_index.reach_ids
+        stat_values = cell_index.stats(ras, [statType], grid)[statType]
+
+    # reaches whose buffers have no data get a value of 0
+    no_data = np.isnan(stat_values)
+    if no_data.any():
+        warning_message = "While calculating " + outFCField + ", " + str(np.count_nonzero(no_data)) + " reach buffers "
+        warning_message += "had no raster data. The following ReachIDs were given a value of 0:\n"
+        warning_message += ", ".join(str(reachID) for reachID in reach_ids[no_data]) + "\n"
+        arcpy.AddWarning(warning_message)
+        stat_values[no_data] = 0
 
     # populate dictionary value to output field by ReachID
+    statDict = dict(zip(reach_ids.tolist(), stat_values.tolist()))
     with arcpy.da.UpdateCursor(outFC, ['ReachID', outFCField]) as cursor:
         for row in cursor:
-            try:
-                aKey = row[0]
-                row[1] = statDict[aKey]
+            if row[0] in statDict:
+                row[1] = statDict[row[0]]
                 cursor.updateRow(row)
-            except:
-                pass
     statDict.clear()
-    # delete temp fcs, tbls, etc.
-    #items = [statTbl, haveStatList, haveStatList2, needStatList, stat, tmp_buff_lyr, needStat]
-    items = [statTbl, stat, tmp_buff_lyr]
-    for item in items:
-        if item is not None:
-            arcpy.Delete_management(item)
+
+
+def colouredZonalStats(buffer, ras, statType, statField, scratch):
+    """
+    Gets the raster stat value within each reach buffer with ZonalStatisticsAsTable, which does not support
+    overlapping zones. The buffers are split into groups that do not overlap, and the tool is run once per group
+    :param buffer: The buffer polygons
+    :param ras: The raster to get values from
+    :param statType: The statistic type to calculate
+    :param statField: The name ZonalStatisticsAsTable gives the stat
+    :param scratch: The scratch workspace
+    :return: An array of ReachIDs, and an array of their stat values, which is nan where a buffer got no value
+    """
+    groups = Zonal_Engine.overlap_groups(buffer)
+    arcpy.AddMessage("Running zonal statistics on " + str(len(groups)) + " groups of non-overlapping buffers")
+    statDict = {}
+    buffer_lyr = arcpy.MakeFeatureLayer_management(buffer, 'tmp_buff_lyr')
+    for group in groups:
+        quer = '"ReachID" IN (' + ", ".join(str(reach) for reach in group) + ')'
+        arcpy.SelectLayerByAttribute_management(buffer_lyr, 'NEW_SELECTION', quer)
+        statTbl = arcpy.sa.ZonalStatisticsAsTable(buffer_lyr, 'ReachID', ras, os.path.join(scratch, 'statTbl'),
+                                                  'DATA', statType)
+        with arcpy.da.SearchCursor(statTbl, ['ReachID', statField]) as cursor:
+            for row in cursor:
+                statDict[row[0]] = row[1]
+        arcpy.Delete_management(statTbl)
+    arcpy.Delete_management(buffer_lyr)
+
+    reach_ids = np.array([reach for group in groups for reach in group])
+    stat_values = np.array([statDict.get(reach, np.nan) for reach in reach_ids.tolist()], np.float64)
+    return reach_ids, stat_values
+
 
 # geo attributes function
 # calculates min and max elevation, length, slope, and drainage area for each flowline segment
-def igeo_attributes(out_network, inDEM, FlowAcc, midpoint_buffer, scratch, is_verbose):
+def igeo_attributes(out_network, inDEM, FlowAcc, scratch, is_verbose):
 
     # if fields already exist, delete them
     fields = [f.name for f in arcpy.ListFields(out_network)]
@@ -341,40 +350,34 @@ def igeo_attributes(out_network, inDEM, FlowAcc, midpoint_buffer, scratch, is_ve
                 cursor.updateRow(row)
     if is_verbose:
         arcpy.AddMessage("Preprocessing DEM...")
-    #  --smooth input dem by 3x3 cell window--
     #  define raster environment settings
     desc = arcpy.Describe(inDEM)
     arcpy.env.extent = desc.Extent
     arcpy.env.outputCoordinateSystem = desc.SpatialReference
     arcpy.env.cellSize = desc.meanCellWidth
-    # calculate mean z over 3x3 cell window
-    neighborhood = NbrRectangle(3, 3, "CELL")
-    tmpDEM = FocalStatistics(inDEM, neighborhood, 'MEAN')
-    # clip smoothed dem to input dem
-    DEM = ExtractByMask(tmpDEM, inDEM)
-
-    # function to attribute start/end elevation (dem z) to each flowline segment
-    def zSeg(vertexType, outField):
-        if is_verbose:
-            arcpy.AddMessage("Find values for " + outField)
-        # create start/end points for each flowline reach segment
-        tmp_pts = os.path.join(scratch, 'tmp_pts')
-        arcpy.FeatureVerticesToPoints_management(out_network, tmp_pts, vertexType)
-        # create 30 meter buffer around each start/end point
-        tmp_buff = os.path.join(scratch, 'tmp_buff')
-        arcpy.Buffer_analysis(tmp_pts, tmp_buff, '30 Meters')
-        # get min dem z value within each buffer
-        arcpy.AddField_management(out_network, outField, "DOUBLE")
-        zonalStatsWithinBuffer(tmp_buff, DEM, 'MINIMUM', 'MIN', out_network, outField, scratch)
-
-        # delete temp fcs, tbls, etc.
-        items = [tmp_pts, tmp_buff]
-        for item in items:
-            arcpy.Delete_management(item)
+    reach_ids, endpoints = readEndpoints(out_network, desc.SpatialReference)
+    radius = ENDPOINT_RADIUS / desc.SpatialReference.metersPerUnit
+    #  --smooth input dem by 3x3 cell window--
+    # drainage area is calculated from the whole smoothed dem, but otherwise only the dem near reach endpoints is used
+    DEM = os.path.join(arcpy.env.scratchFolder, "smoothed_dem.tif")
+    try:
+        import Terrain_Engine  # needs GDAL, so is only imported when the DEM is smoothed
+    except ImportError:
+        # without GDAL, the whole dem is smoothed with Spatial Analyst
+        neighborhood = NbrRectangle(3, 3, "CELL")
+        ExtractByMask(FocalStatistics(inDEM, neighborhood, 'MEAN'), inDEM).save(DEM)
+    else:
+        if FlowAcc is None:
+            Terrain_Engine.smooth_dem(inDEM, DEM)
+        else:
+            Terrain_Engine.smooth_dem(inDEM, DEM, np.vstack((endpoints[:, :2], endpoints[:, 2:])), radius)
 
-    # run zSeg function for start/end of each network segment
-    zSeg('START', 'iGeo_ElMax')
-    zSeg('END', 'iGeo_ElMin')
+    # attribute start/end elevation (dem z) to each flowline segment
+    if is_verbose:
+        arcpy.AddMessage("Finding values for iGeo_ElMax and iGeo_ElMin")
+    arcpy.AddField_management(out_network, "iGeo_ElMax", "DOUBLE")
+    arcpy.AddField_management(out_network, "iGeo_ElMin", "DOUBLE")
+    endpointElevations(out_network, DEM, reach_ids, endpoints, radius)
 
     # calculate network reach slope
     arcpy.AddField_management(out_network, "iGeo_Len", "DOUBLE")
@@ -403,14 +406,15 @@ def igeo_attributes(out_network, inDEM, FlowAcc, midpoint_buffer, scratch, is_ve
         DrArea = os.path.dirname(inDEM) + "/Flow/DrainArea_sqkm.tif"
     else:
         DrArea = os.path.dirname(inDEM) + "/Flow/" + os.path.basename(FlowAcc)
-    # Todo: check this bc it seems wrong to pull from midpoint buffer
 
     # add drainage area 'iGeo_DA' field to flowline network
     arcpy.AddField_management(out_network, "iGeo_DA", "DOUBLE")
-    # get max drainage area within 100 m midpoint buffer
+    # get max drainage area along each reach
     if is_verbose:
         arcpy.AddMessage("Finding values for iGeo_DA")
-    zonalStatsWithinBuffer(midpoint_buffer, DrArea, "MAXIMUM", 'MAX', out_network, "iGeo_DA", scratch)
+    reachDrainageArea(out_network, DrArea, DA_SNAP_DISTANCE)
+    # the smoothed dem is as big as the input dem, and isn't needed once the drainage area is found
+    arcpy.Delete_management(DEM)
 
     # replace '0' drainage area values with tiny value
     with arcpy.da.UpdateCursor(out_network, ["iGeo_DA"]) as cursor:
@@ -420,9 +424,125 @@ def igeo_attributes(out_network, inDEM, FlowAcc, midpoint_buffer, scratch, is_ve
             cursor.updateRow(row)
 
 
+def reachDrainageArea(out_network, DrArea, snap_distance):
+    """
+    Gets the maximum drainage area of the cells each reach passes through, or whose centres are within the snap
+    distance of it, and writes it to iGeo_DA. The downstream end of each reach is left out, so that a tributary
+    does not take the drainage area of the stream it flows into. The downstream end is the end with the larger
+    drainage area near it, so reaches digitized in either direction are handled
+    :param out_network: The network to write the drainage areas to
+    :param DrArea: The drainage area raster
+    :param snap_distance: The distance from each reach that cells are also taken from, in meters
+    :return:
+    """
+    grid = Zonal_Engine.RasterGrid.from_raster(DrArea)
+    snap_distance /= grid.spatial_reference.metersPerUnit
+    end_distance = snap_distance + np.hypot(grid.cell_width, grid.cell_height)
+
+    # the largest drainage area near each end of each reach, from zero length segments at the ends
+    end_ids, endpoints = readEndpoints(out_network, grid.spatial_reference)
+    ends = np.vstack((endpoints[:, :2], endpoints[:, 2:]))
+    end_areas = Zonal_Engine.line_maximums(np.hstack((ends, ends)), np.arange(len(ends)), len(ends), DrArea,
+                                           snap_distance, grid).reshape(2, -1)
+    # reaches with no drainage area near an end keep their digitized direction
+    reversed_reaches = dict(zip(end_ids, (end_areas[0] > end_areas[1]).tolist()))
+
+    reach_ids = []
+    segments = []
+    segment_reaches = []
+    with arcpy.da.SearchCursor(out_network, ['ReachID', 'SHAPE@'], spatial_reference=grid.spatial_reference) as cursor:
+        for row in cursor:
+            if row[1] is None:
+                continue
+            # reaches too short to leave their end out keep their upstream half
+            trim = min(end_distance, row[1].length / 2)
+            if reversed_reaches.get(row[0], False):
+                line = row[1].segmentAlongLine(trim, row[1].length)
+            else:
+                line = row[1].segmentAlongLine(0, row[1].length - trim)
+            for part in line:
+                vertices = [(point.X, point.Y) for point in part if point is not None]
+                for start, end in zip(vertices[:-1], vertices[1:]):
+                    segments.append(start + end)
+                    segment_reaches.append(len(reach_ids))
+            reach_ids.append(row[0])
+    segments = np.array(segments, np.float64).reshape(-1, 4)
+
+    drainage_areas = Zonal_Engine.line_maximums(segments, segment_reaches, len(reach_ids), DrArea, snap_distance,
+                                                grid)
+
+    # reaches with no drainage area data get a value of 0
+    no_data = np.isnan(drainage_areas)
+    if no_data.any():
+        warning_message = "While calculating iGeo_DA, " + str(np.count_nonzero(no_data)) + " reaches had no drainage "
+        warning_message += "area data. The following ReachIDs were given a value of 0:\n"
+        warning_message += ", ".join(str(reach_ids[i]) for i in np.flatnonzero(no_data)) + "\n"
+        arcpy.AddWarning(warning_message)
+        drainage_areas[no_data] = 0
+
+    drainageAreaDict = dict(zip(reach_ids, drainage_areas.tolist()))
+    with arcpy.da.UpdateCursor(out_network, ['ReachID', 'iGeo_DA']) as cursor:
+        for row in cursor:
+            if row[0] in drainageAreaDict:
+                row[1] = drainageAreaDict[row[0]]
+                cursor.updateRow(row)
+
+
+def readEndpoints(out_network, spatial_reference):
+    """
+    Reads the start and end point of each reach
+    :param out_network: The network
+    :param spatial_reference: The spatial reference to read the points in
+    :return: A list of ReachIDs, and an (n, 4) array of the start x, start y, end x and end y of each reach
+    """
+    reach_ids = []
+    endpoints = []
+    with arcpy.da.SearchCursor(out_network, ['ReachID', 'SHAPE@'], spatial_reference=spatial_reference) as cursor:
+        for row in cursor:
+            if row[1] is None:
+                continue
+            reach_ids.append(row[0])
+            endpoints.append((row[1].firstPoint.X, row[1].firstPoint.Y, row[1].lastPoint.X, row[1].lastPoint.Y))
+    return reach_ids, np.array(endpoints, np.float64).reshape(-1, 4)
+
+
+def endpointElevations(out_network, DEM, reach_ids, endpoints, radius):
+    """
+    Gets the minimum DEM value within the radius of the start and end of each reach, and writes them to iGeo_ElMax
+    and iGeo_ElMin. All of the endpoints are sampled from the DEM together
+    :param out_network: The network to write the elevations to
+    :param DEM: The smoothed DEM
+    :param reach_ids: The ReachID of each reach
+    :param endpoints: (n, 4) array of the start and end point of each reach, in the DEM's coordinate system
+    :param radius: The distance around each endpoint to get the minimum within, in map units
+    :return:
+    """
+    grid = Zonal_Engine.RasterGrid.from_raster(DEM)
+    elevations = Zonal_Engine.point_minimums(np.vstack((endpoints[:, :2], endpoints[:, 2:])), DEM, radius, grid)
+    elevations = elevations.reshape(2, -1)
+
+    # endpoints with no DEM data nearby get a value of 0
+    no_data = np.isnan(elevations).any(axis=0)
+    if no_data.any():
+        warning_message = "While calculating iGeo_ElMax and iGeo_ElMin, " + str(np.count_nonzero(no_data))
+        warning_message += " reaches had no DEM data near an endpoint. The following ReachIDs were given a value of 0:\n"
+        warning_message += ", ".join(str(reach_ids[i]) for i in np.flatnonzero(no_data)) + "\n"
+        arcpy.AddWarning(warning_message)
+        elevations[np.isnan(elevations)] = 0
+
+    elevationDict = dict(zip(reach_ids, zip(elevations[0].tolist(), elevations[1].tolist())))
+    with arcpy.da.UpdateCursor(out_network, ['ReachID', 'iGeo_ElMax', 'iGeo_ElMin']) as cursor:
+        for row in cursor:
+            values = elevationDict.get(row[0])
+            if values is None:
+                continue
+            row[1], row[2] = values
+            cursor.updateRow(row)
+
+
 # vegetation attributes function
 # calculates both existing and potential mean vegetation value within 30 m and 100 m buffer of each stream segment
-def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scratch, is_verbose):
+def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scratch, is_verbose, cache_folder=None):
 
     # if fields already exist, delete them
     fields = [f.name for f in arcpy.ListFields(out_network)]
@@ -440,14 +560,14 @@ def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scrat
     # get mean existing veg value within 100 m buffer
     if is_verbose:
         arcpy.AddMessage("Finding iVeg_100EX...")
-    zonalStatsWithinBuffer(buf_100m, veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_100EX", scratch)
+    zonalStatsWithinBuffer(buf_100m, veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_100EX", scratch, cache_folder)
 
     # add mean veg value 'iVeg_VT30EX' field to flowline network
     arcpy.AddField_management(out_network, "iVeg_30EX", "DOUBLE")
     # get mean existing veg value within 30 m buffer
     if is_verbose:
         arcpy.AddMessage("Finding iVeg_30EX...")
-    zonalStatsWithinBuffer(buf_30m, veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_30EX", scratch)
+    zonalStatsWithinBuffer(buf_30m, veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_30EX", scratch, cache_folder)
 
     # delete temp fcs, tbls, etc.
     items = [veg_lookup]
@@ -464,14 +584,14 @@ def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scrat
     # get mean potential veg value within 100 m buffer
     if is_verbose:
         arcpy.AddMessage("Finding iVeg_100PT...")
-    zonalStatsWithinBuffer(buf_100m, hist_veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_100PT", scratch)
+    zonalStatsWithinBuffer(buf_100m, hist_veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_100PT", scratch, cache_folder)
 
     # add mean veg value 'iVeg_30PT' field to flowline network
     arcpy.AddField_management(out_network, "iVeg_30PT", "DOUBLE")
     # get mean potential veg value within 30 m buffer
     if is_verbose:
         arcpy.AddMessage("Finding iVeg_30PT...")
-    zonalStatsWithinBuffer(buf_30m, hist_veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_30PT", scratch)
+    zonalStatsWithinBuffer(buf_30m, hist_veg_lookup, 'MEAN', 'MEAN', out_network, "iVeg_30PT", scratch, cache_folder)
 
     # delete temp fcs, tbls, etc.
     items = [hist_veg_lookup]
@@ -481,7 +601,8 @@ def iveg_attributes(coded_veg, coded_hist, buf_100m, buf_30m, out_network, scrat
 
 # conflict potential function
 # calculates distances from road intersections, adjacent roads, railroads and canals for each flowline segment
-def ipc_attributes(out_network, road, railroad, canal, valley_bottom, buf_30m, buf_100m, landuse, scratch, projPath, is_verbose):
+def ipc_attributes(out_network, road, railroad, canal, valley_bottom, buf_30m, buf_100m, landuse, scratch, projPath, is_verbose,
+                   cache_folder=None):
     # create temp directory
     if is_verbose:
         arcpy.AddMessage("Deleting and remaking temp dir...")
@@ -493,7 +614,7 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, buf_30m, b
 
     # if fields already exist, delete them
     fields = [f.name for f in arcpy.ListFields(out_network)]
-    drop = ["iPC_RoadX", "iPC_RoadAd", "iPC_RR", "iPC_Canal", "iPC_LU"]
+    drop = ["iPC_RoadX", "iPC_RoadAd", "iPC_RR", "iPC_Canal", "iPC_LU", "iPC_VLowLU", "iPC_LowLU", "iPC_ModLU", "iPC_HighLU"]
     for field in fields:
         if field in drop:
             arcpy.DeleteField_management(out_network, field)
@@ -506,45 +627,32 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, buf_30m, b
         roadx = tempDir + "\\roadx.shp"
         # create points at road-stream intersections
         arcpy.Intersect_analysis([out_network, road], roadx, "", "", "POINT")
-        # get count of road-stream intersections
-        roadx_mts = tempDir + "\\roadx_mts.shp"
-        arcpy.MultipartToSinglepart_management(roadx, roadx_mts)
-        roadxcount = arcpy.GetCount_management(roadx_mts)
-        roadxct = int(roadxcount.getOutput(0))
+        # read the crossings as points
+        roadx_points = Distance_Engine.read_segments(roadx, arcpy.Describe(out_network).spatialReference)
         # if there are no road-stream crossings, set 'iPC_RoadsX' to high value (10000 m)
-        if roadxct < 1:
+        if len(roadx_points) < 1:
             with arcpy.da.UpdateCursor(out_network, "iPC_RoadX") as cursor:
                 for row in cursor:
                     row[0] = 10000.0
                     cursor.updateRow(row)
-        # if there are road-stream crossings, calculate distance
+        # if there are road-stream crossings, get minimum distance from them within 30 m buffer of each network segment
         else:
-            # set extent to the stream network
-            arcpy.env.extent = out_network
-            # calculate euclidean distance from road-stream crossings
-            ed_roadx = EucDistance(roadx, cell_size = 5)  # cell size of 5 m
-            # get minimum distance from road-stream crossings within 30 m buffer of each network segment
-            zonalStatsWithinBuffer(buf_30m, ed_roadx, "MINIMUM", 'MIN', out_network, "iPC_RoadX", scratch)
-
-            # delete temp fcs, tbls, etc.
-            items = [ed_roadx]
-            for item in items:
-                arcpy.Delete_management(item)
+            distanceWithinBuffer(buf_30m, roadx_points, "MINIMUM", out_network, "iPC_RoadX", cache_folder)
 
     # calculate mean distance from adjacent roads ('iPC_RoadAd')
     # here we only care about roads in the valley bottom
     if road is not None:
-        findDistanceFromFeature(out_network, road, valley_bottom, tempDir, buf_30m, "road_ad", "iPC_RoadAd", scratch, is_verbose)
+        findDistanceFromFeature(out_network, road, valley_bottom, tempDir, buf_30m, "road_ad", "iPC_RoadAd", scratch, is_verbose, cache_folder)
 
     # calculate mean distance from railroads ('iPC_RR')
     # here we only care about railroads in the valley bottom
     if railroad is not None:
-        findDistanceFromFeature(out_network, railroad, valley_bottom, tempDir, buf_30m, "railroad", "iPC_RR", scratch, is_verbose)
+        findDistanceFromFeature(out_network, railroad, valley_bottom, tempDir, buf_30m, "railroad", "iPC_RR", scratch, is_verbose, cache_folder)
 
     # calculate mean distance from canals ('iPC_Canal')
     # here we only care about canals in the valley bottom
     if canal is not None:
-        findDistanceFromFeature(out_network, canal, valley_bottom, tempDir, buf_30m, "canal", "iPC_Canal", scratch, is_verbose)
+        findDistanceFromFeature(out_network, canal, valley_bottom, tempDir, buf_30m, "canal", "iPC_Canal", scratch, is_verbose, cache_folder)
     #rmtree(tempDir)
     """
     This is the section of code that stores intermediary data in memory. In ArcMap 10.6, that crashes the program,
@@ -672,54 +780,12 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, buf_30m, b
         # create raster with just landuse code values
         lu_ras = Lookup(landuse, "LU_CODE")
         # calculate mean landuse value within 100 m buffer of each network segment
-        zonalStatsWithinBuffer(buf_100m, lu_ras, 'MEAN', 'MEAN', out_network, "iPC_LU", scratch)
+        zonalStatsWithinBuffer(buf_100m, lu_ras, 'MEAN', 'MEAN', out_network, "iPC_LU", scratch, cache_folder)
         # get percentage of each land use class in 100 m buffer of stream segment
         fields = [f.name.upper() for f in arcpy.ListFields(landuse)]
 
         if "LUI_CLASS" in fields:
-            buf_fields = [f.name for f in arcpy.ListFields(buf_100m)]
-            if 'oArea' not in buf_fields:
-                arcpy.AddField_management(buf_100m, 'oArea', 'DOUBLE')
-                with arcpy.da.UpdateCursor(buf_100m, ['SHAPE@AREA', 'oArea']) as cursor:
-                    for row in cursor:
-                        row[1] = row[0]
-                        cursor.updateRow(row)
-            landuse_poly = arcpy.RasterToPolygon_conversion(landuse, os.path.join(scratch, 'landuse_poly'), 'NO_SIMPLIFY', "LUI_Class")
-            landuse_int = arcpy.Intersect_analysis([landuse_poly, buf_100m], os.path.join(scratch, 'landuse_int'))
-            arcpy.AddField_management(landuse_int, 'propArea', 'DOUBLE')
-            with arcpy.da.UpdateCursor(landuse_int, ['SHAPE@AREA', 'oArea', 'propArea']) as cursor:
-                for row in cursor:
-                    row[2] = row[0]/row[1]
-                    cursor.updateRow(row)
-            areaTbl = arcpy.Statistics_analysis(landuse_int, os.path.join(scratch, 'areaTbl'), [['propArea', 'SUM']], ['ReachID', 'LUI_CLASS'])
-            areaPivTbl = arcpy.PivotTable_management(areaTbl, ['ReachID'], 'LUI_CLASS', 'SUM_propArea', os.path.join(scratch, 'areaPivTbl'))
-
-            sanitize_area_piv_tbl(areaPivTbl)
-            # create empty dictionary to hold input table field values
-            tblDict = {}
-            # add values to dictionary
-            with arcpy.da.SearchCursor(areaPivTbl, ['ReachID', 'VeryLow', 'Low', 'Moderate', 'High']) as cursor:
-                for row in cursor:
-                    tblDict[row[0]] = [row[1], row[2], row[3], row[4]]
-
-            # populate flowline network out fields
-            arcpy.AddField_management(out_network, "iPC_VLowLU", 'DOUBLE')
-            arcpy.AddField_management(out_network, "iPC_LowLU", 'DOUBLE')
-            arcpy.AddField_management(out_network, "iPC_ModLU", 'DOUBLE')
-            arcpy.AddField_management(out_network, "iPC_HighLU", 'DOUBLE')
-
-            with arcpy.da.UpdateCursor(out_network, ['ReachID', 'iPC_VLowLU', 'iPC_LowLU', 'iPC_ModLU', 'iPC_HighLU']) as cursor:
-                for row in cursor:
-                    try:
-                        aKey = row[0]
-                        row[1] = round(100*tblDict[aKey][0], 2)
-                        row[2] = round(100*tblDict[aKey][1], 2)
-                        row[3] = round(100*tblDict[aKey][2], 2)
-                        row[4] = round(100*tblDict[aKey][3], 2)
-                        cursor.updateRow(row)
-                    except:
-                        pass
-            tblDict.clear()
+            landUseFractions(landuse, buf_100m, out_network, cache_folder)
         else:
             arcpy.AddWarning("No field named \"LU_CLASS\" in the land use raster. Make sure that this field exists" +
                              " with no typos if you wish to use the data from the land use raster")
@@ -732,93 +798,166 @@ def ipc_attributes(out_network, road, railroad, canal, valley_bottom, buf_30m, b
     arcpy.ClearEnvironment("extent")
 
 
-def sanitize_area_piv_tbl(areaPivTbl):
+def landUseFractions(landuse, buf_100m, out_network, cache_folder=None):
     """
-    Makes sure that the areaPivTbl has all the fields we need. If it doesn't, we'll add it.
-    :param areaPivTbl:
+    Gets the percentage of each land use intensity class in the 100 m buffer of each reach, from counts of the
+    land use cells in each buffer, and writes them to iPC_VLowLU, iPC_LowLU, iPC_ModLU and iPC_HighLU
+    :param landuse: The land use raster, with a LUI_Class field
+    :param buf_100m: The 100 m buffer polygons
+    :param out_network: The network to write the percentages to
+    :param cache_folder: If given, the folder to keep cell indexes in
     :return:
     """
-    fields = [f.name for f in arcpy.ListFields(areaPivTbl)]
-    check_and_add_zero_fields(areaPivTbl, fields, 'VeryLow')
-    check_and_add_zero_fields(areaPivTbl, fields, 'Low')
-    check_and_add_zero_fields(areaPivTbl, fields, 'Moderate')
-    check_and_add_zero_fields(areaPivTbl, fields, 'High')
-
-
-def check_and_add_zero_fields(table, fields, field_name):
-    """
-    Checks that a field is in the table. If it isn't, we add it and populate it with zeros
-    :param table: The table that we want to check
-    :param fields: All the fields in the table (more efficient if doing multiple checks)
-    :param field_name: The name of the field we want to check for
-    :return:
-    """
-    if field_name not in fields:
-        arcpy.AddField_management(table, field_name, "DOUBLE")
-        arcpy.CalculateField_management(table, field_name, 0, "PYTHON")
+    lu_classes = ['VeryLow', 'Low', 'Moderate', 'High']
+    out_fields = ['iPC_VLowLU', 'iPC_LowLU', 'iPC_ModLU', 'iPC_HighLU']
 
+    # class code of each land use raster value
+    class_values = {}
+    with arcpy.da.SearchCursor(landuse, ['Value', 'LUI_Class']) as cursor:
+        for row in cursor:
+            if row[1] in lu_classes:
+                class_values[row[0]] = lu_classes.index(row[1])
 
+    grid = Zonal_Engine.RasterGrid.from_raster(landuse)
+    if cache_folder:
+        cell_index = Zonal_Engine.CellIndex.load_or_build(buf_100m, grid, cache_folder)
+    else:
+        cell_index = Zonal_Engine.CellIndex.build(buf_100m, grid)
+    reach_ids = cell_index.reach_ids
+    class_counts = cell_index.class_counts(landuse, class_values, grid)
+    if class_counts.shape[1] < len(lu_classes):
+        class_counts = np.hstack((class_counts, np.zeros((len(reach_ids), len(lu_classes) - class_counts.shape[1]),
+                                                         np.int64)))
+
+    # fractions are of every cell in the buffer, so cells of other classes or with no data count against them
+    cell_counts = cell_index.cell_count()
+    no_cells = cell_counts == 0
+    if no_cells.any():
+        warning_message = "While calculating land use intensity percentages, " + str(np.count_nonzero(no_cells))
+        warning_message += " reach buffers held no cells. The following ReachIDs were given values of 0:\n"
+        warning_message += ", ".join(str(reachID) for reachID in reach_ids[no_cells]) + "\n"
+        arcpy.AddWarning(warning_message)
+    fractions = class_counts / np.maximum(cell_counts, 1).astype(np.float64)[:, None]
+
+    for field in out_fields:
+        arcpy.AddField_management(out_network, field, 'DOUBLE')
+    fractionDict = dict(zip(reach_ids.tolist(), fractions.tolist()))
+    with arcpy.da.UpdateCursor(out_network, ['ReachID'] + out_fields) as cursor:
+        for row in cursor:
+            if row[0] in fractionDict:
+                row[1:] = [round(100 * fraction, 2) for fraction in fractionDict[row[0]]]
+                cursor.updateRow(row)
 
 
-def findDistanceFromFeature(out_network, feature, valley_bottom, temp_dir, buf, temp_name, new_field_name, scratch, is_verbose):
+def findDistanceFromFeature(out_network, feature, valley_bottom, temp_dir, buf, temp_name, new_field_name, scratch, is_verbose,
+                            cache_folder=None):
     if is_verbose:
         arcpy.AddMessage("Finding " + new_field_name + " values...")
     arcpy.AddField_management(out_network, new_field_name, "DOUBLE")
     # clip roads to the valley bottom
-    feature_subset = arcpy.Clip_analysis(feature, valley_bottom, os.path.join(temp_dir, temp_name + '_subset.shp'))
-    # get count of roads in the valley bottom
-    feature_mts = arcpy.MultipartToSinglepart_management(feature_subset, os.path.join(temp_dir, temp_name + "_mts.shp"))
-    count = arcpy.GetCount_management(feature_mts)
-    ct = int(count.getOutput(0))
+    feature_subset = os.path.join(temp_dir, temp_name + '_subset.shp')
+    arcpy.Clip_analysis(feature, valley_bottom, feature_subset)
+    # read the roads in the valley bottom as segments
+    segments = Distance_Engine.read_segments(feature_subset, arcpy.Describe(out_network).spatialReference)
     # if there are no roads in the valley bottom, set 'iPC_RoadsAd' to high value (10000 m)
-    if ct < 1:
+    if len(segments) < 1:
         with arcpy.da.UpdateCursor(out_network, new_field_name) as cursor:
             for row in cursor:
                 row[0] = 10000.0
                 cursor.updateRow(row)
-    # if there are roads in the valley bottom, calculate distance
+    # if there are roads in the valley bottom, get mean distance from them within 30 m buffer of each network segment
     else:
-        # set extent to the stream network
-        arcpy.env.extent = out_network
-        # calculate euclidean distance from roads in the valley bottom
-        ed_roadad = EucDistance(feature_subset, cell_size = 5) # cell size of 5 m
-        # get mean distance from roads in the valley bottom within 30 m buffer of each network segment
-        zonalStatsWithinBuffer(buf, ed_roadad, 'MEAN', 'MEAN', out_network, new_field_name, scratch)
+        distanceWithinBuffer(buf, segments, 'MEAN', out_network, new_field_name, cache_folder)
 
-        # delete temp fcs, tbls, etc.
-        items = []
-        for item in items:
-            arcpy.Delete_management(item)
+
+def distanceWithinBuffer(buffer, segments, statType, outFC, outFCField, cache_folder=None):
+    """
+    Gets the minimum or mean distance from the cells in each reach buffer to the nearest feature, and writes it to
+    the network. Distances are measured exactly from each cell centre, so no Euclidean distance raster is made. The
+    cells are those of the Euclidean distance raster these values once came from, which covered the network's
+    extent, so the buffer means stay the same
+    :param buffer: The buffer polygons, with one feature per ReachID
+    :param segments: The segments of the features to measure to, from Distance_Engine.read_segments
+    :param statType: 'MINIMUM' or 'MEAN'
+    :param outFC: The network to write the distances to
+    :param outFCField: The field to write the distances to
+    :param cache_folder: If given, the folder to keep cell indexes in, so that later features reuse them
+    :return:
+    """
+    desc = arcpy.Describe(outFC)
+    extent = desc.extent
+    cell_size = DISTANCE_CELL_SIZE / desc.spatialReference.metersPerUnit
+    grid = Zonal_Engine.RasterGrid(extent.XMin, extent.YMax, cell_size, cell_size,
+                                   np.ceil((extent.YMax - extent.YMin) / cell_size),
+                                   np.ceil((extent.XMax - extent.XMin) / cell_size), desc.spatialReference)
+    if cache_folder:
+        cell_index = Zonal_Engine.CellIndex.load_or_build(buffer, grid, cache_folder)
+    else:
+        cell_index = Zonal_Engine.CellIndex.build(buffer, grid)
+    reach_ids = cell_index.reach_ids
+    distances = Distance_Engine.zone_distances(Distance_Engine.SegmentIndex(segments), cell_index, grid, statType)
+
+    # reaches whose buffers hold no cells get a value of 0
+    no_data = np.isnan(distances)
+    if no_data.any():
+        warning_message = "While calculating " + outFCField + ", " + str(np.count_nonzero(no_data)) + " reach buffers "
+        warning_message += "held no cells. The following ReachIDs were given a value of 0:\n"
+        warning_message += ", ".join(str(reachID) for reachID in reach_ids[no_data]) + "\n"
+        arcpy.AddWarning(warning_message)
+        distances[no_data] = 0
+
+    distanceDict = dict(zip(reach_ids.tolist(), distances.tolist()))
+    with arcpy.da.UpdateCursor(outFC, ['ReachID', outFCField]) as cursor:
+        for row in cursor:
+            if row[0] in distanceDict:
+                row[1] = distanceDict[row[0]]
+                cursor.updateRow(row)
 
 
 # calculate drainage area function
 def calc_drain_area(DEM, inputDEM):
 
-    #  define raster environment settings
-    desc = arcpy.Describe(DEM)
-    arcpy.env.extent = desc.Extent
-    arcpy.env.outputCoordinateSystem = desc.SpatialReference
-    arcpy.env.cellSize = desc.meanCellWidth
-
-    #  calculate cell area for use in drainage area calcultion
-    height = desc.meanCellHeight
-    width = desc.meanCellWidth
-    cellArea = height * width
+    flowFolder = os.path.dirname(inputDEM) + "/Flow"
+    if not os.path.exists(flowFolder):
+        os.mkdir(flowFolder)
+    # the flow direction is kept next to the drainage area, so that BDWS can use it instead of filling the dem again
+    flowDirection = flowFolder + "/" + FLOW_DIRECTION_NAME
+    for item in [flowFolder + "/DrainArea_sqkm.tif", flowDirection]:
+        if os.path.exists(item):
+            arcpy.Delete_management(item)
 
     # derive drainage area raster (in square km) from input DEM
     # note: draiange area calculation assumes input dem is in meters
-    filled_DEM = Fill(DEM) # fill sinks in dem
-    flow_direction = FlowDirection(filled_DEM) # calculate flow direction
-    flow_accumulation = FlowAccumulation(flow_direction) # calculate flow accumulattion
-    DrainArea = flow_accumulation * cellArea / 1000000 # calculate drainage area in square kilometers
-
-    # save drainage area raster
-    if os.path.exists(os.path.dirname(inputDEM) + "/Flow/DrainArea_sqkm.tif"):
-        arcpy.Delete_management(os.path.dirname(inputDEM) + "/Flow/DrainArea_sqkm.tif")
-        arcpy.CopyRaster_management(DrainArea, os.path.dirname(inputDEM) + "/Flow/DrainArea_sqkm.tif")
+    if arcpy.CheckExtension("Spatial") == "Available":
+        #  define raster environment settings
+        desc = arcpy.Describe(DEM)
+        arcpy.env.extent = desc.Extent
+        arcpy.env.outputCoordinateSystem = desc.SpatialReference
+        arcpy.env.cellSize = desc.meanCellWidth
+
+        #  calculate cell area for use in drainage area calcultion
+        height = desc.meanCellHeight
+        width = desc.meanCellWidth
+        cellArea = height * width
+
+        filled_DEM = Fill(DEM) # fill sinks in dem
+        flow_direction = FlowDirection(filled_DEM) # calculate flow direction
+        arcpy.CopyRaster_management(flow_direction, flowDirection)
+        flow_accumulation = FlowAccumulation(flow_direction) # calculate flow accumulattion
+        DrainArea = flow_accumulation * cellArea / 1000000 # calculate drainage area in square kilometers
+
+        # save drainage area raster
+        arcpy.CopyRaster_management(DrainArea, flowFolder + "/DrainArea_sqkm.tif")
     else:
-        os.mkdir(os.path.dirname(inputDEM) + "/Flow")
-        arcpy.CopyRaster_management(DrainArea, os.path.dirname(inputDEM) + "/Flow/DrainArea_sqkm.tif")
+        # without Spatial Analyst, the dem is filled and routed with GDAL, which is only imported if it is needed
+        import Terrain_Engine
+        # the filled dem is only needed on the way, so is kept in the scratch folder
+        filled_DEM = Terrain_Engine.fill_depressions(DEM, os.path.join(arcpy.env.scratchFolder, "Filled_DEM.tif")) # fill sinks in dem
+        Terrain_Engine.flow_direction(filled_DEM, flowDirection, 'ESRI') # calculate flow direction
+
+        # calculate drainage area in square kilometers and save drainage area raster
+        Terrain_Engine.drainage_area(flowDirection, flowFolder + "/DrainArea_sqkm.tif")
+        arcpy.Delete_management(filled_DEM)
 
 
 # write xml function
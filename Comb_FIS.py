@@ -10,21 +10,126 @@
 # -------------------------------------------------------------------------------
 
 import arcpy
-import skfuzzy as fuzz
-from skfuzzy import control as ctrl
 import numpy as np
 import os
 import sys
 import projectxml
 import uuid
 import xml.etree.ElementTree as ET
+import Veg_FIS
+import iHyd
+from FIS_Engine import FuzzyVariable, FuzzyInferenceSystem, infer_shared
+
+
+# number of (sample, reach) pairs run through the fis at once in monteCarlo
+MONTE_CARLO_BLOCK_SIZE = 1000000
+
+# fields that monteCarlo keeps from going negative after perturbing them, as negative values have no meaning
+NON_NEGATIVE_FIELDS = ['iGeo_Slope', 'iGeo_DA', 'iHyd_QLow', 'iHyd_Q2']
+
+# dam density terms, used both for the vegetation capacity input (oVC_*) and the combined capacity output
+DENSITY_TERMS = [
+    ('none', 'trimf', [0, 0, 0.1]),
+    ('rare', 'trapmf', [0, 0.1, 0.5, 1.5]),
+    ('occasional', 'trapmf', [0.5, 1.5, 4, 8]),
+    ('frequent', 'trapmf', [4, 8, 12, 25]),
+    ('pervasive', 'trapmf', [12, 25, 45, 45])]
+
+SP2_TERMS = [
+    ('persists', 'trapmf', [0, 0, 1000, 1200]),
+    ('breach', 'trimf', [1000, 1200, 1600]),
+    ('oblowout', 'trimf', [1200, 1600, 2400]),
+    ('blowout', 'trapmf', [1600, 2400, 10000, 10000])]
+
+SPLOW_TERMS = [
+    ('can', 'trapmf', [0, 0, 150, 175]),
+    ('probably', 'trapmf', [150, 175, 180, 190]),
+    ('cannot', 'trapmf', [180, 190, 10000, 10000])]
+
+SLOPE_TERMS = [
+    ('flat', 'trapmf', [0, 0, 0.0002, 0.005]),
+    ('can', 'trapmf', [0.0002, 0.005, 0.12, 0.15]),
+    ('probably', 'trapmf', [0.12, 0.15, 0.17, 0.23]),
+    ('cannot', 'trapmf', [0.17, 0.23, 1, 1])]
+
+# fis rule table: (ovc, sp2, splow, slope, density)
+# None means the rule ignores that input, and '~' means the complement of the term
+COMB_RULES = [
+    ('none', None, None, None, 'none'),
+    (None, None, 'cannot', None, 'none'),
+    (None, None, None, 'cannot', 'none'),
+    ('rare', 'persists', 'can', '~cannot', 'rare'),
+    ('rare', 'persists', 'probably', '~cannot', 'rare'),
+    ('rare', 'breach', 'can', '~cannot', 'rare'),
+    ('rare', 'breach', 'probably', '~cannot', 'rare'),
+    ('rare', 'oblowout', 'can', '~cannot', 'rare'),
+    ('rare', 'oblowout', 'probably', '~cannot', 'rare'),
+    ('rare', 'blowout', 'can', '~cannot', 'none'),
+    ('rare', 'blowout', 'probably', '~cannot', 'none'),
+    ('occasional', 'persists', 'can', '~cannot', 'occasional'),
+    ('occasional', 'persists', 'probably', '~cannot', 'occasional'),
+    ('occasional', 'breach', 'can', '~cannot', 'occasional'),
+    ('occasional', 'breach', 'probably', '~cannot', 'occasional'),
+    ('occasional', 'oblowout', 'can', '~cannot', 'occasional'),
+    ('occasional', 'oblowout', 'probably', '~cannot', 'occasional'),
+    ('occasional', 'blowout', 'can', '~cannot', 'rare'),
+    ('occasional', 'blowout', 'probably', '~cannot', 'rare'),
+    ('frequent', 'persists', 'can', 'flat', 'occasional'),
+    ('frequent', 'persists', 'can', 'can', 'frequent'),
+    ('frequent', 'persists', 'can', 'probably', 'occasional'),
+    ('frequent', 'persists', 'probably', 'flat', 'occasional'),
+    ('frequent', 'persists', 'probably', 'can', 'frequent'),
+    ('frequent', 'persists', 'probably', 'probably', 'occasional'),
+    ('frequent', 'breach', 'can', 'flat', 'occasional'),
+    ('frequent', 'breach', 'can', 'can', 'frequent'),
+    ('frequent', 'breach', 'can', 'probably', 'occasional'),
+    ('frequent', 'breach', 'probably', 'flat', 'occasional'),
+    ('frequent', 'breach', 'probably', 'can', 'frequent'),
+    ('frequent', 'breach', 'probably', 'probably', 'occasional'),
+    ('frequent', 'oblowout', 'can', 'flat', 'occasional'),
+    ('frequent', 'oblowout', 'can', 'can', 'frequent'),
+    ('frequent', 'oblowout', 'can', 'probably', 'occasional'),
+    ('frequent', 'oblowout', 'probably', 'flat', 'rare'),
+    ('frequent', 'oblowout', 'probably', 'can', 'occasional'),
+    ('frequent', 'oblowout', 'probably', 'probably', 'rare'),
+    ('frequent', 'blowout', 'can', 'flat', 'rare'),
+    ('frequent', 'blowout', 'can', 'can', 'rare'),
+    ('frequent', 'blowout', 'can', 'probably', 'rare'),
+    ('frequent', 'blowout', 'probably', 'flat', 'rare'),
+    ('frequent', 'blowout', 'probably', 'can', 'rare'),
+    ('frequent', 'blowout', 'probably', 'probably', 'rare'),
+    ('pervasive', 'persists', 'can', 'flat', 'frequent'),
+    ('pervasive', 'persists', 'can', 'can', 'pervasive'),
+    ('pervasive', 'persists', 'can', 'probably', 'frequent'),
+    ('pervasive', 'persists', 'probably', 'flat', 'frequent'),
+    ('pervasive', 'persists', 'probably', 'can', 'pervasive'),
+    ('pervasive', 'persists', 'probably', 'probably', 'frequent'),
+    ('pervasive', 'breach', 'can', 'flat', 'frequent'),
+    ('pervasive', 'breach', 'can', 'can', 'pervasive'),
+    ('pervasive', 'breach', 'can', 'probably', 'frequent'),
+    ('pervasive', 'breach', 'probably', 'flat', 'frequent'),
+    ('pervasive', 'breach', 'probably', 'can', 'pervasive'),
+    ('pervasive', 'breach', 'probably', 'probably', 'frequent'),
+    ('pervasive', 'oblowout', 'can', 'flat', 'frequent'),
+    ('pervasive', 'oblowout', 'can', 'can', 'pervasive'),
+    ('pervasive', 'oblowout', 'can', 'probably', 'frequent'),
+    ('pervasive', 'oblowout', 'probably', 'flat', 'occasional'),
+    ('pervasive', 'oblowout', 'probably', 'can', 'frequent'),
+    ('pervasive', 'oblowout', 'probably', 'probably', 'occasional'),
+    ('pervasive', 'blowout', 'can', 'flat', 'occasional'),
+    ('pervasive', 'blowout', 'can', 'can', 'occasional'),
+    ('pervasive', 'blowout', 'can', 'probably', 'rare'),
+    ('pervasive', 'blowout', 'probably', 'flat', 'occasional'),
+    ('pervasive', 'blowout', 'probably', 'can', 'occasional'),
+    ('pervasive', 'blowout', 'probably', 'probably', 'rare')]
 
 
 def main(
     projPath,
     in_network,
     max_DA_thresh,
-    out_name):
+    out_name,
+    decimals=None):
 
     scratch = 'in_memory'
 
@@ -40,8 +145,8 @@ def main(
     arcpy.CopyFeatures_management(in_network, out_network)
 
     # run the combined fis function for both potential and existing
-    combFIS(out_network, 'pt', scratch, max_DA_thresh)
-    combFIS(out_network, 'ex', scratch, max_DA_thresh)
+    combFIS(out_network, 'pt', scratch, max_DA_thresh, decimals)
+    combFIS(out_network, 'ex', scratch, max_DA_thresh, decimals)
 
     makeLayers(out_network, out_name)
 
@@ -49,7 +154,7 @@ def main(
 
 
 # combined fis function
-def combFIS(in_network, model_run, scratch, max_DA_thresh):
+def combFIS(in_network, model_run, scratch, max_DA_thresh, decimals=None):
     arcpy.env.overwriteOutput = True
 
     # get list of all fields in the flowline network
@@ -70,153 +175,22 @@ def combFIS(in_network, model_run, scratch, max_DA_thresh):
         arcpy.DeleteField_management(in_network, out_field)
 
     # get arrays for fields of interest
-    segid_np = arcpy.da.FeatureClassToNumPyArray(in_network, "ReachID")
-    ovc_np = arcpy.da.FeatureClassToNumPyArray(in_network, veg_field)
-    ihydsp2_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iHyd_SP2")
-    ihydsplow_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iHyd_SPLow")
-    igeoslope_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iGeo_Slope")
-
-    segid_array = np.asarray(segid_np, np.int64)
-    ovc_array = np.asarray(ovc_np, np.float64)
-    ihydsp2_array = np.asarray(ihydsp2_np, np.float64)
-    ihydsplow_array = np.asarray(ihydsplow_np, np.float64)
-    igeoslope_array = np.asarray(igeoslope_np, np.float64)
-
-    # check that inputs are within range of fis
-    # if not, re-assign the value to just within range
-    ovc_array[ovc_array < 0] = 0
-    ovc_array[ovc_array > 45] = 45
-    ihydsp2_array[ihydsp2_array < 0] = 0.0001
-    ihydsp2_array[ihydsp2_array > 10000] = 10000
-    ihydsplow_array[ihydsplow_array < 0] = 0.0001
-    ihydsplow_array[ihydsplow_array > 10000] = 10000
-    igeoslope_array[igeoslope_array > 1] = 1
-
-    # delete temp arrays
-    items = [segid_np, ovc_np, ihydsp2_np, ihydsplow_np, igeoslope_np]
-    for item in items:
-        del item
-
-    # create antecedent (input) and consequent (output) objects to hold universe variables and membership functions
-    ovc = ctrl.Antecedent(np.arange(0, 45, 0.01), 'input1')
-    sp2 = ctrl.Antecedent(np.arange(0, 10000, 1), 'input2')
-    splow = ctrl.Antecedent(np.arange(0, 10000, 1), 'input3')
-    slope = ctrl.Antecedent(np.arange(0, 1, 0.0001), 'input4')
-    density = ctrl.Consequent(np.arange(0, 45, 0.01), 'result')
-
-    # build membership functions for each antecedent and consequent object
-    ovc['none'] = fuzz.trimf(ovc.universe, [0, 0, 0.1])
-    ovc['rare'] = fuzz.trapmf(ovc.universe, [0, 0.1, 0.5, 1.5])
-    ovc['occasional'] = fuzz.trapmf(ovc.universe, [0.5, 1.5, 4, 8])
-    ovc['frequent'] = fuzz.trapmf(ovc.universe, [4, 8, 12, 25])
-    ovc['pervasive'] = fuzz.trapmf(ovc.universe, [12, 25, 45, 45])
-
-    sp2['persists'] = fuzz.trapmf(sp2.universe, [0, 0, 1000, 1200])
-    sp2['breach'] = fuzz.trimf(sp2.universe, [1000, 1200, 1600])
-    sp2['oblowout'] = fuzz.trimf(sp2.universe, [1200, 1600, 2400])
-    sp2['blowout'] = fuzz.trapmf(sp2.universe, [1600, 2400, 10000, 10000])
-
-    splow['can'] = fuzz.trapmf(splow.universe, [0, 0, 150, 175])
-    splow['probably'] = fuzz.trapmf(splow.universe, [150, 175, 180, 190])
-    splow['cannot'] = fuzz.trapmf(splow.universe, [180, 190, 10000, 10000])
-
-    slope['flat'] = fuzz.trapmf(slope.universe, [0, 0, 0.0002, 0.005])
-    slope['can'] = fuzz.trapmf(slope.universe, [0.0002, 0.005, 0.12, 0.15])
-    slope['probably'] = fuzz.trapmf(slope.universe, [0.12, 0.15, 0.17, 0.23])
-    slope['cannot'] = fuzz.trapmf(slope.universe, [0.17, 0.23, 1, 1])
-
-    density['none'] = fuzz.trimf(density.universe, [0, 0, 0.1])
-    density['rare'] = fuzz.trapmf(density.universe, [0, 0.1, 0.5, 1.5])
-    density['occasional'] = fuzz.trapmf(density.universe, [0.5, 1.5, 4, 8])
-    density['frequent'] = fuzz.trapmf(density.universe, [4, 8, 12, 25])
-    density['pervasive'] = fuzz.trapmf(density.universe, [12, 25, 45, 45])
-
-    # build fis rule table
-    rule1 = ctrl.Rule(ovc['none'], density['none'])
-    rule2 = ctrl.Rule(splow['cannot'], density['none'])
-    rule3 = ctrl.Rule(slope['cannot'], density['none'])
-    rule4 = ctrl.Rule(ovc['rare'] & sp2['persists'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule5 = ctrl.Rule(ovc['rare'] & sp2['persists'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule6 = ctrl.Rule(ovc['rare'] & sp2['breach'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule7 = ctrl.Rule(ovc['rare'] & sp2['breach'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule8 = ctrl.Rule(ovc['rare'] & sp2['oblowout'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule9 = ctrl.Rule(ovc['rare'] & sp2['oblowout'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule10 = ctrl.Rule(ovc['rare'] & sp2['blowout'] & splow['can'] & ~slope['cannot'], density['none'])
-    rule11 = ctrl.Rule(ovc['rare'] & sp2['blowout'] & splow['probably'] & ~slope['cannot'], density['none'])
-    rule12 = ctrl.Rule(ovc['occasional'] & sp2['persists'] & splow['can'] & ~slope['cannot'], density['occasional'])
-    rule13 = ctrl.Rule(ovc['occasional'] & sp2['persists'] & splow['probably'] & ~slope['cannot'], density['occasional'])
-    rule14 = ctrl.Rule(ovc['occasional'] & sp2['breach'] & splow['can'] & ~slope['cannot'], density['occasional'])
-    rule15 = ctrl.Rule(ovc['occasional'] & sp2['breach'] & splow['probably'] & ~slope['cannot'], density['occasional'])
-    rule16 = ctrl.Rule(ovc['occasional'] & sp2['oblowout'] & splow['can'] & ~slope['cannot'], density['occasional'])
-    rule17 = ctrl.Rule(ovc['occasional'] & sp2['oblowout'] & splow['probably'] & ~slope['cannot'], density['occasional'])
-    rule18 = ctrl.Rule(ovc['occasional'] & sp2['blowout'] & splow['can'] & ~slope['cannot'], density['rare'])
-    rule19 = ctrl.Rule(ovc['occasional'] & sp2['blowout'] & splow['probably'] & ~slope['cannot'], density['rare'])
-    rule20 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['can'] & slope['flat'], density['occasional'])
-    rule21 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['can'] & slope['can'], density['frequent'])
-    rule22 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['can'] & slope['probably'], density['occasional'])
-    rule23 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule24 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['probably'] & slope['can'], density['frequent'])
-    rule25 = ctrl.Rule(ovc['frequent'] & sp2['persists'] & splow['probably'] & slope['probably'], density['occasional'])
-    rule26 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['can'] & slope['flat'], density['occasional'])
-    rule27 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['can'] & slope['can'], density['frequent'])
-    rule28 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['can'] & slope['probably'], density['occasional'])
-    rule29 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule30 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['probably'] & slope['can'], density['frequent'])
-    rule31 = ctrl.Rule(ovc['frequent'] & sp2['breach'] & splow['probably'] & slope['probably'], density['occasional'])
-    rule32 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['can'] & slope['flat'], density['occasional'])
-    rule33 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['can'] & slope['can'], density['frequent'])
-    rule34 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['can'] & slope['probably'], density['occasional'])
-    rule35 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['probably'] & slope['flat'], density['rare'])
-    rule36 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['probably'] & slope['can'], density['occasional'])
-    rule37 = ctrl.Rule(ovc['frequent'] & sp2['oblowout'] & splow['probably'] & slope['probably'], density['rare'])
-    rule38 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['can'] & slope['flat'], density['rare'])
-    rule39 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['can'] & slope['can'], density['rare'])
-    rule40 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['can'] & slope['probably'], density['rare'])
-    rule41 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['probably'] & slope['flat'], density['rare'])
-    rule42 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['probably'] & slope['can'], density['rare'])
-    rule43 = ctrl.Rule(ovc['frequent'] & sp2['blowout'] & splow['probably'] & slope['probably'], density['rare'])
-    rule44 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['can'] & slope['flat'], density['frequent'])
-    rule45 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['can'] & slope['can'], density['pervasive'])
-    rule46 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['can'] & slope['probably'], density['frequent'])
-    rule47 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['probably'] & slope['flat'], density['frequent'])
-    rule48 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['probably'] & slope['can'], density['pervasive'])
-    rule49 = ctrl.Rule(ovc['pervasive'] & sp2['persists'] & splow['probably'] & slope['probably'], density['frequent'])
-    rule50 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['can'] & slope['flat'], density['frequent'])
-    rule51 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['can'] & slope['can'], density['pervasive'])
-    rule52 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['can'] & slope['probably'], density['frequent'])
-    rule53 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['probably'] & slope['flat'], density['frequent'])
-    rule54 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['probably'] & slope['can'], density['pervasive'])
-    rule55 = ctrl.Rule(ovc['pervasive'] & sp2['breach'] & splow['probably'] & slope['probably'], density['frequent'])
-    rule56 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['can'] & slope['flat'], density['frequent'])
-    rule57 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['can'] & slope['can'], density['pervasive'])
-    rule58 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['can'] & slope['probably'], density['frequent'])
-    rule59 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule60 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['probably'] & slope['can'], density['frequent'])
-    rule61 = ctrl.Rule(ovc['pervasive'] & sp2['oblowout'] & splow['probably'] & slope['probably'], density['occasional'])
-    rule62 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['can'] & slope['flat'], density['occasional'])
-    rule63 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['can'] & slope['can'], density['occasional'])
-    rule64 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['can'] & slope['probably'], density['rare'])
-    rule65 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['probably'] & slope['flat'], density['occasional'])
-    rule66 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['probably'] & slope['can'], density['occasional'])
-    rule67 = ctrl.Rule(ovc['pervasive'] & sp2['blowout'] & splow['probably'] & slope['probably'], density['rare'])
-
-    comb_ctrl = ctrl.ControlSystem([rule1, rule2, rule3, rule4, rule5, rule6, rule7, rule8, rule9, rule10, rule11, rule12,
-                                    rule13, rule14, rule15, rule16, rule17, rule18, rule19, rule20, rule21, rule22, rule23,
-                                    rule24, rule25, rule26, rule27, rule28, rule29, rule30, rule31, rule32, rule33, rule34,
-                                    rule35, rule36, rule37, rule38, rule39, rule40, rule41, rule42, rule43, rule44, rule45,
-                                    rule46, rule47, rule48, rule49, rule50, rule51, rule52, rule53, rule54, rule55, rule56,
-                                    rule57, rule58, rule59, rule60, rule61, rule62, rule63, rule64, rule65, rule66, rule67])
-    comb_fis = ctrl.ControlSystemSimulation(comb_ctrl)
-
-    # run fuzzy inference system on inputs and defuzzify output
-    out = np.zeros(len(ovc_array)) # todo: test this using nas instead of zeros
-    for i in range(len(out)):
-        comb_fis.input['input1'] = ovc_array[i]
-        comb_fis.input['input2'] = ihydsp2_array[i]
-        comb_fis.input['input3'] = ihydsplow_array[i]
-        comb_fis.input['input4'] = igeoslope_array[i]
-        comb_fis.compute()
-        out[i] = comb_fis.output['result']
+    segid_array, veg_array, inputs, igeoda_array = readInputs(in_network, veg_field)
+
+    # find reaches whose output is decided before inference: those over the drainage area threshold, and those
+    # where oVC_* is 'none' or splow or slope is 'cannot', which only leaves 'none' rules able to fire
+    # run fuzzy inference system on the remaining inputs and defuzzify output
+    comb_fis = build_comb_fis()
+    out, pruned, unique_count = inferCapacity(comb_fis, inputs, igeoda_array >= float(max_DA_thresh), decimals)
+    if len(pruned) > 0:
+        arcpy.AddMessage(out_field + ": " + str(np.count_nonzero(pruned)) + " of " + str(len(pruned)) + " reaches (" +
+                         str(round(100.0 * np.count_nonzero(pruned) / len(pruned), 1)) + "%) decided before running the FIS")
+        remaining = len(pruned) - np.count_nonzero(pruned)
+        arcpy.AddMessage(out_field + ": ran the FIS for " + str(unique_count) + " distinct inputs across " +
+                         str(remaining) + " remaining reaches (" +
+                         str(round(float(remaining) / max(unique_count, 1), 1)) + " reaches per run)")
+
+    out = applyLimits(out, veg_array, igeoda_array, max_DA_thresh)
 
     # save fuzzy inference system output as table
     columns = np.column_stack((segid_array, out))
@@ -244,35 +218,10 @@ def combFIS(in_network, model_run, scratch, max_DA_thresh):
                 pass
     tblDict.clear()
 
-    # calculate defuzzified centroid value for density 'none' MF group
-    # this will be used to re-classify output values that fall in this group
-    # important: will need to update the array (x) and MF values (mfx) if the
-    #            density 'none' values are changed in the model
-    x = np.arange(0, 45, 0.01)
-    mfx = fuzz.trimf(x, [0, 0, 0.1])
-    defuzz_centroid = round(fuzz.defuzz(x, mfx, 'centroid'), 6)
-
-    # update combined capacity (occ_*) values in stream network
-    # correct for occ_* greater than ovc_* as vegetation is most limiting factor in model
-    # (i.e., combined fis value should not be greater than the vegetation capacity)
-    # set occ_* to 0 if the drainage area is greater than the user defined threshold
-    # this enforces a stream size threshold above which beaver dams won't persist and/or won't be built
-    # set occ_* to 0 if output falls fully in 'none' category
-
-    with arcpy.da.UpdateCursor(in_network, [out_field, veg_field, 'iGeo_DA', 'iGeo_Slope']) as cursor:
-        for row in cursor:
-            if row[0] > row[1]:
-                row[0] = row[1]
-            if row[2] >= float(max_DA_thresh):
-                row[0] = 0.0
-            if round(row[0], 6) == defuzz_centroid:
-                row[0] = 0.0
-            cursor.updateRow(row)
-
     # delete temporary tables and arrays
     arcpy.Delete_management(out_table)
     arcpy.Delete_management(occ_table)
-    items = [columns, out, x, mfx, defuzz_centroid]
+    items = [columns, out, pruned]
     for item in items:
         del item
 
@@ -291,6 +240,354 @@ def combFIS(in_network, model_run, scratch, max_DA_thresh):
     #             row[0] = row[1] / row[2]
     #             cursor.updateRow(row)
 
+def readInputs(in_network, veg_field):
+    """
+    Reads the combined FIS inputs from the network, clipped to the range of the fis
+    :param in_network: The network to read from
+    :param veg_field: The vegetation capacity field, oVC_PT or oVC_EX
+    :return: The ReachID array, the unclipped vegetation capacity array, a list of the four clipped fis input
+    arrays and the drainage area array
+    """
+    segid_np = arcpy.da.FeatureClassToNumPyArray(in_network, "ReachID")
+    ovc_np = arcpy.da.FeatureClassToNumPyArray(in_network, veg_field)
+    ihydsp2_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iHyd_SP2")
+    ihydsplow_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iHyd_SPLow")
+    igeoslope_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iGeo_Slope")
+    igeoda_np = arcpy.da.FeatureClassToNumPyArray(in_network, "iGeo_DA")
+
+    segid_array = np.asarray(segid_np, np.int64)
+    ovc_array = np.asarray(ovc_np, np.float64)
+    ihydsp2_array = np.asarray(ihydsp2_np, np.float64)
+    ihydsplow_array = np.asarray(ihydsplow_np, np.float64)
+    igeoslope_array = np.asarray(igeoslope_np, np.float64)
+    igeoda_array = np.asarray(igeoda_np, np.float64)
+    veg_array = ovc_array.copy()
+
+    # delete temp arrays
+    items = [segid_np, ovc_np, ihydsp2_np, ihydsplow_np, igeoslope_np, igeoda_np]
+    for item in items:
+        del item
+
+    return segid_array, veg_array, clipInputs(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array), igeoda_array
+
+
+def clipInputs(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array):
+    """
+    Checks that inputs are within range of fis, and if not, re-assigns the value to just within range
+    :param ovc_array: Vegetation capacity (oVC_*)
+    :param ihydsp2_array: Annual peak stream power (iHyd_SP2)
+    :param ihydsplow_array: Baseflow stream power (iHyd_SPLow)
+    :param igeoslope_array: Slope (iGeo_Slope)
+    :return: A list of the four arrays, clipped in place
+    """
+    ovc_array[ovc_array < 0] = 0
+    ovc_array[ovc_array > 45] = 45
+    ihydsp2_array[ihydsp2_array < 0] = 0.0001
+    ihydsp2_array[ihydsp2_array > 10000] = 10000
+    ihydsplow_array[ihydsplow_array < 0] = 0.0001
+    ihydsplow_array[ihydsplow_array > 10000] = 10000
+    igeoslope_array[igeoslope_array > 1] = 1
+    return [ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array]
+
+
+def inferCapacity(comb_fis, inputs, decided, decimals=None):
+    """
+    Runs the combined FIS, skipping reaches whose output is decided before inference: those given in 'decided',
+    and those where oVC_* is 'none' or splow or slope is 'cannot', which only leaves 'none' rules able to fire.
+    The FIS is only run once for each distinct set of inputs among the remaining reaches
+    :param comb_fis: The combined FuzzyInferenceSystem
+    :param inputs: The four clipped fis input arrays
+    :param decided: Boolean array of reaches whose output will be overwritten anyway
+    :param decimals: If given, inputs are rounded to this many decimal places, so more reaches share inputs
+    :return: The fis output with the 'none' category set to 0, the boolean array of skipped reaches, and the
+    number of distinct sets of inputs that were run
+    """
+    pruned = decided | comb_fis.forces_only(inputs, 'none')
+    infer_index = np.flatnonzero(~pruned)
+
+    # set occ_* to 0 if output falls fully in 'none' category, as the pruned reaches do
+    out = np.zeros(len(pruned))
+    fis_out, activations, unique_count = comb_fis.infer_unique([value[infer_index] for value in inputs], decimals)
+    fis_out[comb_fis.fires_only(activations, 'none')] = 0.0
+    out[infer_index] = fis_out
+    return out, pruned, unique_count
+
+
+def applyLimits(out, veg_array, igeoda_array, max_DA_thresh):
+    """
+    Applies the vegetation and drainage area limits to the combined FIS output
+    :param out: The combined FIS output, with the 'none' category already set to 0
+    :param veg_array: The unclipped vegetation capacity (oVC_*)
+    :param igeoda_array: The drainage area (iGeo_DA)
+    :param max_DA_thresh: The drainage area above which dams won't persist
+    :return: The final combined capacity
+    """
+    # correct for occ_* greater than ovc_* as vegetation is most limiting factor in model
+    # (i.e., combined fis value should not be greater than the vegetation capacity)
+    # set occ_* to 0 if the drainage area is greater than the user defined threshold
+    # this enforces a stream size threshold above which beaver dams won't persist and/or won't be built
+    out = np.where(out > veg_array, veg_array, out)
+    out[igeoda_array >= float(max_DA_thresh)] = 0.0
+    return out
+
+
+def sweep(in_network, scenarios, out_table, model_runs=('pt', 'ex')):
+    """
+    Runs the combined FIS for several parameter sets at once, without copying the network. Membership grades
+    are shared between scenarios wherever an input is unchanged, and scenarios that only differ in their
+    drainage area threshold share the whole FIS run
+    :param in_network: The network, with the oVC_*, iHyd_SP2, iHyd_SPLow, iGeo_Slope and iGeo_DA fields
+    :param scenarios: A list of dictionaries, each with a 'name', a 'max_DA_thresh', and optionally 'sp2'
+    and 'splow' dictionaries of term label to the breakpoints that replace the defaults
+    :param out_table: The text table to write, with a ReachID column and one column per scenario and run
+    :param model_runs: Which of 'pt' and 'ex' to run
+    :return: The (reaches, scenarios * runs) array of combined capacity
+    """
+    systems = [build_comb_fis(scenario.get('sp2'), scenario.get('splow')) for scenario in scenarios]
+
+    columns = []
+    header = ["ReachID"]
+    segid_array = None
+    for model_run in model_runs:
+        veg_field = "oVC_PT" if model_run == 'pt' else "oVC_EX"
+        segid_array, veg_array, inputs, igeoda_array = readInputs(in_network, veg_field)
+        columns.extend(sweepCapacity(scenarios, systems, veg_array, inputs, igeoda_array))
+        header.extend(str(scenario['name']) + "_" + model_run.upper() for scenario in scenarios)
+
+    matrix = np.column_stack(columns)
+    np.savetxt(out_table, np.column_stack((segid_array, matrix)), delimiter = ",", header = ", ".join(header),
+               comments = "")
+    arcpy.AddMessage("Wrote " + str(matrix.shape[1]) + " scenario columns for " + str(matrix.shape[0]) +
+                     " reaches to " + out_table)
+    return matrix
+
+
+def sweepCapacity(scenarios, systems, veg_array, inputs, igeoda_array):
+    """
+    Finds the combined capacity of every reach under each scenario, as combFIS would
+    :param scenarios: The scenarios, as for sweep
+    :param systems: The combined FuzzyInferenceSystem of each scenario
+    :param veg_array: The unclipped vegetation capacity (oVC_*)
+    :param inputs: The four clipped fis input arrays
+    :param igeoda_array: The drainage area (iGeo_DA)
+    :return: A list of the combined capacity array of each scenario
+    """
+    columns = []
+    for scenario, comb_fis, (fis_out, activations) in zip(scenarios, systems, infer_shared(systems, inputs)):
+        out = fis_out.copy()
+        out[comb_fis.fires_only(activations, 'none')] = 0.0
+        columns.append(applyLimits(out, veg_array, igeoda_array, scenario['max_DA_thresh']))
+    return columns
+
+
+def runMonteCarlo(
+    in_network,
+    max_DA_thresh,
+    error_models,
+    samples=None,
+    percentiles=None,
+    seed=None,
+    region=None,
+    region_field=None,
+    region_polygons=None,
+    curves_file=None):
+    """
+    Runs monteCarlo from the toolbox, where every parameter is given as text
+    :param in_network: The network, with the iVeg_*, iGeo_Slope, iGeo_DA, iHyd_QLow and iHyd_Q2 fields
+    :param max_DA_thresh: The drainage area above which dams won't persist
+    :param error_models: Rows of "field distribution spread", separated by semicolons
+    :param samples: How many ensemble members to run for each reach. Defaults to 100
+    :param percentiles: Whole-number percentiles separated by semicolons. Defaults to 5, 50 and 95
+    :param seed: Seed for the random number generator
+    :param region: The hydrologic region code, as for iHyd
+    :param region_field: The hydrologic region field, as for iHyd
+    :param region_polygons: The hydrologic region polygons, as for iHyd
+    :param curves_file: The regional curves table, as for iHyd
+    :return:
+    """
+    models = {}
+    for row in error_models.split(';'):
+        if row.strip() == '':
+            continue
+        field, distribution, spread = row.replace("'", "").split()
+        models[field] = (distribution, float(spread))
+    percentiles = [int(percentile) for percentile in percentiles.split(';')] if percentiles else [5, 50, 95]
+
+    monteCarlo(in_network, max_DA_thresh, models, int(samples) if samples else 100, percentiles,
+               int(seed) if seed else None, region, region_field, region_polygons, curves_file)
+
+
+def monteCarlo(in_network, max_DA_thresh, error_models, samples=100, percentiles=(5, 50, 95), seed=None,
+               region=None, region_field=None, region_polygons=None, curves_file=None):
+    """
+    Propagates input uncertainty through the vegetation and combined FIS. Each reach is given 'samples' sets of
+    perturbed inputs, the whole ensemble is run through both fis as one batch, and the percentiles of each reach's
+    combined capacity are written to oCC_PT_p05, oCC_EX_p50, etc.
+    :param in_network: The network, with the iVeg_*, iGeo_Slope, iGeo_DA, iHyd_QLow and iHyd_Q2 fields
+    :param max_DA_thresh: The drainage area above which dams won't persist
+    :param error_models: A dictionary of field name to (distribution, spread) for each uncertain field. A 'normal'
+    model adds normally distributed errors with a standard deviation of 'spread', and a 'lognormal' model
+    multiplies the field by exp() of normally distributed errors with a standard deviation of 'spread'. For
+    example, {'iGeo_Slope': ('lognormal', 0.25), 'iGeo_DA': ('lognormal', 0.1), 'iHyd_Q2': ('lognormal', 0.3)}.
+    With an iGeo_DA model, Qlow and Q2 are recalculated from the perturbed drainage area with the iHyd regional
+    curves, and any iHyd_QLow or iHyd_Q2 model is applied on top of that
+    :param samples: How many ensemble members to run for each reach
+    :param percentiles: Which whole-number percentiles of combined capacity to write
+    :param seed: Seed for the random number generator, to make runs repeatable
+    :param region: The hydrologic region code, as for iHyd. Only used with an iGeo_DA model
+    :param region_field: The hydrologic region field, as for iHyd. Only used with an iGeo_DA model
+    :param region_polygons: The hydrologic region polygons, as for iHyd. Only used with an iGeo_DA model
+    :param curves_file: The regional curves table, as for iHyd. Only used with an iGeo_DA model
+    :return:
+    """
+    veg_fis = Veg_FIS.build_veg_fis()
+    comb_fis = build_comb_fis()
+    random = np.random.RandomState(seed)
+
+    # discharge follows drainage area through the regional curves, so is recalculated when drainage area varies
+    curves = None
+    regions = None
+    if 'iGeo_DA' in error_models:
+        curves = iHyd.readRegionalCurves(curves_file if curves_file else iHyd.REGIONAL_CURVES)
+        reach_ids = np.asarray(arcpy.da.FeatureClassToNumPyArray(in_network, "ReachID")["ReachID"], np.int64)
+        regions = iHyd.findRegions(in_network, reach_ids, float(region if region is not None else
+                                                                iHyd.DEFAULT_REGION), region_field, region_polygons)
+
+    for model_run in ['pt', 'ex']:
+        suffix = model_run.upper()
+        fields = ['ReachID', 'iVeg_100' + suffix, 'iVeg_30' + suffix, 'iGeo_Slope', 'iGeo_DA', 'iHyd_QLow', 'iHyd_Q2']
+        for field in error_models:
+            if field not in fields and not field.startswith('iVeg_'):
+                raise Exception("No error model can be applied to " + field)
+
+        arcpy.AddMessage("Running " + str(samples) + " member ensemble for oCC_" + suffix + "...")
+        table = arcpy.da.FeatureClassToNumPyArray(in_network, fields)
+        result = ensemblePercentiles(table, model_run, max_DA_thresh, error_models, samples, percentiles, random,
+                                     veg_fis, comb_fis, curves, regions)
+
+        # write percentiles to the network
+        out_fields = ["oCC_" + suffix + "_p" + str(int(percentile)).zfill(2) for percentile in percentiles]
+        existing_fields = [f.name for f in arcpy.ListFields(in_network)]
+        tblDict = {}
+        for reach_id, row in zip(table['ReachID'], result):
+            tblDict[reach_id] = row
+        for out_field in out_fields:
+            if out_field in existing_fields:
+                arcpy.DeleteField_management(in_network, out_field)
+            arcpy.AddField_management(in_network, out_field, 'DOUBLE')
+        with arcpy.da.UpdateCursor(in_network, ['ReachID'] + out_fields) as cursor:
+            for row in cursor:
+                row[1:] = list(tblDict[row[0]])
+                cursor.updateRow(row)
+        tblDict.clear()
+
+
+def ensemblePercentiles(table, model_run, max_DA_thresh, error_models, samples, percentiles, random, veg_fis=None,
+                        comb_fis=None, curves=None, regions=None):
+    """
+    Runs the ensemble for every reach of a table of inputs, as monteCarlo does
+    :param table: Structured array with the iVeg_100*, iVeg_30*, iGeo_Slope, iGeo_DA, iHyd_QLow and iHyd_Q2 fields
+    :param model_run: 'pt' or 'ex'
+    :param max_DA_thresh: The drainage area above which dams won't persist
+    :param error_models: The error models, as for monteCarlo
+    :param samples: How many ensemble members to run for each reach
+    :param percentiles: Which percentiles of combined capacity to find
+    :param random: The RandomState to draw errors from
+    :param veg_fis: The vegetation FuzzyInferenceSystem. Built if not given
+    :param comb_fis: The combined FuzzyInferenceSystem. Built if not given
+    :param curves: The regional curves, if Qlow and Q2 are recalculated from the perturbed drainage area
+    :param regions: The region code of each reach, if curves are given
+    :return: A (reaches, percentiles) array of the percentiles of each reach's combined capacity
+    """
+    veg_fis = veg_fis if veg_fis is not None else Veg_FIS.build_veg_fis()
+    comb_fis = comb_fis if comb_fis is not None else build_comb_fis()
+    suffix = model_run.upper()
+    fields = ['iVeg_100' + suffix, 'iVeg_30' + suffix, 'iGeo_Slope', 'iGeo_DA', 'iHyd_QLow', 'iHyd_Q2']
+    block_size = max(1, MONTE_CARLO_BLOCK_SIZE // samples)
+    result = np.zeros((len(table), len(percentiles)))
+
+    # run the ensemble for a block of reaches at a time, with every sample of every reach in one batch
+    for start in range(0, len(table), block_size):
+        values = {}
+        for field in fields:
+            if curves is not None and field in ['iHyd_QLow', 'iHyd_Q2']:
+                continue
+            value = np.tile(np.asarray(table[field][start:start + block_size], np.float64), (samples, 1))
+            values[field] = perturbInput(value, field, error_models, random)
+        if curves is not None:
+            block_regions = np.tile(regions[start:start + block_size], samples)
+            qlow_array, q2_array = iHyd.calcDischarge(values['iGeo_DA'], block_regions, curves, False)
+            values['iHyd_QLow'] = perturbInput(qlow_array, 'iHyd_QLow', error_models, random)
+            values['iHyd_Q2'] = perturbInput(q2_array, 'iHyd_Q2', error_models, random)
+
+        # vegetation fis, as in Veg_FIS
+        riparian_array = np.clip(values['iVeg_100' + suffix], 0, 4)
+        streamside_array = np.clip(values['iVeg_30' + suffix], 0, 4)
+        ovc_array, activations = veg_fis.infer([riparian_array, streamside_array])
+        ovc_array[veg_fis.fires_only(activations, 'none')] = 0.0
+
+        # Q2 correction and stream power, as in iHyd
+        qlow_array = values['iHyd_QLow']
+        q2_array = np.where(values['iHyd_Q2'] < qlow_array, qlow_array + 0.001, values['iHyd_Q2'])
+        igeoslope_array = values['iGeo_Slope']
+        ihydsplow_array = iHyd.calcStreamPower(igeoslope_array, qlow_array)
+        ihydsp2_array = iHyd.calcStreamPower(igeoslope_array, q2_array)
+
+        # combined fis, as in combFIS
+        veg_array = ovc_array.copy()
+        inputs = clipInputs(ovc_array, ihydsp2_array, ihydsplow_array, igeoslope_array.copy())
+        out = inferCapacity(comb_fis, inputs, values['iGeo_DA'] >= float(max_DA_thresh))[0]
+        out = applyLimits(out, veg_array, values['iGeo_DA'], max_DA_thresh)
+
+        ensemble = out.reshape(samples, -1)
+        result[start:start + block_size] = np.percentile(ensemble, percentiles, axis=0).T
+
+    return result
+
+
+def perturbInput(value, field, error_models, random):
+    """
+    Applies the field's error model, if it has one, and keeps fields that can't be negative from going negative
+    :param value: The array of values to perturb
+    :param field: The field the values are from
+    :param error_models: The error models, as for monteCarlo
+    :param random: The RandomState to draw errors from
+    :return: The flattened array of perturbed values
+    """
+    value = np.array(value, np.float64)
+    if field in error_models:
+        distribution, spread = error_models[field]
+        if distribution == 'normal':
+            value += random.normal(0.0, spread, value.shape)
+        elif distribution == 'lognormal':
+            value *= np.exp(random.normal(0.0, spread, value.shape))
+        else:
+            raise Exception("Unknown error model distribution: " + str(distribution))
+        if field in NON_NEGATIVE_FIELDS:
+            value = np.maximum(value, 0.0)
+    return value.ravel()
+
+
+def build_comb_fis(sp2_breakpoints=None, splow_breakpoints=None):
+    """
+    Builds the combined capacity fuzzy inference system
+    :param sp2_breakpoints: Optional dictionary of iHyd_SP2 term label to breakpoints, replacing the defaults
+    :param splow_breakpoints: Optional dictionary of iHyd_SPLow term label to breakpoints, replacing the defaults
+    :return: A FuzzyInferenceSystem taking oVC_*, iHyd_SP2, iHyd_SPLow and iGeo_Slope
+    """
+    sp2_breakpoints = sp2_breakpoints or {}
+    splow_breakpoints = splow_breakpoints or {}
+    sp2_terms = [(label, mf, sp2_breakpoints.get(label, params)) for label, mf, params in SP2_TERMS]
+    splow_terms = [(label, mf, splow_breakpoints.get(label, params)) for label, mf, params in SPLOW_TERMS]
+
+    ovc = FuzzyVariable('input1', (0, 45, 0.01), DENSITY_TERMS)
+    sp2 = FuzzyVariable('input2', (0, 10000, 1), sp2_terms)
+    splow = FuzzyVariable('input3', (0, 10000, 1), splow_terms)
+    slope = FuzzyVariable('input4', (0, 1, 0.0001), SLOPE_TERMS)
+    density = FuzzyVariable('result', (0, 45, 0.01), DENSITY_TERMS)
+    return FuzzyInferenceSystem([ovc, sp2, splow, slope], density, COMB_RULES)
+
+
 def addxmloutput(projPath, in_network, out_network):
     """add the capacity output to the project xml file"""
 
@@ -400,4 +697,5 @@ if __name__ == '__main__':
         sys.argv[1],
         sys.argv[2],
         sys.argv[3],
-        sys.argv[4])	
\ No newline at end of file
+        sys.argv[4],
+        sys.argv[5] if len(sys.argv) > 5 else None)	
\ No newline at end of file
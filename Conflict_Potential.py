@@ -11,6 +11,7 @@
 
 import arcpy
 import numpy as np
+import csv
 import os
 import sys
 import projectxml
@@ -62,130 +63,15 @@ def find_oPC_Score(out_name, in_network, CrossingLow, CrossingHigh, AdjLow, AdjH
     if "oPC_Score" in fields:
         arcpy.DeleteField_management(out_network, "oPC_Score")
 
-    # create segid array for joining output
-    segid_np = arcpy.da.FeatureClassToNumPyArray(out_network, "ReachID")
-    segid_array = np.asarray(segid_np, np.int64)
-
-    # road crossing conflict
-    if "iPC_RoadX" in fields:
-        roadx_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_RoadX")
-        roadx = np.asarray(roadx_array, np.float64)
-        roadx_pc = np.empty_like(roadx)
-        m = slopeInt(CrossingLow, CrossingHigh)[0]
-        b = slopeInt(CrossingLow, CrossingHigh)[1]
-        for i in range(len(roadx)):
-            if roadx[i] >= 0 and roadx[i] <= CrossingLow:
-                roadx_pc[i] = 0.99
-            elif roadx[i] > CrossingLow and roadx[i] <= CrossingHigh:
-                roadx_pc[i] = m * roadx[i] + b
-            elif roadx[i] > CrossingHigh:
-                roadx_pc[i] = 0.01
-            else:
-                roadx_pc[i] = 0.01
-
-        del roadx_array, roadx, m, b
-    else:
-        roadx_pc = np.zeros_like(segid_array)
-
-    # road adjacent conflict
-    if "iPC_RoadAd" in fields:
-        roadad_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_RoadAd")
-        roadad = np.asarray(roadad_array, np.float64)
-        #roadad_pc = np.zeros_like(roadad)
-        roadad_pc = np.empty_like(roadad)
-        m = slopeInt(AdjLow, AdjHigh)[0]
-        b = slopeInt(AdjLow, AdjHigh)[1]
-        for i in range(len(roadad)):
-            if roadad[i] >= 0 and roadad[i] <= AdjLow:
-                roadad_pc[i] = 0.99
-            elif roadad[i] > AdjLow and roadad[i] <= AdjHigh:
-                roadad_pc[i] = m * roadad[i] + b
-            elif roadad[i] > AdjHigh:
-                roadad_pc[i] = 0.01
-            else:
-                roadad_pc[i] = 0.01
-
-        del roadad_array, roadad, m, b
-    else:
-        roadad_pc = np.zeros_like(segid_array)
-
-    # canal conflict
-    if "iPC_Canal" in fields:
-        canal_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_Canal")
-        canal = np.asarray(canal_array, np.float64)
-        #canal_pc = np.zeros_like(canal)
-        canal_pc = np.empty_like(canal)
-        m = slopeInt(CanalLow, CanalHigh)[0]
-        b = slopeInt(CanalLow, CanalHigh)[1]
-        for i in range(len(canal)):
-            if canal[i] >= 0 and canal[i] <= CanalLow:
-                canal_pc[i] = 0.99
-            elif canal[i] > CanalLow and canal[i] <= CanalHigh:
-                canal_pc[i] = m * canal[i] + b
-            elif canal[i] > CanalHigh:
-                canal_pc[i] = 0.01
-            else:
-                canal_pc[i] = 0.01
-
-        del canal_array, canal, m, b
-    else:
-        canal_pc = np.zeros_like(segid_array)
-
-    # railroad conflict
-    if "iPC_RR" in fields:
-        rr_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_RR")
-        rr = np.asarray(rr_array, np.float64)
-        #rr_pc = np.zeros_like(rr)
-        rr_pc = np.empty_like(rr)
-        m = slopeInt(RRLow, RRHigh)[0]
-        b = slopeInt(RRLow, RRHigh)[1]
-        for i in range(len(rr)):
-            if rr[i] >= 0 and rr[i] <= RRLow:
-                rr_pc[i] = 0.99
-            elif rr[i] > RRLow and rr[i] <= RRHigh:
-                rr_pc[i] = m * rr[i] + b
-            elif rr[i] > RRHigh:
-                rr_pc[i] = 0.01
-            else:
-                rr_pc[i] = 0.01
-
-        del rr_array, rr, m, b
-    else:
-        rr_pc = np.zeros_like(segid_array)
-
-    # landuse conflict
-    if "iPC_LU" in fields:
-        lu_array = arcpy.da.FeatureClassToNumPyArray(out_network, "iPC_LU")
-        lu = np.asarray(lu_array, np.float64)
-        lu_pc = np.empty_like(lu)
-
-        # for i in range(len(lu)):
-        #     if lu[i] >= 2:
-        #         lu_pc[i] = 0.75
-        #     elif lu[i] >= 1.25 and lu[i] < 2:
-        #         lu_pc[i] = 0.5
-        #     elif lu[i] < 1.25:
-        #         lu_pc[i] = 0.01
-        #     else:
-        #         lu_pc[i] = 0.01
-
-        for i in range(len(lu)):
-            if lu[i] >= 1.0:
-                lu_pc[i] = 0.99
-            elif lu[i] >= 0.66 and lu[i] < 1.0:
-                lu_pc[i] = 0.75
-            elif lu[i] >= 0.33 and lu[i] < 0.66:
-                lu_pc[i] = 0.5
-            elif lu[i] > 0 and lu[i] < 0.33:
-                lu_pc[i] = 0.25
-            else:
-                lu_pc[i] = 0.01
-    else:
-        lu_pc = np.zeros_like(segid_array)
+    # read the reach ids and every conflict input in one pass
+    components = conflictComponents(CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh)
+    present = [component for component in components if component.field in fields]
+    inputs = arcpy.da.FeatureClassToNumPyArray(out_network, ["ReachID"] + [component.field for component in present])
+    segid_array = np.asarray(inputs["ReachID"], np.int64)
 
     # get max of all individual conflict potential scores
     # this is our conflict potential output
-    oPC_Score = np.fmax(roadx_pc, np.fmax(roadad_pc, np.fmax(canal_pc, np.fmax(rr_pc, lu_pc))))
+    oPC_Score = scoreConflict(inputs, present)
 
     # save the output text file
     columns = np.column_stack((segid_array, oPC_Score))
@@ -220,12 +106,157 @@ def find_oPC_Score(out_name, in_network, CrossingLow, CrossingHigh, AdjLow, AdjH
     return out_network
 
 
+NO_CONFLICT = 0.01
+THRESHOLD_FIELDS = ["CrossingLow", "CrossingHigh", "AdjLow", "AdjHigh", "CanalLow", "CanalHigh", "RRLow", "RRHigh"]
+CONFLICT_CLASS_BREAKS = [0.25, 0.5, 0.75]
+CONFLICT_CLASSES = ["Low", "Moderate", "Considerable", "High"]
+
+
+class ConflictComponent(object):
+    """
+    One source of conflict potential, scored from a single iPC field as a function of its value
+    """
+    def __init__(self, field, breakpoints, linear=True, min_value=0.0, include_min=True):
+        """
+        :param field: The iPC field the score is calculated from
+        :param breakpoints: List of (value, score) pairs, in increasing order of value. Linear components score
+        values at or below the first value with its score, interpolate between breakpoints, and score values above the
+        last value with its score. Step components score each value with the score of the largest breakpoint at or
+        below it
+        :param linear: True to interpolate between breakpoints, False to step
+        :param min_value: Values below this, or missing values, score NO_CONFLICT
+        :param include_min: False to also score values equal to min_value as NO_CONFLICT
+        """
+        self.field = field
+        self.values = np.array([value for value, score in breakpoints], np.float64)
+        self.scores = np.array([score for value, score in breakpoints], np.float64)
+        self.linear = linear
+        self.min_value = min_value
+        self.include_min = include_min
+
+        # slope and intercept of each segment between breakpoints
+        self.slopes = np.zeros(max(len(breakpoints) - 1, 0))
+        self.intercepts = np.zeros(max(len(breakpoints) - 1, 0))
+        for i in range(len(breakpoints) - 1):
+            self.slopes[i], self.intercepts[i] = slopeInt(breakpoints[i][0], breakpoints[i + 1][0],
+                                                          breakpoints[i][1], breakpoints[i + 1][1])
+
+    def score(self, values):
+        """
+        Scores an array of iPC values
+        :param values: The values of self.field for every reach
+        :return: An array of conflict potential scores
+        """
+        values = np.asarray(values, np.float64)
+        if self.linear:
+            segment = np.searchsorted(self.values, values, side='left')
+            inner = np.clip(segment - 1, 0, max(len(self.slopes) - 1, 0))
+            if len(self.slopes) > 0:
+                out = self.slopes[inner] * values + self.intercepts[inner]
+            else:
+                out = np.empty_like(values)
+            out[segment == 0] = self.scores[0]
+            out[segment == len(self.values)] = self.scores[-1]
+        else:
+            step = np.searchsorted(self.values, values, side='right')
+            out = np.where(step > 0, self.scores[np.maximum(step - 1, 0)], NO_CONFLICT)
+
+        with np.errstate(invalid='ignore'):
+            valid = values >= self.min_value if self.include_min else values > self.min_value
+        out[~valid] = NO_CONFLICT
+        return out
+
+
+def conflictComponents(CrossingLow, CrossingHigh, AdjLow, AdjHigh, CanalLow, CanalHigh, RRLow, RRHigh):
+    """
+    Declares the conflict potential components. Distance based components score 0.99 up to the low threshold,
+    fall linearly to 0.01 at the high threshold, and score 0.01 beyond it
+    :return: A list of ConflictComponents
+    """
+    return [
+        ConflictComponent("iPC_RoadX", [(CrossingLow, 0.99), (CrossingHigh, 0.01)]),  # road crossing conflict
+        ConflictComponent("iPC_RoadAd", [(AdjLow, 0.99), (AdjHigh, 0.01)]),  # road adjacent conflict
+        ConflictComponent("iPC_Canal", [(CanalLow, 0.99), (CanalHigh, 0.01)]),  # canal conflict
+        ConflictComponent("iPC_RR", [(RRLow, 0.99), (RRHigh, 0.01)]),  # railroad conflict
+        # landuse conflict
+        ConflictComponent("iPC_LU", [(0.0, 0.25), (0.33, 0.5), (0.66, 0.75), (1.0, 0.99)], linear=False,
+                          include_min=False)
+    ]
+
+
+def scoreConflict(inputs, components):
+    """
+    Scores every component and takes the max of the scores for each reach
+    :param inputs: Structured array with a field for each component
+    :param components: The ConflictComponents to score
+    :return: The oPC_Score array, which is 0 where there are no components
+    """
+    oPC_Score = np.zeros(len(inputs))
+    for component in components:
+        oPC_Score = np.fmax(component.score(inputs[component.field]), oPC_Score)
+    return oPC_Score
+
+
+def readScenarios(scenario_table):
+    """
+    Reads a table of threshold sets
+    :param scenario_table: A csv file with a Name column and a column for each of THRESHOLD_FIELDS
+    :return: A list of (name, thresholds) tuples, with the thresholds in the order of THRESHOLD_FIELDS
+    """
+    scenarios = []
+    with open(scenario_table, 'rb') as csv_file:
+        for row in csv.DictReader(csv_file):
+            scenarios.append((row['Name'], [float(row[field]) for field in THRESHOLD_FIELDS]))
+    return scenarios
+
+
+def sweep(in_network, scenario_table, out_table, summary_table=None):
+    """
+    Calculates oPC_Score for several sets of thresholds in one pass, without copying the network
+    :param in_network: The network, with the iPC_* fields
+    :param scenario_table: The csv of threshold sets, read by readScenarios()
+    :param out_table: The text table to write, with a ReachID column and an oPC_Score column per scenario
+    :param summary_table: If given, the text table to write with the number of reaches in each conflict class
+    for each scenario
+    :return: The (reaches, scenarios) array of oPC_Score
+    """
+    scenarios = readScenarios(scenario_table)
+    if len(scenarios) == 0:
+        raise Exception("No threshold sets found in " + scenario_table)
+
+    # read every conflict input once for all of the scenarios
+    fields = [f.name for f in arcpy.ListFields(in_network)]
+    scenario_components = [[component for component in conflictComponents(*thresholds) if component.field in fields]
+                           for name, thresholds in scenarios]
+    inputs = arcpy.da.FeatureClassToNumPyArray(in_network, ["ReachID"] +
+                                               [component.field for component in scenario_components[0]])
+    segid_array = np.asarray(inputs["ReachID"], np.int64)
+
+    columns = [scoreConflict(inputs, components) for components in scenario_components]
+
+    matrix = np.column_stack(columns)
+    header = ", ".join(["ReachID"] + [name for name, thresholds in scenarios])
+    np.savetxt(out_table, np.column_stack((segid_array, matrix)), delimiter = ",", header = header, comments = "")
+    arcpy.AddMessage("Wrote " + str(matrix.shape[1]) + " scenario columns for " + str(matrix.shape[0]) +
+                     " reaches to " + out_table)
+
+    if summary_table:
+        counts = [np.bincount(np.digitize(column, CONFLICT_CLASS_BREAKS, right=True),
+                              minlength=len(CONFLICT_CLASSES)) for column in columns]
+        with open(summary_table, 'w') as summary_file:
+            summary_file.write(", ".join(["Scenario"] + THRESHOLD_FIELDS + CONFLICT_CLASSES) + "\n")
+            for (name, thresholds), count in zip(scenarios, counts):
+                summary_file.write(", ".join([name] + ["%g" % value for value in thresholds] +
+                                             [str(value) for value in count]) + "\n")
+
+    return matrix
+
 # function to calculate slope-intercept equation based on user inputs
-def slopeInt(lowValue, highValue):
+def slopeInt(lowValue, highValue, lowScore=0.99, highScore=0.01):
     x1 = lowValue
-    y1 = 0.99
+    y1 = lowScore
     x2 = highValue
-    y2 = 0.01
+    y2 = highScore
     m = (y2 - y1)/(x2 - x1) # calculate slope
     b = y1 - (m * x1) # calculate y-intercept
     return [m, b]
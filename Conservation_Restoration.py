@@ -14,88 +14,83 @@ import sys
 import os
 import projectxml
 import uuid
-
-
-def main(projPath, in_network, out_name):
+from Decision_Table import DecisionTable, classifyNetwork
+
+
+UNSUITABLE_NATURAL = "Unsuitable: Naturally Limited"
+UNSUITABLE_ANTHRO = "Unsuitable: Anthropogenically Limited"
+QUICK_RETURN = "Quick Return Restoration Zone"
+LONG_TERM = "Long Term Possibility Restoration Zone"
+LOW_HANGING_FRUIT = "Low Hanging Fruit - Potential Restoration/Conservation Zone"
+LOW_SOURCE = "Living with Beaver (Low Source)"
+HIGH_SOURCE = "Living with Beaver (High Source)"
+NOT_PREDICTED = "NOT PREDICTED - Requires Manual Attention"
+
+LowConflict = 0.25
+IntConflict = 0.5
+HighConflict = 0.75
+
+# land use ("iPC_ModLU" + "iPC_HighLU")
+LU = ("iPC_ModLU", "iPC_HighLU")
+
+# rules are applied in order, and each reach takes the class of the first rule it meets
+OPBRC_TABLE = DecisionTable(
+    [UNSUITABLE_NATURAL, UNSUITABLE_ANTHRO, QUICK_RETURN, LONG_TERM, LOW_HANGING_FRUIT, LOW_SOURCE, HIGH_SOURCE,
+     NOT_PREDICTED],
+    [
+        # none or rare existing capacity
+        ([("oCC_EX", "<=", 1.0), ("oCC_PT", "<=", 1.0)], UNSUITABLE_NATURAL),
+        ([("oCC_EX", "<=", 1.0), ("oPC_Score", ">", HighConflict)], UNSUITABLE_ANTHRO),
+        ([("oCC_EX", "<=", 1.0), ("oCC_PT", "<=", 5.0)], QUICK_RETURN),
+        ([("oCC_EX", "<=", 1.0), ("oPC_Score", ">", LowConflict)], LONG_TERM),
+        ([("oCC_EX", "<=", 1.0), (LU, ">", 0.5)], LONG_TERM),
+        ([("oCC_EX", "<=", 1.0)], QUICK_RETURN),
+
+        # occasional existing capacity
+        ([("oCC_EX", "<=", 5.0), ("oPC_Score", ">", HighConflict)], UNSUITABLE_ANTHRO),
+        ([("oCC_EX", "<=", 5.0), ("oCC_PT", ">", 5.0)], LOW_HANGING_FRUIT),
+        ([("oCC_EX", "<=", 5.0), ("oPC_Score", "<=", LowConflict)], QUICK_RETURN),
+        ([("oCC_EX", "<=", 5.0), (LU, ">", 0.5)], LONG_TERM),
+        ([("oCC_EX", "<=", 5.0)], LOW_SOURCE),
+
+        # frequent existing capacity
+        ([("oCC_EX", "<=", 15.0), ("oPC_Score", ">", HighConflict)], UNSUITABLE_ANTHRO),
+        ([("oCC_EX", "<=", 15.0), ("oCC_PT", ">", 15.0), ("oPC_Score", "<=", LowConflict)], LOW_HANGING_FRUIT),
+        ([("oCC_EX", "<=", 15.0), ("oCC_PT", ">", 15.0)], HIGH_SOURCE),
+        ([("oCC_EX", "<=", 15.0), ("oPC_Score", "<=", LowConflict)], LOW_HANGING_FRUIT),
+        ([("oCC_EX", "<=", 15.0), (LU, ">", 0.5)], LONG_TERM),
+        ([("oCC_EX", "<=", 15.0)], QUICK_RETURN),
+
+        # pervasive existing capacity
+        ([("oCC_EX", ">", 15.0), ("oPC_Score", "<=", LowConflict)], LOW_HANGING_FRUIT),
+        ([("oCC_EX", ">", 15.0), ("oPC_Score", ">", HighConflict)], UNSUITABLE_ANTHRO),
+        ([("oCC_EX", ">", 15.0), (LU, ">", 0.5)], HIGH_SOURCE),
+        ([("oCC_EX", ">", 15.0)], QUICK_RETURN)
+    ],
+    NOT_PREDICTED)
+
+
+def main(projPath, in_network, out_name, write_labels=True):
+    """
+    Adds the conservation and restoration class of each reach to a copy of the network, as the oPBRC_Code class
+    code and, if asked for, the oPBRC text label
+    :param projPath: The project folder
+    :param in_network: The conflict potential output network
+    :param out_name: The name of the output network
+    :param write_labels: Whether to write the oPBRC text labels, which the management zone layer is symbolized by
+    :return: The output network
+    """
 
     arcpy.env.overwriteOutput = True
 
     out_network = os.path.dirname(in_network) + "/" + out_name + ".shp"
     arcpy.CopyFeatures_management(in_network, out_network)
 
-    # check for oPBRC field and delete if exists
-    fields = [f.name for f in arcpy.ListFields(out_network)]
-    if "oPBRC" in fields:
-        arcpy.DeleteField_management(out_network, "oPBRC")
-
-    LowConflict = 0.25
-    IntConflict = 0.5
-    HighConflict = 0.75
-
-    arcpy.AddField_management(out_network, "oPBRC", "TEXT", "", "", 60)
-
-    with arcpy.da.UpdateCursor(out_network, ["oCC_EX", "oCC_PT", "oPC_Score", "iPC_ModLU", "iPC_HighLU", "oPBRC"]) as cursor:
-        for row in cursor:
-
-            if row[0] <= 1.0:  # none or rare existing capacity
-                if row[1] <= 1.0:
-                    row[5] = "Unsuitable: Naturally Limited"
-                elif row[2] > 0.75:
-                    row[5] = "Unsuitable: Anthropogenically Limited"
-                elif row[1] <= 5.0:
-                    row[5] = "Quick Return Restoration Zone"
-                elif row[2] > 0.25:
-                    row[5] = "Long Term Possibility Restoration Zone"
-                elif row[3] + row[4] > 0.5:
-                    row[5] = "Long Term Possibility Restoration Zone"
-                else:
-                    row[5] = "Quick Return Restoration Zone"
-
-            elif row[0] <= 5.0:  # occasional existing capacity
-                if row[2] > 0.75:
-                    row[5] = "Unsuitable: Anthropogenically Limited"
-                elif row[1] > 5.0:
-                    row[5] = "Low Hanging Fruit - Potential Restoration/Conservation Zone"
-                elif row[2] <= 0.25:
-                    row[5] = "Quick Return Restoration Zone"
-                elif row[3] + row[4] > 0.5:
-                    row[5] = "Long Term Possibility Restoration Zone"
-                else:
-                    row[5] = "Living with Beaver (Low Source)"
-
-            elif row[0] <= 15.0:  # frequent existing capacity
-                if row[2] > 0.75:
-                    row[5] = "Unsuitable: Anthropogenically Limited"
-                elif row[1] > 15.0:
-                    if row[2] <= 0.25:
-                        row[5] = "Low Hanging Fruit - Potential Restoration/Conservation Zone"
-                    else:
-                        row[5] = "Living with Beaver (High Source)"
-                elif row[2] <= 0.25:
-                    row[5] = "Low Hanging Fruit - Potential Restoration/Conservation Zone"
-                elif row[3] + row[4] > 0.5:
-                    row[5] = "Long Term Possibility Restoration Zone"
-                else:
-                    row[5] = "Quick Return Restoration Zone"
-
-            elif row[0] > 15.0:  # pervasive existing capacity
-                if row[2] <= 0.25:
-                    row[5] = "Low Hanging Fruit - Potential Restoration/Conservation Zone"
-                elif row[2] > 0.75:
-                    row[5] = "Unsuitable: Anthropogenically Limited"
-                elif row[3] + row[4] > 0.5:
-                    row[5] = "Living with Beaver (High Source)"
-                else:
-                    row[5] = "Quick Return Restoration Zone"
-
-            else:
-                row[5] = "NOT PREDICTED - Requires Manual Attention"
-
-            cursor.updateRow(row)
+    classifyNetwork(out_network, OPBRC_TABLE, "oPBRC_Code", "oPBRC" if write_labels else None, 60)
 
     addxmloutput(projPath, in_network, out_network)
 
-    makeLayers(out_network)
+    makeLayers(out_network, write_labels)
 
     return out_network
 
@@ -127,12 +122,19 @@ def addxmloutput(projPath, in_network, out_network):
 
 
 
-def makeLayers(out_network):
+def makeLayers(out_network, write_labels=True):
     """
     Writes the layers
     :param out_network: The output network, which we want to make into a layer
+    :param write_labels: Whether the oPBRC text labels were written. The management zone symbology is by oPBRC,
+    so without them no layer is made
     :return:
     """
+    if not write_labels:
+        arcpy.AddWarning("The management zone layer is symbolized by oPBRC, which is only written with labels, so " +
+                         "no layer was made. Each reach's class is in oPBRC_Code, with labels in " +
+                         os.path.splitext(out_network)[0] + "_oPBRC_Code.csv")
+        return
     arcpy.AddMessage("Making layers...")
     output_folder = os.path.dirname(out_network)
 
@@ -14,83 +14,80 @@ import sys
 import os
 import projectxml
 import uuid
-
-
-def main(projPath, in_network, out_name):
+from Decision_Table import DecisionTable, classifyNetwork
+
+
+HYDRO_LIMITED = "Naturally Unsuitable: Hydrologically Limited"
+VEG_LIMITED = "Naturally Unsuitable: Vegetation Limited"
+ANTHRO_LIMITED = "Unsuitable: Anthropogenically Limited"
+HIGH_IMPACT = "Immediate Returns: High Impact/Activity"
+MODERATE_IMPACT = "Immediate Returns: Moderate Impact/Activity"
+HIGH_POTENTIAL = "Long-Term: High Potential, Short-Term: Moderate Impact"
+MODERATE_POTENTIAL = "Long-Term: Moderate Potential, Short-Term: Unsuitable"
+LOW_DEVELOPED = "Need Categorical Definition: Low Developed"
+
+# 'iPC_LowLU' + 'iPC_ModLU' (i.e., Agriculture)
+AGRICULTURE = ("iPC_LowLU", "iPC_ModLU")
+
+# 'iPC_HighLU' (i.e., Developed) < 10 and 'iPC_VLowLU'(i.e., Natural) > 75
+NATURAL = [("iPC_VLowLU", ">", 75), ("iPC_HighLU", "<", 10)]
+
+# rules are applied in order, and each reach takes the class of the first rule it meets
+OPBRC_TABLE = DecisionTable(
+    [HYDRO_LIMITED, VEG_LIMITED, ANTHRO_LIMITED, HIGH_IMPACT, MODERATE_IMPACT, HIGH_POTENTIAL, MODERATE_POTENTIAL,
+     LOW_DEVELOPED],
+    [
+        # 'oVC_PT' Occasional, Frequent or Pervasive
+        # 'oCC_PT' None or Rare
+        ([("oVC_PT", ">", 1), ("oCC_PT", "<=", 1)], HYDRO_LIMITED),
+        # 'OVC_PT' None or Rare
+        ([("oVC_PT", "<=", 1)], VEG_LIMITED),
+        # 'iPC_HighLU' (i.e., Developed) > 40 or Agriculture > 40, whatever the capacity
+        # todo: ask SS and WM if this is really what we want to assign in instances where high landuse but frequent exisitng
+        ([(AGRICULTURE, ">", 40)], ANTHRO_LIMITED),
+        ([("iPC_HighLU", ">", 40)], ANTHRO_LIMITED),
+        # 'oCC_PT' Frequent or Pervasive
+        # 'oCC_EX' Frequent or Pervasive
+        (NATURAL + [("oCC_PT", ">=", 5), ("oCC_EX", ">=", 5)], HIGH_IMPACT),
+        # 'oCC_PT' Occasional
+        # 'oCC_EX' Occasional
+        (NATURAL + [("oCC_PT", ">", 1), ("oCC_PT", "<", 5), ("oCC_EX", ">", 1), ("oCC_EX", "<", 5)], MODERATE_IMPACT),
+        # 'oCC_PT' Frequent or Pervasive
+        # 'oCC_EX' None, Rare, or Occasional
+        (NATURAL + [("oCC_PT", ">=", 5), ("oCC_EX", "<", 5)], HIGH_POTENTIAL),
+        # 'oCC_PT' Occasional
+        # 'oCC_EX' None or Rare
+        (NATURAL + [("oCC_PT", ">", 1), ("oCC_PT", "<", 5), ("oCC_EX", "<=", 1)], MODERATE_POTENTIAL),
+        # 'oCC_PT' Occasional
+        # 'oCC_EX' Frequent or Pervasive
+        (NATURAL + [("oCC_PT", ">", 1), ("oCC_PT", "<", 5), ("oCC_EX", ">=", 5)], HIGH_IMPACT),
+        (NATURAL, LOW_DEVELOPED)
+    ],
+    # todo: this is more or less a 'best option' placeholder and should re-visit and create additional category
+    MODERATE_POTENTIAL)
+
+
+def main(projPath, in_network, out_name, write_labels=True):
+    """
+    Adds the conservation and restoration class of each reach to a copy of the network, as the oPBRC_Code class
+    code and, if asked for, the oPBRC text label
+    :param projPath: The project folder
+    :param in_network: The combined capacity output network
+    :param out_name: The name of the output network
+    :param write_labels: Whether to write the oPBRC text labels, which the management zone layer is symbolized by
+    :return: The output network
+    """
 
     arcpy.env.overwriteOutput = True
 
     out_network = os.path.dirname(in_network) + "/" + out_name + ".shp"
     arcpy.CopyFeatures_management(in_network, out_network)
 
-    # check for oPBRC field and delete if exists
-    fields = [f.name for f in arcpy.ListFields(out_network)]
-    if "oPBRC" in fields:
-        arcpy.DeleteField_management(out_network, "oPBRC")
-
-    arcpy.AddField_management(out_network, "oPBRC", "TEXT", "", "", 100)
-
-    fields = ['oPBRC', 'oVC_PT', 'oVC_EX', 'oCC_PT', 'oCC_EX', 'iPC_LowLU', 'iPC_ModLU', 'iPC_HighLU', 'iPC_VLowLU']
-
-    with arcpy.da.UpdateCursor(out_network, fields) as cursor:
-        for row in cursor:
-            # 'oVC_PT' Occasional, Frequent or Pervasive
-            # 'oCC_PT' None or Rare
-            if row[1] > 1 and row[3] <= 1:
-                row[0] = 'Naturally Unsuitable: Hydrologically Limited'
-            # 'OVC_PT' None or Rare
-            elif row[1] <= 1:
-                row[0] = 'Naturally Unsuitable: Vegetation Limited'
-            # 'iPC_HighLU' (i.e., Developed) > 50 or  'iPC_LowLU' + 'iPC_ModLU' (i.e., Agriculture) > 50
-            elif row[5] + row[6] > 40 or row[7] > 40:
-                # 'oCC_PT' Frequent or Pervasive
-                # 'oCC_EX' None, Rare or Occasional
-                if row[3] >= 5 and row[4] < 5:
-                    row[0] = 'Unsuitable: Anthropogenically Limited'
-                # todo: ask SS and WM if this is really what we want to assign in instances where high landuse but frequent exisitng
-                # 'oCC_PT' Pervasive
-                # 'oCC_EX' Frequent
-                elif row[3] >= 15 and row[4] >= 5 and row[4] < 15:
-                    row[0] = 'Unsuitable: Anthropogenically Limited'
-                # 'oCC_PT' Occasional
-                # 'oCC_EX' None or Rare
-                elif row[3] >= 1 and row[4] <= 1:
-                    row[0] = 'Unsuitable: Anthropogenically Limited'
-                else:
-                    row[0] = 'Unsuitable: Anthropogenically Limited'
-                    # row[0] = 'Need Categorical Definition: Highly Developed'
-            # 'iPC_HighLU' (i.e., Developed) < 10 and 'iPC_VLowLU'(i.e., Natural) > 75
-            elif row[8] > 75 and row[7] < 10:
-                # 'oCC_PT' Frequent or Pervasive
-                # 'oCC_EX' Frequent or Pervasive
-                if row[3] >= 5 and row[4] >= 5:
-                    row[0] = 'Immediate Returns: High Impact/Activity'
-                # 'oCC_PT' Occasional
-                # 'oCC_EX' Occasional
-                elif row[3] > 1 and row[3] < 5 and row[4] > 1 and row[4] < 5:
-                    row[0] = 'Immediate Returns: Moderate Impact/Activity'
-                # 'oCC_PT' Frequent or Pervasive
-                # 'oCC_EX' None, Rare, or Occasional
-                elif row[3] >= 5 and row[4] < 5:
-                    row[0] = 'Long-Term: High Potential, Short-Term: Moderate Impact'
-                # 'oCC_PT' Occasional
-                # 'oCC_EX' None or Rare
-                elif row[3] > 1 and row[3] < 5 and row[4] <= 1:
-                    row[0] = 'Long-Term: Moderate Potential, Short-Term: Unsuitable'
-                # 'oCC_PT' Occasional
-                # 'oCC_EX' Frequent or Pervasive
-                elif row[3] > 1 and row[3] < 5 and row[4] >= 5:
-                    row[0] = 'Immediate Returns: High Impact/Activity'
-                else:
-                    row[0] = 'Need Categorical Definition: Low Developed'
-            else:
-                # todo: this is more or less a 'best option' placeholder and should re-visit and create additional category
-                row[0] = 'Long-Term: Moderate Potential, Short-Term: Unsuitable'
-            cursor.updateRow(row)
+    classifyNetwork(out_network, OPBRC_TABLE, "oPBRC_Code", "oPBRC" if write_labels else None, 100)
 
     addxmloutput(projPath, in_network, out_network)
 
-    makeLayers(out_network)
+    makeLayers(out_network, write_labels)
 
     return out_network
 
@@ -122,12 +119,19 @@ def addxmloutput(projPath, in_network, out_network):
 
 
 
-def makeLayers(out_network):
+def makeLayers(out_network, write_labels=True):
     """
     Writes the layers
     :param out_network: The output network, which we want to make into a layer
+    :param write_labels: Whether the oPBRC text labels were written. The management zone symbology is by oPBRC,
+    so without them no layer is made
     :return:
     """
+    if not write_labels:
+        arcpy.AddWarning("The management zone layer is symbolized by oPBRC, which is only written with labels, so " +
+                         "no layer was made. Each reach's class is in oPBRC_Code, with labels in " +
+                         os.path.splitext(out_network)[0] + "_oPBRC_Code.csv")
+        return
     arcpy.AddMessage("Making layers...")
     output_folder = os.path.dirname(out_network)
 
@@ -0,0 +1,148 @@
+# -------------------------------------------------------------------------------
+# Name:        Decision Table
+# Purpose:     Classifies every reach at once from a declarative table of rules, for the conservation and
+#              restoration models
+#
+# Created:     10/2026
+# Licence:     <your licence>
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+import csv
+import os
+
+OPERATORS = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal
+}
+
+
+class DecisionTable(object):
+    """
+    An ordered list of rules, each assigning a class to the reaches that meet all of its conditions. As with an
+    if/elif chain, each reach takes the class of the first rule it meets, or the default class if it meets none
+    """
+    def __init__(self, labels, rules, default):
+        """
+        :param labels: The text label of each class. A class's code is its position in this list
+        :param rules: List of (conditions, label) tuples. Each condition is a (fields, operator, value) tuple,
+        where fields is a field name or a tuple of field names to sum, and operator is one of OPERATORS
+        :param default: The label for reaches that meet no rule
+        """
+        self.labels = list(labels)
+        for conditions, label in rules:
+            if label not in self.labels:
+                raise Exception("Decision table rule has unknown class '" + label + "'")
+            for fields, operator, value in conditions:
+                if operator not in OPERATORS:
+                    raise Exception("Decision table rule has unknown operator '" + operator + "'")
+        if default not in self.labels:
+            raise Exception("Decision table has unknown default class '" + default + "'")
+        self.rules = [([(fieldTuple(fields), operator, value) for fields, operator, value in conditions],
+                       self.labels.index(label)) for conditions, label in rules]
+        self.default = self.labels.index(default)
+
+    def fields(self):
+        """
+        :return: The fields that the rules read, in a fixed order
+        """
+        fields = []
+        for conditions, code in self.rules:
+            for condition_fields, operator, value in conditions:
+                fields.extend(field for field in condition_fields if field not in fields)
+        return fields
+
+    def classify(self, values):
+        """
+        Classifies every reach
+        :param values: A structured array, or dictionary of arrays, with each of self.fields()
+        :return: An array of class codes
+        """
+        size = len(values[self.fields()[0]])
+        codes = np.full(size, self.default, np.int16)
+        unassigned = np.ones(size, bool)
+        sums = {}
+        for conditions, code in self.rules:
+            meets = unassigned.copy()
+            for fields, operator, value in conditions:
+                if fields not in sums:
+                    sums[fields] = np.sum([np.asarray(values[field], np.float64) for field in fields], axis=0)
+                with np.errstate(invalid='ignore'):
+                    meets &= OPERATORS[operator](sums[fields], value)
+            codes[meets] = code
+            unassigned &= ~meets
+        return codes
+
+    def label(self, codes):
+        """
+        :param codes: An array of class codes
+        :return: An array of the text label of each code
+        """
+        return np.asarray(self.labels, object)[codes]
+
+    def domain(self):
+        """
+        :return: A dictionary of class code to text label
+        """
+        return dict(enumerate(self.labels))
+
+
+def fieldTuple(fields):
+    """
+    :param fields: A field name or tuple of field names
+    :return: A tuple of field names
+    """
+    if isinstance(fields, tuple):
+        return fields
+    return (fields,)
+
+
+def classifyNetwork(network, table, code_field, label_field=None, label_length=100):
+    """
+    Classifies the network with one read of the input fields and one write of the output fields, and writes the
+    lookup table from class code to label next to the network
+    :param network: The network to classify, which is modified in place
+    :param table: The DecisionTable
+    :param code_field: The short integer field to write the class codes to
+    :param label_field: If given, the text field to write the class labels to
+    :param label_length: The length of the label field
+    :return: The array of class codes
+    """
+    inputs = arcpy.da.FeatureClassToNumPyArray(network, ["ReachID"] + table.fields())
+    codes = table.classify(inputs)
+
+    fields = [f.name for f in arcpy.ListFields(network)]
+    out_fields = [code_field] + ([label_field] if label_field else [])
+    for field in out_fields:
+        if field in fields:
+            arcpy.DeleteField_management(network, field)
+    arcpy.AddField_management(network, code_field, "SHORT")
+    if label_field:
+        arcpy.AddField_management(network, label_field, "TEXT", "", "", label_length)
+
+    out_rows = dict(zip(inputs["ReachID"].tolist(), codes.tolist()))
+    with arcpy.da.UpdateCursor(network, ["ReachID"] + out_fields) as cursor:
+        for row in cursor:
+            code = out_rows.get(row[0])
+            if code is None:
+                continue
+            row[1] = code
+            if label_field:
+                row[2] = table.labels[code]
+            cursor.updateRow(row)
+
+    lookup_table = os.path.splitext(network)[0] + "_" + code_field + ".csv"
+    with open(lookup_table, 'wb') as lookup_file:
+        writer = csv.writer(lookup_file)
+        writer.writerow([code_field, "Label"])
+        for code, label in sorted(table.domain().items()):
+            writer.writerow([code, label])
+
+    counts = np.bincount(codes, minlength=len(table.labels))
+    for code, label in enumerate(table.labels):
+        arcpy.AddMessage(str(code) + " " + label + ": " + str(counts[code]) + " reaches")
+
+    return codes
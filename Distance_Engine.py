@@ -0,0 +1,186 @@
+# -------------------------------------------------------------------------------
+# Name:        Distance Engine
+# Purpose:     Calculates exact distances from points to the nearest of a set of line segments or points, so that
+#              distance to roads, railroads and canals needs no Euclidean distance rasters
+#
+# Created:     10/2026
+# Licence:     <your licence>
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+from Zonal_Engine import segment_distance
+
+# most points measured against all candidate segments at once; bounds the memory used
+CHUNK_SIZE = 2000000
+
+
+class SegmentIndex(object):
+    def __init__(self, segments, cell_size=None):
+        """
+        A grid index of line segments. Each segment is indexed in every grid cell its bounding box covers
+        :param segments: (n, 4) array of segment start and end coordinates. Points are segments that start and end
+        at the same place
+        :param cell_size: The width of the grid cells. By default, the larger of the typical segment size and the
+        size that puts a few segments in each cell
+        """
+        self.segments = np.asarray(segments, np.float64).reshape(-1, 4)
+        if len(self.segments) == 0:
+            raise Exception("A segment index needs at least one segment")
+        x_min = np.minimum(self.segments[:, 0], self.segments[:, 2])
+        x_max = np.maximum(self.segments[:, 0], self.segments[:, 2])
+        y_min = np.minimum(self.segments[:, 1], self.segments[:, 3])
+        y_max = np.maximum(self.segments[:, 1], self.segments[:, 3])
+        if cell_size is None:
+            area = max((x_max.max() - x_min.min()) * (y_max.max() - y_min.min()), 1.0)
+            cell_size = max(np.median(np.maximum(x_max - x_min, y_max - y_min)), np.sqrt(4 * area / len(self.segments)))
+        self.cell_size = float(max(cell_size, 1e-9))
+        self.origin_x = x_min.min()
+        self.origin_y = y_min.min()
+        self.columns = int((x_max.max() - self.origin_x) // self.cell_size) + 1
+        self.rows = int((y_max.max() - self.origin_y) // self.cell_size) + 1
+
+        col0 = ((x_min - self.origin_x) // self.cell_size).astype(np.int64)
+        col1 = ((x_max - self.origin_x) // self.cell_size).astype(np.int64)
+        row0 = ((y_min - self.origin_y) // self.cell_size).astype(np.int64)
+        row1 = ((y_max - self.origin_y) // self.cell_size).astype(np.int64)
+        widths = col1 - col0 + 1
+        cell_counts = widths * (row1 - row0 + 1)
+        segment_index = np.repeat(np.arange(len(self.segments)), cell_counts)
+        offset = np.arange(cell_counts.sum()) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+        cell_keys = ((row0[segment_index] + offset // widths[segment_index]) * self.columns +
+                     col0[segment_index] + offset % widths[segment_index])
+        order = np.argsort(cell_keys, kind='mergesort')
+        self.cell_keys = cell_keys[order]
+        self.segment_index = segment_index[order]
+
+    def cell_of(self, x, y):
+        """
+        :return: The grid row and column of a point, which may be outside the grid
+        """
+        return int((y - self.origin_y) // self.cell_size), int((x - self.origin_x) // self.cell_size)
+
+    def block(self, row, col, reach, ring_only=False):
+        """
+        Finds the segments indexed in the cells within reach cells of a cell
+        :param row: The row of the centre cell
+        :param col: The column of the centre cell
+        :param reach: How many cells out from the centre cell to look
+        :param ring_only: If true, only the cells exactly reach cells out are looked in
+        :return: An array of segment indices, which may repeat
+        """
+        rows = np.arange(max(row - reach, 0), min(row + reach, self.rows - 1) + 1)
+        cols = np.arange(max(col - reach, 0), min(col + reach, self.columns - 1) + 1)
+        if len(rows) == 0 or len(cols) == 0:
+            return np.zeros(0, np.int64)
+        block_rows, block_cols = np.meshgrid(rows, cols, indexing='ij')
+        if ring_only:
+            ring = np.maximum(np.abs(block_rows - row), np.abs(block_cols - col)) == reach
+            block_rows, block_cols = block_rows[ring], block_cols[ring]
+        keys = (block_rows * self.columns + block_cols).ravel()
+        first = np.searchsorted(self.cell_keys, keys, side='left')
+        counts = np.searchsorted(self.cell_keys, keys, side='right') - first
+        return self.segment_index[np.repeat(first, counts) + np.arange(counts.sum()) -
+                                  np.repeat(np.cumsum(counts) - counts, counts)]
+
+    def nearest(self, x, y):
+        """
+        The distance from a point to the nearest segment, searching out from the point's cell one ring of cells at
+        a time. Segments outside the rings searched are at least as far away as the rings reach
+        :return: The distance
+        """
+        row, col = self.cell_of(x, y)
+        # the first ring that holds any cells of the grid
+        reach = max(-row, row - self.rows + 1, -col, col - self.columns + 1, 0)
+        # the distance from the point to the outside of the centre cell
+        inside = min(x - self.origin_x - col * self.cell_size, (col + 1) * self.cell_size - x + self.origin_x,
+                     y - self.origin_y - row * self.cell_size, (row + 1) * self.cell_size - y + self.origin_y)
+        best = np.inf
+        while True:
+            candidates = self.block(row, col, reach, ring_only=reach > 0)
+            if len(candidates) > 0:
+                best = min(best, segment_distance(x, y, self.segments[candidates]).min())
+            if best <= inside + reach * self.cell_size:
+                return best
+            reach += 1
+
+    def within(self, x, y, distance):
+        """
+        :return: The indices of the segments within the distance of a point
+        """
+        row, col = self.cell_of(x, y)
+        candidates = np.unique(self.block(row, col, int(distance // self.cell_size) + 1))
+        if len(candidates) == 0:
+            return candidates
+        return candidates[segment_distance(x, y, self.segments[candidates]) <= distance]
+
+    def distances(self, points):
+        """
+        The distance from each of a cluster of points to the nearest segment. Every point is within the cluster's
+        radius of its centre, so only the segments within the centre's nearest distance plus twice the radius can
+        be nearest to any point
+        :param points: (n, 2) array of point coordinates
+        :return: An array of distances
+        """
+        centre = 0.5 * (points.min(axis=0) + points.max(axis=0))
+        radius = np.hypot(*(points.max(axis=0) - centre))
+        candidates = self.segments[self.within(centre[0], centre[1],
+                                               self.nearest(centre[0], centre[1]) + 2 * radius)]
+        distances = np.empty(len(points))
+        step = max(CHUNK_SIZE // len(candidates), 1)
+        for start in range(0, len(points), step):
+            chunk = points[start:start + step]
+            distances[start:start + step] = segment_distance(chunk[:, 0][:, None], chunk[:, 1][:, None],
+                                                             candidates[None, :, :]).min(axis=1)
+        return distances
+
+
+def read_segments(features, spatial_reference=None):
+    """
+    Reads the segments of line features, or the points of point features as segments with no length
+    :param features: A line or point feature class
+    :param spatial_reference: The spatial reference to read the features in
+    :return: (n, 4) array of segment start and end coordinates
+    """
+    segments = []
+    with arcpy.da.SearchCursor(features, ['SHAPE@'], spatial_reference=spatial_reference) as cursor:
+        for row in cursor:
+            if row[0] is None:
+                continue
+            if row[0].type in ('point', 'multipoint'):
+                for point in ([row[0].firstPoint] if row[0].type == 'point' else row[0]):
+                    segments.append((point.X, point.Y, point.X, point.Y))
+                continue
+            for part in row[0]:
+                vertices = [(point.X, point.Y) for point in part if point is not None]
+                for start, end in zip(vertices[:-1], vertices[1:]):
+                    segments.append(start + end)
+    return np.array(segments, np.float64).reshape(-1, 4)
+
+
+def zone_distances(segment_index, cell_index, grid, stat_type):
+    """
+    The minimum or mean distance from the centres of the cells in each zone of a cell index to the nearest segment
+    :param segment_index: The SegmentIndex of the features to measure to
+    :param cell_index: A Zonal_Engine.CellIndex
+    :param grid: The RasterGrid the cell index was built on
+    :param stat_type: 'MINIMUM' or 'MEAN'
+    :return: An array of the stat of each zone, which is nan where a zone has no cells
+    """
+    if stat_type not in ('MINIMUM', 'MEAN'):
+        raise Exception("Unknown distance statistic " + stat_type)
+    values = np.full(len(cell_index.reach_ids), np.nan)
+    order = np.argsort(cell_index.zones, kind='mergesort')
+    zones = cell_index.zones[order]
+    zone_starts = np.flatnonzero(np.diff(np.append(-1, zones)))
+    for start, end in zip(zone_starts, np.append(zone_starts[1:], len(zones))):
+        runs = order[start:end]
+        lengths = cell_index.col_ends[runs] - cell_index.col_starts[runs]
+        rows = np.repeat(cell_index.rows[runs], lengths)
+        cols = np.repeat(cell_index.col_starts[runs], lengths) + np.arange(lengths.sum()) - \
+            np.repeat(np.cumsum(lengths) - lengths, lengths)
+        points = np.column_stack((grid.x_min + (cols + 0.5) * grid.cell_width,
+                                  grid.y_max - (rows + 0.5) * grid.cell_height))
+        distances = segment_index.distances(points)
+        values[zones[start]] = distances.min() if stat_type == 'MINIMUM' else distances.mean()
+    return values
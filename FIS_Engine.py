@@ -0,0 +1,527 @@
+# -------------------------------------------------------------------------------
+# Name:        FIS Engine
+# Purpose:     Evaluates the BRAT fuzzy inference systems for every reach at once
+#              using numpy arrays, instead of one skfuzzy simulation per reach
+#
+# Created:     10/2026
+# -------------------------------------------------------------------------------
+
+import numpy as np
+import os
+import json
+import hashlib
+
+# number of reaches evaluated at once; bounds the (reaches x candidate points) working arrays
+CHUNK_SIZE = 10000
+
+# largest absolute difference in dam density (dams/km) allowed between this engine and skfuzzy.
+# skfuzzy samples the membership functions on the output universe before taking the centroid, while
+# this engine integrates the aggregated output exactly, so the two differ slightly
+SKFUZZY_TOLERANCE = 0.005
+
+# upper bounds (dams/km) of the rare, occasional and frequent capacity categories, as in Summary_Report.CATEGORY_BREAKS
+CAPACITY_CATEGORY_BREAKS = [1.0, 5.0, 15.0]
+
+
+def trapmf(x, abcd):
+    """
+    Trapezoidal membership function, evaluated for every value in x
+    :param x: Array of crisp values
+    :param abcd: The four breakpoints of the trapezoid, with a <= b <= c <= d
+    :return: Array of membership grades with the same shape as x
+    """
+    a, b, c, d = [float(value) for value in abcd]
+    x = np.asarray(x, np.float64)
+    y = np.ones(x.shape)
+    if b > a:
+        y = np.minimum(y, (x - a) / (b - a))
+    else:
+        y[x < a] = 0.0
+    if d > c:
+        y = np.minimum(y, (d - x) / (d - c))
+    else:
+        y[x > d] = 0.0
+    return np.clip(y, 0.0, 1.0)
+
+
+def trimf(x, abc):
+    """
+    Triangular membership function, evaluated for every value in x
+    :param x: Array of crisp values
+    :param abc: The three breakpoints of the triangle, with a <= b <= c
+    :return: Array of membership grades with the same shape as x
+    """
+    a, b, c = abc
+    return trapmf(x, [a, b, b, c])
+
+
+MEMBERSHIP_FUNCTIONS = {'trimf': trimf, 'trapmf': trapmf}
+
+
+def trapezoid(mf, params):
+    """
+    Gives the breakpoints of a membership function as a trapezoid
+    :param mf: The name of the membership function
+    :param params: The breakpoints of the membership function
+    :return: The [a, b, c, d] breakpoints of the equivalent trapezoid
+    """
+    if mf == 'trimf':
+        return [float(params[0]), float(params[1]), float(params[1]), float(params[2])]
+    return [float(value) for value in params]
+
+
+class FuzzyVariable(object):
+    def __init__(self, name, universe, terms):
+        """
+        Holds the universe and membership functions of one antecedent or consequent
+        :param name: The name of the variable
+        :param universe: The (start, stop, step) of the universe, as it would be given to np.arange
+        :param terms: A list of (label, membership function name, breakpoints) tuples
+        """
+        self.name = name
+        self.universe = tuple(universe)
+        self.terms = [(label, mf, list(params)) for label, mf, params in terms]
+        self.labels = [term[0] for term in self.terms]
+
+        # skfuzzy clips crisp values to the sampled universe, which stops one step short of 'stop'
+        samples = np.arange(*self.universe)
+        self.lower = samples[0]
+        self.upper = samples[-1]
+
+    def clip(self, values):
+        """
+        Clips crisp values to the range of the universe
+        :param values: Array of crisp values
+        :return: Array of clipped values
+        """
+        return np.clip(np.asarray(values, np.float64), self.lower, self.upper)
+
+    def membership(self, values):
+        """
+        Finds the membership grade of every value in every term
+        :param values: Array of crisp values
+        :return: Dictionary of term label to array of membership grades
+        """
+        values = self.clip(values)
+        grades = {}
+        for label, mf, params in self.terms:
+            grades[label] = MEMBERSHIP_FUNCTIONS[mf](values, params)
+        return grades
+
+    def signature(self):
+        """
+        Describes the universe and membership functions of the variable, but not its name
+        :return: A string that is the same for any two variables with the same definition
+        """
+        return json.dumps([list(self.universe), self.terms], sort_keys=True)
+
+
+class FuzzyInferenceSystem(object):
+    def __init__(self, inputs, output, rules):
+        """
+        A Mamdani fuzzy inference system (min for 'and', max aggregation, centroid defuzzification)
+        :param inputs: A list of FuzzyVariable antecedents, in the order their values will be given
+        :param output: The FuzzyVariable consequent
+        :param rules: A list of rules. Each rule is a tuple holding one antecedent label per input, followed
+        by the consequent label. An antecedent label is None if the rule ignores that input, and starts
+        with '~' if the rule uses the complement of that term
+        """
+        self.inputs = list(inputs)
+        self.output = output
+        self.rules = [tuple(rule) for rule in rules]
+
+        for rule in self.rules:
+            if len(rule) != len(self.inputs) + 1:
+                raise Exception("Rule " + str(rule) + " does not have one label per input plus a consequent")
+            for variable, label in zip(self.inputs, rule[:-1]):
+                if label is not None and label.lstrip('~') not in variable.labels:
+                    raise Exception("'" + label + "' is not a term of " + variable.name)
+            if rule[-1] not in self.output.labels:
+                raise Exception("'" + rule[-1] + "' is not a term of " + self.output.name)
+
+        # every consequent term is a trapezoid, so clipping and aggregating them gives a piecewise linear
+        # shape. Its slope can only change at the term breakpoints, where two term edges cross, or where
+        # a term edge crosses the clip level of a term. The first two don't depend on the rule activations
+        self._trapezoids = np.array([trapezoid(mf, params) for label, mf, params in self.output.terms])
+        edge_slopes = []
+        edge_intercepts = []
+        for a, b, c, d in self._trapezoids:
+            if b > a:
+                edge_slopes.append(1.0 / (b - a))
+                edge_intercepts.append(-a / (b - a))
+            if d > c:
+                edge_slopes.append(-1.0 / (d - c))
+                edge_intercepts.append(d / (d - c))
+        self._edge_slopes = np.array(edge_slopes)
+        self._edge_intercepts = np.array(edge_intercepts)
+
+        fixed_points = list(self._trapezoids.ravel()) + [self.output.lower, self.output.upper]
+        for i in range(len(edge_slopes)):
+            for j in range(i + 1, len(edge_slopes)):
+                if edge_slopes[i] != edge_slopes[j]:
+                    fixed_points.append((edge_intercepts[j] - edge_intercepts[i]) / (edge_slopes[i] - edge_slopes[j]))
+        self._fixed_points = np.unique(np.clip(fixed_points, self.output.lower, self.output.upper))
+
+    def memberships(self, values):
+        """
+        Finds the membership grades of each input
+        :param values: A list with one array of crisp values per input
+        :return: A list with one dictionary of term label to membership grades per input
+        """
+        if len(values) != len(self.inputs):
+            raise Exception("Expected " + str(len(self.inputs)) + " input arrays, got " + str(len(values)))
+        return [variable.membership(value) for variable, value in zip(self.inputs, values)]
+
+    def activations(self, grades):
+        """
+        Fires every rule and aggregates the rule strengths onto the consequent terms
+        :param grades: The membership grades of each input, as returned by memberships()
+        :return: A (reaches, consequent terms) array holding the activation of each consequent term
+        """
+        count = len(grades[0][self.inputs[0].labels[0]])
+        activations = np.zeros((count, len(self.output.labels)))
+        for rule in self.rules:
+            strength = np.ones(count)
+            for input_grades, label in zip(grades, rule[:-1]):
+                if label is None:
+                    continue
+                if label.startswith('~'):
+                    np.fmin(strength, 1.0 - input_grades[label[1:]], strength)
+                else:
+                    np.fmin(strength, input_grades[label], strength)
+            column = self.output.labels.index(rule[-1])
+            np.fmax(activations[:, column], strength, activations[:, column])
+        return activations
+
+    def aggregate(self, activations, x):
+        """
+        Clips each consequent term at its activation and aggregates the clipped terms with max
+        :param activations: A (reaches, consequent terms) array, as returned by activations()
+        :param x: A (reaches, points) array of output values to evaluate the aggregated shape at
+        :return: A (reaches, points) array of aggregated membership
+        """
+        out = np.zeros(x.shape)
+        for i in range(len(self.output.labels)):
+            np.fmax(out, np.fmin(activations[:, i:i + 1], trapmf(x, self._trapezoids[i])), out)
+        return out
+
+    def defuzzify(self, activations):
+        """
+        Takes the centroid of the aggregated output shape over the output universe. The shape is linear
+        between consecutive candidate points, so its area and first moment are found exactly from its value
+        at two points inside each interval (which also copes with vertical term edges). Reaches where no
+        rule fires are given a value of 0
+        :param activations: A (reaches, consequent terms) array, as returned by activations()
+        :return: Array of crisp output values
+        """
+        count = activations.shape[0]
+        levels = activations[:, np.newaxis, :]
+        crossings = (levels - self._edge_intercepts[:, np.newaxis]) / self._edge_slopes[:, np.newaxis]
+        points = np.hstack((np.tile(self._fixed_points, (count, 1)),
+                            np.clip(crossings.reshape(count, -1), self.output.lower, self.output.upper)))
+        points.sort(axis=1)
+
+        width = np.diff(points, axis=1)
+        middle = points[:, :-1] + width / 2.0
+        first = self.aggregate(activations, middle - width / 4.0)
+        second = self.aggregate(activations, middle + width / 4.0)
+
+        area = np.sum(width * (first + second) / 2.0, axis=1)
+        moment = np.sum(width * middle * (first + second) / 2.0 + (second - first) * width ** 2 / 6.0, axis=1)
+
+        out = np.zeros(count)
+        fired = area > 0
+        out[fired] = moment[fired] / area[fired]
+        return out
+
+    def infer(self, values):
+        """
+        Runs the fuzzy inference system for every reach, CHUNK_SIZE reaches at a time
+        :param values: A list with one array of crisp values per input, all the same length
+        :return: The array of defuzzified outputs, and the (reaches, consequent terms) array of activations
+        """
+        count = len(values[0])
+        out = np.zeros(count)
+        activations = np.zeros((count, len(self.output.labels)))
+        for start in range(0, count, CHUNK_SIZE):
+            chunk = [np.asarray(value)[start:start + CHUNK_SIZE] for value in values]
+            activations[start:start + CHUNK_SIZE] = self.activations(self.memberships(chunk))
+            out[start:start + CHUNK_SIZE] = self.defuzzify(activations[start:start + CHUNK_SIZE])
+        return out, activations
+
+    def infer_unique(self, values, decimals=None):
+        """
+        Runs the fuzzy inference system once for each distinct set of inputs, and copies the results back to every
+        reach sharing those inputs
+        :param values: A list with one array of crisp values per input, all the same length
+        :param decimals: If given, inputs are rounded to this many decimal places first, so more reaches share inputs
+        :return: The array of defuzzified outputs, the (reaches, consequent terms) array of activations, and the
+        number of distinct sets of inputs that were run
+        """
+        unique_values, inverse = unique_rows(values, decimals)
+        out, activations = self.infer(unique_values)
+        return out[inverse], activations[inverse], len(unique_values[0])
+
+    def evaluate(self, *values):
+        """
+        Runs the fuzzy inference system for every reach
+        :param values: One array of crisp values per input, all the same length
+        :return: Array of defuzzified outputs
+        """
+        return self.infer(values)[0]
+
+    def fires_only(self, activations, label):
+        """
+        Finds the reaches whose output falls fully in one consequent term
+        :param activations: A (reaches, consequent terms) array, as returned by activations()
+        :param label: The consequent term
+        :return: Boolean array, True where that term is the only one activated
+        """
+        column = self.output.labels.index(label)
+        others = np.delete(activations, column, axis=1)
+        return (activations[:, column] > 0) & np.all(others == 0, axis=1)
+
+    def forcing_terms(self, label):
+        """
+        Finds the input terms that decide the output on their own. When an input falls fully in one of these
+        terms, a rule on that term alone fires fully, and every other rule that can still fire has the same
+        consequent
+        :param label: The consequent term
+        :return: A list of (input index, input term) tuples
+        """
+        forcing = []
+        for index, variable in enumerate(self.inputs):
+            for term in variable.labels:
+                able = [rule for rule in self.rules if rule[index] is None or rule[index] == term or
+                        (rule[index].startswith('~') and rule[index] != '~' + term)]
+                alone = [rule for rule in able if rule[index] == term and
+                         all(other is None for i, other in enumerate(rule[:-1]) if i != index)]
+                if alone and all(rule[-1] == label for rule in able):
+                    forcing.append((index, term))
+        return forcing
+
+    def forces_only(self, values, label):
+        """
+        Finds the reaches whose output is known to fall fully in one consequent term, from their inputs alone.
+        Every reach found here would also be found by fires_only() after running the rules
+        :param values: A list with one array of crisp values per input, all the same length
+        :param label: The consequent term
+        :return: Boolean array, True where an input falls fully in one of the forcing_terms()
+        """
+        forced = np.zeros(len(values[0]), bool)
+        for index, term in self.forcing_terms(label):
+            grades = self.inputs[index].membership(values[index])
+            full = grades[term] == 1
+            for other in self.inputs[index].labels:
+                if other != term:
+                    full &= grades[other] == 0
+            forced |= full
+        return forced
+
+    def signature(self):
+        """
+        Hashes the universes, membership function breakpoints and rule table of the system
+        :return: A hex string that changes whenever the definition of the system changes
+        """
+        definition = {
+            'inputs': [[variable.name, list(variable.universe), variable.terms] for variable in self.inputs],
+            'output': [self.output.name, list(self.output.universe), self.output.terms],
+            'rules': [list(rule) for rule in self.rules]}
+        return hashlib.sha1(json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ResponseSurface(object):
+    def __init__(self, axes, values, max_error, category_changes):
+        """
+        The output of a two input fuzzy inference system, tabulated on a regular grid
+        :param axes: The grid coordinates along each input
+        :param values: The (len(axes[0]), len(axes[1])) array of outputs at each grid node
+        :param max_error: The largest difference between the interpolated and directly evaluated output
+        :param category_changes: How many of the points checked changed capacity category when interpolated
+        """
+        self.axes = [np.asarray(axis, np.float64) for axis in axes]
+        self.values = np.asarray(values, np.float64)
+        self.max_error = float(max_error)
+        self.category_changes = int(category_changes)
+
+    @classmethod
+    def build(cls, fis, step):
+        """
+        Evaluates a two input fuzzy inference system on a grid, then checks the interpolation error at the
+        centre of every grid cell, which is where bilinear interpolation is furthest from the grid nodes
+        :param fis: The FuzzyInferenceSystem to tabulate
+        :param step: The approximate spacing of the grid along each input
+        :return: A ResponseSurface
+        """
+        if len(fis.inputs) != 2:
+            raise Exception("Response surfaces can only be built for fuzzy inference systems with two inputs")
+        if not step > 0:
+            raise Exception("The response surface grid spacing must be greater than 0, not " + str(step))
+
+        axes = []
+        for variable in fis.inputs:
+            count = max(int(round((variable.upper - variable.lower) / float(step))), 1) + 1
+            axes.append(np.linspace(variable.lower, variable.upper, count))
+        grid_x, grid_y = np.meshgrid(axes[0], axes[1], indexing='ij')
+        values = fis.evaluate(grid_x.ravel(), grid_y.ravel()).reshape(grid_x.shape)
+        surface = cls(axes, values, 0.0, 0)
+
+        centre_x, centre_y = np.meshgrid((axes[0][:-1] + axes[0][1:]) / 2.0, (axes[1][:-1] + axes[1][1:]) / 2.0,
+                                         indexing='ij')
+        direct = fis.evaluate(centre_x.ravel(), centre_y.ravel())
+        interpolated = surface.interpolate(centre_x.ravel(), centre_y.ravel())
+        surface.max_error = np.max(np.abs(direct - interpolated))
+        surface.category_changes = np.count_nonzero(np.digitize(direct, CAPACITY_CATEGORY_BREAKS, right=True) !=
+                                                    np.digitize(interpolated, CAPACITY_CATEGORY_BREAKS, right=True))
+        return surface
+
+    @classmethod
+    def load_or_build(cls, fis, step, cache_folder):
+        """
+        Reads the response surface for this system and grid spacing from the cache folder, building and
+        saving it first if it isn't there
+        :param fis: The FuzzyInferenceSystem to tabulate
+        :param step: The approximate spacing of the grid along each input
+        :param cache_folder: The folder that holds saved response surfaces
+        :return: A ResponseSurface
+        """
+        key = hashlib.sha1((fis.signature() + repr(float(step))).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_folder, "surface_" + key + ".npz")
+        if os.path.exists(cache_file):
+            saved = np.load(cache_file)
+            return cls([saved['axis0'], saved['axis1']], saved['values'], saved['max_error'],
+                       saved['category_changes'])
+
+        surface = cls.build(fis, step)
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        np.savez(cache_file, axis0=surface.axes[0], axis1=surface.axes[1], values=surface.values,
+                 max_error=surface.max_error, category_changes=surface.category_changes)
+        return surface
+
+    def interpolate(self, *values):
+        """
+        Bilinearly interpolates the output for every reach
+        :param values: One array of crisp values per input, all the same length
+        :return: Array of interpolated outputs
+        """
+        indices = []
+        weights = []
+        for axis, value in zip(self.axes, values):
+            value = np.clip(np.asarray(value, np.float64), axis[0], axis[-1])
+            position = (value - axis[0]) / (axis[1] - axis[0])
+            index = np.clip(np.floor(position).astype(np.int64), 0, len(axis) - 2)
+            indices.append(index)
+            weights.append(position - index)
+
+        i, j = indices
+        wx, wy = weights
+        return (self.values[i, j] * (1 - wx) * (1 - wy) + self.values[i + 1, j] * wx * (1 - wy) +
+                self.values[i, j + 1] * (1 - wx) * wy + self.values[i + 1, j + 1] * wx * wy)
+
+
+def unique_rows(values, decimals=None):
+    """
+    Finds the distinct sets of values across several arrays
+    :param values: A list of arrays, all the same length
+    :param decimals: If given, values are rounded to this many decimal places first
+    :return: A list with one array per input holding the distinct sets of values, and the array of indices that
+    rebuilds the original arrays from them
+    """
+    stack = np.column_stack([np.asarray(value, np.float64) for value in values])
+    if decimals is not None:
+        stack = np.round(stack, int(decimals))
+    # adding 0.0 turns -0.0 into 0.0, so equal values also have equal bytes
+    stack = np.ascontiguousarray(stack + 0.0)
+
+    # view each row as a single opaque item, so np.unique compares whole rows
+    rows = stack.view(np.dtype((np.void, stack.dtype.itemsize * stack.shape[1]))).ravel()
+    index, inverse = np.unique(rows, return_index=True, return_inverse=True)[1:]
+    unique = stack[index]
+    return [unique[:, i] for i in range(stack.shape[1])], inverse.ravel()
+
+
+def infer_shared(systems, values):
+    """
+    Runs several fuzzy inference systems over the same reaches and inputs, CHUNK_SIZE reaches at a time.
+    Systems with the same definition are only run once, and the membership grades of each input are only
+    found once for every distinct definition of that input
+    :param systems: A list of FuzzyInferenceSystems, all taking the same inputs
+    :param values: A list with one array of crisp values per input, all the same length
+    :return: A list with the (outputs, activations) of each system, as returned by infer()
+    """
+    count = len(values[0])
+    distinct = {}
+    for fis in systems:
+        if fis.signature() not in distinct:
+            distinct[fis.signature()] = (fis, np.zeros(count), np.zeros((count, len(fis.output.labels))))
+
+    for start in range(0, count, CHUNK_SIZE):
+        chunk = [np.asarray(value)[start:start + CHUNK_SIZE] for value in values]
+        shared_grades = {}
+        for fis, out, activations in distinct.values():
+            grades = []
+            for index, variable in enumerate(fis.inputs):
+                key = (index, variable.signature())
+                if key not in shared_grades:
+                    shared_grades[key] = variable.membership(chunk[index])
+                grades.append(shared_grades[key])
+            activations[start:start + CHUNK_SIZE] = fis.activations(grades)
+            out[start:start + CHUNK_SIZE] = fis.defuzzify(activations[start:start + CHUNK_SIZE])
+
+    return [distinct[fis.signature()][1:] for fis in systems]
+
+
+def build_skfuzzy_system(fis):
+    """
+    Builds the skfuzzy control system equivalent to a FuzzyInferenceSystem. Only used to check the engine
+    :param fis: The FuzzyInferenceSystem to copy
+    :return: A skfuzzy ControlSystemSimulation
+    """
+    import skfuzzy as fuzz
+    from skfuzzy import control as ctrl
+
+    def add_terms(ctrl_variable, variable):
+        for label, mf, params in variable.terms:
+            ctrl_variable[label] = getattr(fuzz, mf)(ctrl_variable.universe, params)
+        return ctrl_variable
+
+    antecedents = [add_terms(ctrl.Antecedent(np.arange(*variable.universe), variable.name), variable)
+                   for variable in fis.inputs]
+    consequent = add_terms(ctrl.Consequent(np.arange(*fis.output.universe), fis.output.name), fis.output)
+
+    rules = []
+    for rule in fis.rules:
+        antecedent = None
+        for ctrl_variable, label in zip(antecedents, rule[:-1]):
+            if label is None:
+                continue
+            term = ~ctrl_variable[label[1:]] if label.startswith('~') else ctrl_variable[label]
+            antecedent = term if antecedent is None else antecedent & term
+        rules.append(ctrl.Rule(antecedent, consequent[rule[-1]]))
+
+    return ctrl.ControlSystemSimulation(ctrl.ControlSystem(rules))
+
+
+def compare_with_skfuzzy(fis, values, sample_size=200):
+    """
+    Runs a sample of reaches through both this engine and skfuzzy
+    :param fis: The FuzzyInferenceSystem to check
+    :param values: One array of crisp values per input
+    :param sample_size: How many reaches to compare
+    :return: The largest absolute difference between the two outputs
+    """
+    count = len(values[0])
+    sample = np.random.RandomState(0).choice(count, min(sample_size, count), replace=False)
+    sampled_values = [np.asarray(value, np.float64)[sample] for value in values]
+    engine_out = fis.evaluate(*sampled_values)
+
+    simulation = build_skfuzzy_system(fis)
+    skfuzzy_out = np.zeros(len(sample))
+    for i in range(len(sample)):
+        for variable, value in zip(fis.inputs, sampled_values):
+            simulation.input[variable.name] = value[i]
+        simulation.compute()
+        skfuzzy_out[i] = simulation.output[fis.output.name]
+
+    return np.max(np.abs(engine_out - skfuzzy_out))
@@ -8,7 +8,16 @@
 # -------------------------------------------------------------------------------
 
 import os
+import csv
 import arcpy
+import numpy as np
+
+SNAP_DISTANCE = 30.0  # meters
+
+# capacity categories, by their upper bounds in dams/km
+CATEGORY_BREAKS = [0, 1, 5, 15, 40]
+CATEGORIES = ["None", "Rare", "Occasional", "Frequent", "Pervasive", "UNDEFINED"]
+
 
 def main(bratOutput, dams, outputName):
     """
@@ -30,60 +39,189 @@ def main(bratOutput, dams, outputName):
     otherFields = ['Ex_Categor', 'Pt_Categor', 'mCC_EX_Ct', 'mCC_PT_Ct', 'mCC_EXtoPT']
     newFields = damFields + otherFields
 
-    inputFields = ['SHAPE@LENGTH', 'oCC_EX', 'oCC_PT']
+    inputFields = ['ReachID', 'SHAPE@LENGTH', 'oCC_EX', 'oCC_PT']
 
+    arcpy.CopyFeatures_management(bratOutput, outNetwork)
     if dams:
         arcpy.AddMessage("Adding fields that need dam input...")
-        setDamAttributes(bratOutput, outNetwork, dams, damFields + ['Join_Count'] + inputFields, newFields)
+        addFields(outNetwork, newFields)
+        setDamAttributes(outNetwork, dams, damFields)
     else:
-        arcpy.CopyFeatures_management(bratOutput, outNetwork)
         addFields(outNetwork, otherFields)
 
     arcpy.AddMessage("Adding fields that don't need dam input...")
-    setOtherAttributes(outNetwork, otherFields + inputFields)
-
-    if dams:
-        cleanUpFields(bratOutput, outNetwork, newFields)
+    setOtherAttributes(outNetwork, otherFields, inputFields + (['e_DamCt'] if dams else []))
 
 
-def setDamAttributes(bratOutput, outputPath, dams, reqFields, newFields):
+def setDamAttributes(outputPath, dams, damFields):
     """
-    Sets all the dam info and updates the output file with that data
-    :param bratOutput: The polyline we're basing our stuff off of
+    Sets all the dam info and updates the output file with that data. The dams are not modified
     :param outputPath: The polyline shapefile with BRAT output
     :param dams: The points shapefile of observed dams
     :param damFields: The fields we want to update for dam attributes
     :return:
     """
-    arcpy.Snap_edit(dams, [[bratOutput, 'EDGE', '30 Meters']])
-    arcpy.SpatialJoin_analysis(bratOutput,
-                               dams,
-                               outputPath,
-                               join_operation='JOIN_ONE_TO_ONE',
-                               join_type='KEEP_ALL',
-                               match_option='INTERSECT')
-    addFields(outputPath, newFields)
+    reachIDs, damCount, damDensity, damPercentCapacity = calcDamAttributes(outputPath, dams)
+    damValues = dict(zip(reachIDs.tolist(), zip(damCount.tolist(), damDensity.tolist(),
+                                                damPercentCapacity.tolist())))
+
+    with arcpy.da.UpdateCursor(outputPath, ['ReachID'] + damFields) as cursor:
+        for row in cursor:
+            values = damValues.get(row[0])
+            if values is not None:
+                cursor.updateRow([row[0]] + list(values))
+
+
+def calcDamAttributes(network, dams, snapDistance=SNAP_DISTANCE):
+    """
+    Assigns each dam to the nearest reach within the snap distance, and calculates the dam attributes of each reach
+    :param network: The polyline shapefile with BRAT output
+    :param dams: The points shapefile of observed dams
+    :param snapDistance: How far a dam can be from a reach and still be counted on it, in meters
+    :return: Arrays of ReachID, dam count (e_DamCt), dams per kilometer (e_DamDens), and dam count as a proportion
+    of potential capacity (e_DamPcC)
+    """
+    spatialRef = arcpy.Describe(network).spatialReference
+    tolerance = snapDistance / spatialRef.metersPerUnit
 
-    with arcpy.da.UpdateCursor(outputPath, reqFields) as cursor:
+    reachIDs = []
+    lengths = []
+    oCC_PT = []
+    segments = []
+    with arcpy.da.SearchCursor(network, ['ReachID', 'SHAPE@', 'SHAPE@LENGTH', 'oCC_PT']) as cursor:
         for row in cursor:
-            damNum = row[-4]        # fourth to last attribute
-            segLength = row[-3]   # third to last attribute
-            if segLength is None:
-                segLength = 0
-            oCC_EX = row[-2]        # second to last attribute
-            oCC_PT = row[-1]        # last attribute
+            reachIndex = len(reachIDs)
+            reachIDs.append(row[0])
+            lengths.append(row[2] if row[2] is not None else 0)
+            oCC_PT.append(row[3] if row[3] is not None else 0)
+            if row[1] is None:
+                continue
+            for part in row[1]:
+                points = [(point.X, point.Y) for point in part if point]
+                for start, end in zip(points[:-1], points[1:]):
+                    segments.append((start[0], start[1], end[0], end[1], reachIndex))
+
+    # read the dams in the network's spatial reference, without snapping them
+    with arcpy.da.SearchCursor(dams, ['SHAPE@XY'], spatial_reference=spatialRef) as cursor:
+        damPoints = np.array([row[0] for row in cursor if row[0][0] is not None], np.float64).reshape(-1, 2)
+
+    damCount, damDensity, damPercentCapacity = countDams(damPoints, np.array(segments, np.float64).reshape(-1, 5),
+                                                        np.array(lengths, np.float64),
+                                                        np.array(oCC_PT, np.float64), tolerance)
+    arcpy.AddMessage(str(int(damCount.sum())) + " of " + str(len(damPoints)) + " dams are within " +
+                     str(snapDistance) + " meters of a reach")
+
+    return np.array(reachIDs), damCount, damDensity, damPercentCapacity
 
-            row[0] = damNum
-            row[1] = damNum / segLength * 1000
-            try:
-                row[2] = damNum / oCC_PT
-            except ZeroDivisionError:
-                row[2] = 0
 
-            cursor.updateRow(row)
+def countDams(damPoints, segments, lengths, oCC_PT, tolerance):
+    """
+    Counts the dams on each reach, giving each dam to the reach of its nearest segment within the tolerance
+    :param damPoints: (n, 2) array of dam coordinates
+    :param segments: (m, 5) array of segment start and end coordinates, and the index of the segment's reach
+    :param lengths: The length of each reach, in meters
+    :param oCC_PT: The potential capacity of each reach
+    :param tolerance: The greatest distance a dam can be from its reach
+    :return: Arrays of dam count (e_DamCt), dams per kilometer (e_DamDens), and dam count as a proportion of
+    potential capacity (e_DamPcC) for each reach
+    """
+    nearestSegment = findNearestSegments(damPoints, segments[:, :4], tolerance)
+    snapped = nearestSegment >= 0
+    damCount = np.bincount(segments[nearestSegment[snapped], 4].astype(np.int64),
+                           minlength=len(lengths)).astype(np.float64)
+
+    damDensity = np.zeros_like(damCount)
+    np.divide(damCount * 1000, lengths, out=damDensity, where=lengths != 0)
+    damPercentCapacity = np.zeros_like(damCount)
+    np.divide(damCount, oCC_PT, out=damPercentCapacity, where=oCC_PT != 0)
+    return damCount, damDensity, damPercentCapacity
 
-    arcpy.DeleteField_management(outputPath, ["Join_Count", "TARGET_FID"])
 
+def findNearestSegments(points, segments, tolerance):
+    """
+    Finds the nearest line segment to each point, out of those within the tolerance. The segments are indexed by
+    the grid cells their bounding boxes (grown by the tolerance) cover, so each point is only measured against the
+    segments indexed in its own cell
+    :param points: (n, 2) array of point coordinates
+    :param segments: (m, 4) array of segment start and end coordinates
+    :param tolerance: The greatest distance a point can be from its segment
+    :return: The index of each point's nearest segment, or -1 where no segment is within the tolerance
+    """
+    nearest = np.full(len(points), -1, np.int64)
+    if len(points) == 0 or len(segments) == 0:
+        return nearest
+
+    xMin = np.minimum(segments[:, 0], segments[:, 2]) - tolerance
+    xMax = np.maximum(segments[:, 0], segments[:, 2]) + tolerance
+    yMin = np.minimum(segments[:, 1], segments[:, 3]) - tolerance
+    yMax = np.maximum(segments[:, 1], segments[:, 3]) + tolerance
+
+    # grid cells are a few tolerances wide, so most segments only fall in a few of them
+    cellSize = max(4 * tolerance, np.median(np.maximum(xMax - xMin, yMax - yMin)))
+    originX = xMin.min()
+    originY = yMin.min()
+    columns = int((xMax.max() - originX) // cellSize) + 1
+    rows = int((yMax.max() - originY) // cellSize) + 1
+
+    col0 = ((xMin - originX) // cellSize).astype(np.int64)
+    col1 = ((xMax - originX) // cellSize).astype(np.int64)
+    row0 = ((yMin - originY) // cellSize).astype(np.int64)
+    row1 = ((yMax - originY) // cellSize).astype(np.int64)
+    widths = col1 - col0 + 1
+    cellCounts = widths * (row1 - row0 + 1)
+
+    # one (cell, segment) entry for every cell a segment covers
+    segmentIndex = np.repeat(np.arange(len(segments)), cellCounts)
+    offset = np.arange(cellCounts.sum()) - np.repeat(np.cumsum(cellCounts) - cellCounts, cellCounts)
+    cellKeys = ((row0[segmentIndex] + offset // widths[segmentIndex]) * columns +
+                col0[segmentIndex] + offset % widths[segmentIndex])
+    order = np.argsort(cellKeys, kind='mergesort')
+    cellKeys = cellKeys[order]
+    segmentIndex = segmentIndex[order]
+
+    # the candidate segments for each point are the ones indexed in its cell
+    pointCol = np.floor((points[:, 0] - originX) / cellSize)
+    pointRow = np.floor((points[:, 1] - originY) / cellSize)
+    inGrid = (pointCol >= 0) & (pointCol < columns) & (pointRow >= 0) & (pointRow < rows)
+    pointKeys = np.where(inGrid, pointRow * columns + pointCol, -1).astype(np.int64)
+    first = np.searchsorted(cellKeys, pointKeys, side='left')
+    candidateCounts = np.where(inGrid, np.searchsorted(cellKeys, pointKeys, side='right') - first, 0)
+
+    pointIndex = np.repeat(np.arange(len(points)), candidateCounts)
+    candidate = segmentIndex[np.repeat(first, candidateCounts) + np.arange(candidateCounts.sum()) -
+                             np.repeat(np.cumsum(candidateCounts) - candidateCounts, candidateCounts)]
+    if len(candidate) == 0:
+        return nearest
+
+    distance = pointSegmentDistance(points[pointIndex], segments[candidate])
+    within = distance <= tolerance
+    pointIndex = pointIndex[within]
+    candidate = candidate[within]
+    distance = distance[within]
+
+    # keep the closest segment for each point
+    order = np.lexsort((candidate, distance, pointIndex))
+    pointIndex = pointIndex[order]
+    isFirst = np.ones(len(pointIndex), bool)
+    isFirst[1:] = pointIndex[1:] != pointIndex[:-1]
+    nearest[pointIndex[isFirst]] = candidate[order][isFirst]
+    return nearest
+
+
+def pointSegmentDistance(points, segments):
+    """
+    :param points: (n, 2) array of point coordinates
+    :param segments: (n, 4) array of segment start and end coordinates
+    :return: The distance from each point to the segment in the same row
+    """
+    dx = segments[:, 2] - segments[:, 0]
+    dy = segments[:, 3] - segments[:, 1]
+    lengthSquared = dx * dx + dy * dy
+    t = np.zeros(len(points))
+    np.divide((points[:, 0] - segments[:, 0]) * dx + (points[:, 1] - segments[:, 1]) * dy, lengthSquared,
+              out=t, where=lengthSquared > 0)
+    t = np.clip(t, 0, 1)
+    return np.hypot(points[:, 0] - (segments[:, 0] + t * dx), points[:, 1] - (segments[:, 1] + t * dy))
 
 
 def addFields(outputPath, newFields):
@@ -101,79 +239,89 @@ def addFields(outputPath, newFields):
             arcpy.AddField_management(outputPath, field, field_type="DOUBLE", field_precision=0, field_scale=0)
 
 
-def setOtherAttributes(outputPath, fields):
+def setOtherAttributes(outputPath, fields, inputFields):
     """
-    Sets the attributes of all other things we want to do
+    Sets the attributes of all other things we want to do, and writes the validation table next to the output
     :param outputPath: The polyline shapefile with BRAT output
     :param fields: The fields we want to update
+    :param inputFields: ReachID, SHAPE@LENGTH, oCC_EX, oCC_PT and, if there are dams, e_DamCt
     :return:
     """
-    with arcpy.da.UpdateCursor(outputPath, fields) as cursor:
-        for row in cursor:
-            segLength = row[-3] # third to last attribute
-            if segLength is None:
-                segLength = 0
-            oCC_EX = row[-2] # second to last attribute
-            oCC_PT = row[-1] # last attribute
-
-            # Handles Ex_Categor
-            row[0] = handleCategory(oCC_EX)
-
-            # Handles Pt_Categor
-            row[1] = handleCategory(oCC_PT)
+    inputs = arcpy.da.FeatureClassToNumPyArray(outputPath, inputFields, null_value=0)
+    segLength = inputs['SHAPE@LENGTH'].astype(np.float64)
+    oCC_EX = inputs['oCC_EX'].astype(np.float64)
+    oCC_PT = inputs['oCC_PT'].astype(np.float64)
 
-            # Handles mCC_EX_Ct
-            row[2] = (oCC_EX * segLength) / 1000
+    exCategory = categorize(oCC_EX)
+    ptCategory = categorize(oCC_PT)
+    mCC_EX_Ct = (oCC_EX * segLength) / 1000
+    mCC_PT_Ct = (oCC_PT * segLength) / 1000
+    mCC_EXtoPT = np.zeros_like(oCC_EX)
+    np.divide(oCC_EX, oCC_PT, out=mCC_EXtoPT, where=oCC_PT != 0)
 
-            # Handles mCC_PT_Ct
-            row[3] = (oCC_PT * segLength) / 1000
-
-            # Handles mCC_EXtoPT
-            if oCC_PT != 0:
-                row[4] = oCC_EX / oCC_PT
-            else:
-                row[4] = 0
+    outRows = dict(zip(inputs['ReachID'].tolist(),
+                       zip(np.asarray(CATEGORIES)[exCategory].tolist(), np.asarray(CATEGORIES)[ptCategory].tolist(),
+                           mCC_EX_Ct.tolist(), mCC_PT_Ct.tolist(), mCC_EXtoPT.tolist())))
+    with arcpy.da.UpdateCursor(outputPath, ['ReachID'] + fields) as cursor:
+        for row in cursor:
+            values = outRows.get(row[0])
+            if values is not None:
+                cursor.updateRow([row[0]] + list(values))
 
-            cursor.updateRow(row)
+    damCount = inputs['e_DamCt'].astype(np.float64) if 'e_DamCt' in inputFields else None
+    validationTable = os.path.splitext(outputPath)[0] + "_Validation.csv"
+    writeValidationTable(validationTable, segLength, [("Existing", exCategory, mCC_EX_Ct),
+                                                      ("Historic", ptCategory, mCC_PT_Ct)], damCount)
+    arcpy.AddMessage("Wrote the validation table to " + validationTable)
 
 
-def handleCategory(oCCVariable):
+def categorize(oCC):
     """
-    Returns a string based on the oCC value given to it
-    :param oCCVariable: A number
-    :return: String
+    Finds the capacity category of each value
+    :param oCC: An array of capacities, in dams/km
+    :return: An array of indices into CATEGORIES
     """
-    if oCCVariable == 0:
-        return "None"
-    elif 0 < oCCVariable <= 1:
-        return "Rare"
-    elif 1 < oCCVariable <= 5:
-        return "Occasional"
-    elif 5 < oCCVariable <= 15:
-        return "Frequent"
-    elif 15 < oCCVariable <= 40:
-        return "Pervasive"
-    else:
-        return "UNDEFINED"
+    categories = np.digitize(oCC, CATEGORY_BREAKS, right=True)
+    with np.errstate(invalid='ignore'):
+        categories[oCC < 0] = len(CATEGORIES) - 1
+    return categories
 
 
-def cleanUpFields(bratNetwork, outNetwork, newFields):
+def writeValidationTable(validationTable, segLength, models, damCount=None):
     """
-    Removes unnecessary fields
-    :param bratNetwork: The original, unmodified stream network
-    :param outNetwork: The output network
-    :param newFields: All the fields we added
+    Writes the network totals for each capacity category, comparing observed and predicted dams if there are any
+    observed dams. The electivity index of a category is its share of observed dams over its share of stream length
+    :param validationTable: The csv file to write
+    :param segLength: The length of each reach, in meters
+    :param models: A list of (name, category array, predicted dam count array) tuples
+    :param damCount: The number of observed dams on each reach
     :return:
     """
-    originalFields = [field.baseName for field in arcpy.ListFields(bratNetwork)]
-    desiredFields = originalFields + newFields
-    outputFields = [field.baseName for field in arcpy.ListFields(outNetwork)]
-
-    removeFields = []
-    for field in outputFields:
-        if field not in desiredFields:
-            removeFields.append(field)
+    header = ["Capacity", "Category", "Reaches", "Length_km", "Length_Pct", "Predicted_Dams"]
+    if damCount is not None:
+        header += ["Observed_Dams", "Observed_Pct", "Pct_Occupied", "Electivity"]
+    totalLength = segLength.sum()
+    totalDams = damCount.sum() if damCount is not None else 0
 
-    if len(removeFields) > 0:
-        arcpy.DeleteField_management(outNetwork, removeFields)
+    with open(validationTable, 'wb') as tableFile:
+        writer = csv.writer(tableFile)
+        writer.writerow(header)
+        for name, categories, predicted in models:
+            reaches = np.bincount(categories, minlength=len(CATEGORIES))
+            lengths = np.bincount(categories, weights=segLength, minlength=len(CATEGORIES))
+            predictedDams = np.bincount(categories, weights=predicted, minlength=len(CATEGORIES))
+            if damCount is not None:
+                observedDams = np.bincount(categories, weights=damCount, minlength=len(CATEGORIES))
 
+            for category, select in zip(CATEGORIES + ["Total"], list(range(len(CATEGORIES))) + [slice(None)]):
+                length = lengths[select].sum()
+                lengthPct = 100 * length / totalLength if totalLength > 0 else 0
+                predictedCount = predictedDams[select].sum()
+                row = [name, category, reaches[select].sum(), length / 1000, lengthPct, predictedCount]
+                if damCount is not None:
+                    observed = observedDams[select].sum()
+                    observedPct = 100 * observed / totalDams if totalDams > 0 else 0
+                    occupied = 100 * observed / predictedCount if predictedCount > 0 else 0
+                    electivity = observedPct / lengthPct if lengthPct > 0 else 0
+                    row += [observed, observedPct, occupied, electivity]
+                writer.writerow(row)
@@ -0,0 +1,653 @@
+# -------------------------------------------------------------------------------
+# Name:        Terrain Engine
+# Purpose:     DEM processing with NumPy and GDAL, done tile by tile so that large DEMs never need to be held in
+#              memory at once
+#
+# Created:     10/2026
+# Licence:     <your licence>
+# -------------------------------------------------------------------------------
+
+from osgeo import gdal
+import numpy as np
+import heapq
+import collections
+import os
+import shutil
+import tempfile
+
+# width in cells of the square tiles DEMs are processed in; a multiple of the output block size
+TILE_CELLS = 2048
+
+# NoData value of the rasters written by the engine
+NO_DATA = -9999.0
+
+# the eight neighbours of a cell, from the top left across and down, as row and column offsets. A flow direction
+# is stored as the index of the neighbour a cell flows to, and the opposite of direction k is 7 - k
+ROW_OFFSETS = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+COL_OFFSETS = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+# the value each flow direction index is written as. The encoding is declared in the FLOW_DIR_ENCODING metadata item
+# of flow direction rasters, and 0 is a cell with no outflow
+FLOW_ENCODINGS = {
+    'ESRI': np.array([32, 64, 128, 16, 1, 8, 4, 2]),
+    'TAUDEM': np.array([4, 3, 2, 5, 1, 6, 7, 8])
+}
+FLOW_NO_DATA = 255
+
+# label of the cells that drain off the DEM, either at its edge or into NoData
+OCEAN = 1
+
+TIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER', 'SPARSE_OK=TRUE']
+
+
+def create_like(ds, out_path, data_type=gdal.GDT_Float32, no_data=NO_DATA):
+    """
+    Creates a tiled, compressed GeoTIFF on the same grid as a dataset. Blocks that are never written read as NoData
+    :param ds: The GDAL dataset to copy the grid of
+    :param out_path: The path of the GeoTIFF to create
+    :param data_type: The GDAL data type of the GeoTIFF
+    :param no_data: The NoData value of the GeoTIFF
+    :return: The new GDAL dataset
+    """
+    driver = gdal.GetDriverByName("GTiff")
+    out_ds = driver.Create(out_path, xsize=ds.RasterXSize, ysize=ds.RasterYSize, bands=1, eType=data_type,
+                           options=TIFF_OPTIONS)
+    out_ds.SetGeoTransform(ds.GetGeoTransform())
+    out_ds.SetProjection(ds.GetProjection())
+    out_ds.GetRasterBand(1).SetNoDataValue(no_data)
+    return out_ds
+
+
+def tiles(rows, cols, tile_cells=None):
+    """
+    :param rows: The number of rows in the raster
+    :param cols: The number of columns in the raster
+    :param tile_cells: The width of the tiles, which defaults to TILE_CELLS
+    :return: A list of (row0, row1, col0, col1) tile bounds, from the top left
+    """
+    tile_cells = tile_cells or TILE_CELLS
+    return [(row0, min(row0 + tile_cells, rows), col0, min(col0 + tile_cells, cols))
+            for row0 in range(0, rows, tile_cells) for col0 in range(0, cols, tile_cells)]
+
+
+def read_block(band, row0, row1, col0, col1, halo=0):
+    """
+    Reads a block of a band with a halo of cells around it, as floats with NoData as nan. Halo cells outside the
+    raster are nan
+    :param band: The GDAL band
+    :param row0: The first row of the block
+    :param row1: The row after the last row of the block
+    :param col0: The first column of the block
+    :param col1: The column after the last column of the block
+    :param halo: The number of cells to read around the block
+    :return: A (row1 - row0 + 2 * halo, col1 - col0 + 2 * halo) array
+    """
+    values = np.full((row1 - row0 + 2 * halo, col1 - col0 + 2 * halo), np.nan)
+    read_row0 = max(row0 - halo, 0)
+    read_row1 = min(row1 + halo, band.YSize)
+    read_col0 = max(col0 - halo, 0)
+    read_col1 = min(col1 + halo, band.XSize)
+    block = band.ReadAsArray(read_col0, read_row0, read_col1 - read_col0, read_row1 - read_row0).astype(np.float64)
+    no_data = band.GetNoDataValue()
+    if no_data is not None:
+        block[block == no_data] = np.nan
+    values[read_row0 - row0 + halo:read_row1 - row0 + halo, read_col0 - col0 + halo:read_col1 - col0 + halo] = block
+    return values
+
+
+def focal_mean(values):
+    """
+    The mean of the 3x3 window around each cell, ignoring NoData, as FocalStatistics with NbrRectangle(3, 3, "CELL")
+    does. Cells that are NoData stay NoData, as ExtractByMask to the input DEM would leave them
+    :param values: A block with a one cell halo, with NoData as nan
+    :return: The means of the cells inside the halo
+    """
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    rows, cols = values.shape[0] - 2, values.shape[1] - 2
+    sums = np.zeros((rows, cols))
+    counts = np.zeros((rows, cols))
+    for row_offset in range(3):
+        for col_offset in range(3):
+            sums += filled[row_offset:row_offset + rows, col_offset:col_offset + cols]
+            counts += valid[row_offset:row_offset + rows, col_offset:col_offset + cols]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means[~valid[1:-1, 1:-1]] = np.nan
+    return means
+
+
+def point_tiles(ds, points, radius, tile_cells=None):
+    """
+    Finds the tiles that hold any cell within the radius of any of the points
+    :param ds: The GDAL dataset
+    :param points: (n, 2) array of point coordinates, in the dataset's coordinate system
+    :param radius: The radius around each point, in map units
+    :param tile_cells: The width of the tiles, which defaults to TILE_CELLS
+    :return: A set of (row0, col0) tile origins
+    """
+    tile_cells = tile_cells or TILE_CELLS
+    x_min, cell_width, _, y_max, _, cell_height = ds.GetGeoTransform()
+    cell_height = abs(cell_height)
+    # the window of each point, grown by a cell for the halo of the smoothing
+    row0 = np.floor((y_max - points[:, 1] - radius) / cell_height).astype(np.int64) - 1
+    row1 = np.floor((y_max - points[:, 1] + radius) / cell_height).astype(np.int64) + 1
+    col0 = np.floor((points[:, 0] - radius - x_min) / cell_width).astype(np.int64) - 1
+    col1 = np.floor((points[:, 0] + radius - x_min) / cell_width).astype(np.int64) + 1
+    tile_rows = (ds.RasterYSize - 1) // tile_cells
+    tile_cols = (ds.RasterXSize - 1) // tile_cells
+    row0 = np.clip(row0 // tile_cells, 0, tile_rows)
+    row1 = np.clip(row1 // tile_cells, 0, tile_rows)
+    col0 = np.clip(col0 // tile_cells, 0, tile_cols)
+    col1 = np.clip(col1 // tile_cells, 0, tile_cols)
+
+    needed = np.zeros((tile_rows + 1, tile_cols + 1), bool)
+    for r0, r1, c0, c1 in zip(row0, row1, col0, col1):
+        needed[r0:r1 + 1, c0:c1 + 1] = True
+    return set((row * tile_cells, col * tile_cells) for row, col in zip(*np.nonzero(needed)))
+
+
+def smooth_dem(in_dem, out_dem, points=None, radius=0.0):
+    """
+    Smooths a DEM with a 3x3 mean, reading it in tiles with a one cell halo so that the tiles join seamlessly
+    :param in_dem: The path of the DEM
+    :param out_dem: The path of the tiled, compressed GeoTIFF to write
+    :param points: If given, an (n, 2) array of points. Only the tiles near these points are smoothed, and the
+    rest of the output is NoData
+    :param radius: The distance around the points that must be smoothed, in map units
+    :return: The path of the smoothed DEM
+    """
+    ds = gdal.Open(in_dem)
+    band = ds.GetRasterBand(1)
+    out_ds = create_like(ds, out_dem)
+    out_band = out_ds.GetRasterBand(1)
+
+    wanted = point_tiles(ds, points, radius) if points is not None else None
+    for row0, row1, col0, col1 in tiles(ds.RasterYSize, ds.RasterXSize):
+        if wanted is not None and (row0, col0) not in wanted:
+            continue
+        means = focal_mean(read_block(band, row0, row1, col0, col1, halo=1))
+        out_band.WriteArray(np.where(np.isnan(means), NO_DATA, means).astype(np.float32), col0, row0)
+
+    out_band.FlushCache()
+    out_ds = None
+    ds = None
+    return out_dem
+
+
+def fill_depressions(in_dem, out_dem):
+    """
+    Fills the depressions of a DEM with priority-flood, so that every cell has a path to the edge of the DEM, or to
+    NoData, that never goes uphill. Each tile is flooded from its own edges, labelling the cells by the edge cell
+    they were reached from and recording the lowest spill elevation between labels. The labels are then flooded
+    from the edge of the DEM, as a graph, to find the level each one must be raised to
+    :param in_dem: The path of the DEM
+    :param out_dem: The path of the filled DEM to write
+    :return: The path of the filled DEM
+    """
+    ds = gdal.Open(in_dem)
+    band = ds.GetRasterBand(1)
+    tile_list = tiles(ds.RasterYSize, ds.RasterXSize)
+    temp_dir = tempfile.mkdtemp()
+
+    # flood each tile from its edges, keeping the labels of the tile edge cells to join the tiles with
+    spill = {}
+    edge_indices = []
+    edge_labels = []
+    edge_levels = []
+    for tile_number, (row0, row1, col0, col1) in enumerate(tile_list):
+        values = read_block(band, row0, row1, col0, col1, halo=1)
+        first_label = OCEAN + 1 + tile_number * 4 * TILE_CELLS
+        filled, labels, tile_spill = flood_tile(values, first_label)
+        for key, level in tile_spill.items():
+            if level < spill.get(key, np.inf):
+                spill[key] = level
+        np.save(os.path.join(temp_dir, str(tile_number) + "_filled.npy"), filled)
+        np.save(os.path.join(temp_dir, str(tile_number) + "_labels.npy"), labels)
+
+        edge = np.zeros(filled.shape, bool)
+        edge[[0, -1], :] = True
+        edge[:, [0, -1]] = True
+        edge &= labels > 0
+        rows, cols = np.nonzero(edge)
+        edge_indices.append((rows + row0) * ds.RasterXSize + cols + col0)
+        edge_labels.append(labels[edge])
+        edge_levels.append(filled[edge])
+
+    # tile edge cells next to each other across a tile boundary join their labels
+    edge_indices = np.concatenate(edge_indices)
+    edge_labels = np.concatenate(edge_labels)
+    edge_levels = np.concatenate(edge_levels)
+    order = np.argsort(edge_indices)
+    edge_indices = edge_indices[order]
+    edge_labels = edge_labels[order]
+    edge_levels = edge_levels[order]
+    edge_cols = edge_indices % ds.RasterXSize
+    for row_offset, col_offset in zip(ROW_OFFSETS, COL_OFFSETS):
+        neighbours = edge_indices + row_offset * ds.RasterXSize + col_offset
+        position = np.minimum(np.searchsorted(edge_indices, neighbours), len(edge_indices) - 1)
+        joined = ((edge_indices[position] == neighbours) & (edge_cols + col_offset >= 0) &
+                  (edge_cols + col_offset < ds.RasterXSize) & (edge_labels[position] != edge_labels))
+        levels = np.maximum(edge_levels[joined], edge_levels[position[joined]])
+        for first, second, level in zip(edge_labels[joined].tolist(), edge_labels[position[joined]].tolist(),
+                                        levels.tolist()):
+            key = (min(first, second), max(first, second))
+            if level < spill.get(key, np.inf):
+                spill[key] = level
+
+    label_levels = flood_labels(spill)
+
+    out_ds = create_like(ds, out_dem)
+    out_band = out_ds.GetRasterBand(1)
+    for tile_number, (row0, row1, col0, col1) in enumerate(tile_list):
+        filled = np.load(os.path.join(temp_dir, str(tile_number) + "_filled.npy"))
+        labels = np.load(os.path.join(temp_dir, str(tile_number) + "_labels.npy"))
+        unique_labels, label_index = np.unique(labels, return_inverse=True)
+        levels = np.array([label_levels.get(label, -np.inf) for label in unique_labels.tolist()])
+        filled = np.maximum(filled, levels[label_index].reshape(filled.shape))
+        out_band.WriteArray(np.where(np.isnan(filled), NO_DATA, filled).astype(np.float32), col0, row0)
+
+    out_band.FlushCache()
+    out_ds = None
+    ds = None
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    return out_dem
+
+
+def flood_tile(values, first_label):
+    """
+    Priority-flood of one tile from its edge cells. Cells next to NoData or the edge of the DEM drain off it and
+    are labelled OCEAN, and every other tile edge cell starts a new label when the flood reaches it first. Cells
+    raised to the level they were reached from are flooded in order of arrival rather than through the heap
+    :param values: The tile, with a one cell halo of its neighbours' values and NoData as nan
+    :param first_label: The first label to give the tile's edge cells
+    :return: The filled tile, the label of each of its cells (0 for NoData), and a dictionary of the lowest spill
+    elevation between each pair of labels that touch
+    """
+    rows, cols = values.shape
+    valid = ~np.isnan(values)
+    # halo and NoData cells are closed, with a label of -1
+    label_grid = np.where(valid, 0, -1)
+    label_grid[[0, -1], :] = -1
+    label_grid[:, [0, -1]] = -1
+    ocean = np.zeros(values.shape, bool)
+    for row_offset, col_offset in zip(ROW_OFFSETS, COL_OFFSETS):
+        ocean[1:-1, 1:-1] |= ~valid[1 + row_offset:rows - 1 + row_offset, 1 + col_offset:cols - 1 + col_offset]
+    ocean &= label_grid == 0
+    label_grid[ocean] = OCEAN
+    tile_edge = np.zeros(values.shape, bool)
+    tile_edge[[1, -2], 1:-1] = True
+    tile_edge[1:-1, [1, -2]] = True
+    seeds = np.flatnonzero((ocean | tile_edge) & (label_grid >= 0))
+
+    filled = np.where(valid, values, 0.0).ravel().tolist()
+    labels = label_grid.ravel().tolist()
+    offsets = (ROW_OFFSETS * cols + COL_OFFSETS).tolist()
+    heap = [(filled[cell], cell) for cell in seeds.tolist()]
+    heapq.heapify(heap)
+    pit = collections.deque()
+    spill = {}
+    next_label = first_label
+
+    while heap or pit:
+        if pit:
+            cell = pit.popleft()
+        else:
+            cell = heapq.heappop(heap)[1]
+        label = labels[cell]
+        if label == 0:
+            label = labels[cell] = next_label
+            next_label += 1
+        level = filled[cell]
+        for offset in offsets:
+            neighbour = cell + offset
+            neighbour_label = labels[neighbour]
+            if neighbour_label == -1:
+                continue
+            if neighbour_label != 0:
+                if neighbour_label != label:
+                    key = (min(label, neighbour_label), max(label, neighbour_label))
+                    spill_level = max(level, filled[neighbour])
+                    if spill_level < spill.get(key, np.inf):
+                        spill[key] = spill_level
+                continue
+            labels[neighbour] = label
+            if filled[neighbour] <= level:
+                filled[neighbour] = level
+                pit.append(neighbour)
+            else:
+                heapq.heappush(heap, (filled[neighbour], neighbour))
+
+    filled = np.array(filled).reshape(values.shape)[1:-1, 1:-1]
+    labels = np.array(labels, np.int64).reshape(values.shape)[1:-1, 1:-1]
+    filled[~valid[1:-1, 1:-1]] = np.nan
+    labels[labels < 0] = 0
+    return filled, labels, spill
+
+
+def flood_labels(spill):
+    """
+    Floods the graph of labels from OCEAN, so that each label's level is the lowest elevation water in it could
+    spill over on its way off the DEM
+    :param spill: A dictionary of the lowest spill elevation between each pair of labels that touch
+    :return: A dictionary of the level of each label
+    """
+    graph = collections.defaultdict(list)
+    for (first, second), level in spill.items():
+        graph[first].append((second, level))
+        graph[second].append((first, level))
+
+    levels = {OCEAN: -np.inf}
+    heap = [(-np.inf, OCEAN)]
+    done = set()
+    while heap:
+        level, label = heapq.heappop(heap)
+        if label in done:
+            continue
+        done.add(label)
+        for neighbour, spill_level in graph[label]:
+            neighbour_level = max(level, spill_level)
+            if neighbour_level < levels.get(neighbour, np.inf):
+                levels[neighbour] = neighbour_level
+                heapq.heappush(heap, (neighbour_level, neighbour))
+    return levels
+
+
+def flow_direction(in_dem, out_flow_dir, encoding='ESRI'):
+    """
+    D8 flow direction of a filled DEM. Each cell flows to its steepest downhill neighbour. A cell with no downhill
+    neighbour that is next to the edge of the DEM or NoData flows off it, and cells on flats flow towards the
+    nearest cell of the flat that drains, found by a search outwards from the draining cells
+    :param in_dem: The path of the filled DEM
+    :param out_flow_dir: The path of the flow direction raster to write
+    :param encoding: The encoding to write directions in, one of FLOW_ENCODINGS
+    :return: The path of the flow direction raster
+    """
+    if encoding not in FLOW_ENCODINGS:
+        raise Exception("Unknown flow direction encoding " + str(encoding))
+    codes = FLOW_ENCODINGS[encoding]
+    ds = gdal.Open(in_dem)
+    band = ds.GetRasterBand(1)
+    cell_width, cell_height = abs(ds.GetGeoTransform()[1]), abs(ds.GetGeoTransform()[5])
+    distances = np.hypot(ROW_OFFSETS * cell_height, COL_OFFSETS * cell_width)
+    columns = ds.RasterXSize
+
+    out_ds = create_like(ds, out_flow_dir, gdal.GDT_Byte, FLOW_NO_DATA)
+    out_ds.SetMetadataItem("FLOW_DIR_ENCODING", encoding)
+    out_band = out_ds.GetRasterBand(1)
+
+    # directions of every cell that drains, keeping the flat cells that do not
+    flat_indices = []
+    flat_directions = []
+    for row0, row1, col0, col1 in tiles(ds.RasterYSize, ds.RasterXSize):
+        values = read_block(band, row0, row1, col0, col1, halo=2)
+        directions, drains = steepest_directions(values, distances)
+        inner = directions[1:-1, 1:-1]
+        inner_values = values[2:-2, 2:-2]
+        flat = (inner < 0) & ~np.isnan(inner_values)
+        out_band.WriteArray(np.where(np.isnan(inner_values), FLOW_NO_DATA,
+                                     np.where(inner < 0, 0, codes[np.maximum(inner, 0)])).astype(np.uint8), col0, row0)
+
+        # flat cells next to a draining cell of the same elevation flow to it
+        flat_direction = np.full(inner.shape, -1)
+        for direction in range(7, -1, -1):
+            row_offset, col_offset = ROW_OFFSETS[direction], COL_OFFSETS[direction]
+            neighbour_drains = drains[1 + row_offset:drains.shape[0] - 1 + row_offset,
+                                      1 + col_offset:drains.shape[1] - 1 + col_offset]
+            neighbour_values = values[2 + row_offset:values.shape[0] - 2 + row_offset,
+                                      2 + col_offset:values.shape[1] - 2 + col_offset]
+            flat_direction[flat & neighbour_drains & (neighbour_values == inner_values)] = direction
+        rows, cols = np.nonzero(flat)
+        flat_indices.append((rows + row0) * columns + cols + col0)
+        flat_directions.append(flat_direction[flat])
+
+    flat_indices = np.concatenate(flat_indices) if flat_indices else np.zeros(0, np.int64)
+    flat_directions = np.concatenate(flat_directions) if flat_directions else np.zeros(0, np.int64)
+    if len(flat_indices) > 0:
+        order = np.argsort(flat_indices)
+        flat_indices = flat_indices[order]
+        flat_directions = resolve_flats(flat_indices, flat_directions[order], columns)
+        flat_rows = flat_indices // columns
+        flat_cols = flat_indices % columns
+        for row0, row1, col0, col1 in tiles(ds.RasterYSize, ds.RasterXSize):
+            in_tile = (flat_rows >= row0) & (flat_rows < row1) & (flat_cols >= col0) & (flat_cols < col1)
+            if not in_tile.any() or not (flat_directions[in_tile] >= 0).any():
+                continue
+            block = out_band.ReadAsArray(col0, row0, col1 - col0, row1 - row0)
+            resolved = in_tile & (flat_directions >= 0)
+            block[flat_rows[resolved] - row0, flat_cols[resolved] - col0] = codes[flat_directions[resolved]]
+            out_band.WriteArray(block, col0, row0)
+
+    out_band.FlushCache()
+    out_ds = None
+    ds = None
+    return out_flow_dir
+
+
+def steepest_directions(values, distances):
+    """
+    The steepest downhill direction of every cell in a block, and whether each cell drains
+    :param values: A block of the DEM with a two cell halo, with NoData as nan
+    :param distances: The distance to the neighbour in each direction
+    :return: The direction index of the cells inside a one cell halo, which is -1 where a cell has no downhill
+    neighbour and does not flow off the DEM, and whether those cells drain
+    """
+    rows, cols = values.shape[0] - 2, values.shape[1] - 2
+    centre = values[1:-1, 1:-1]
+    steepest = np.zeros((rows, cols))
+    directions = np.full((rows, cols), -1)
+    off_dem = np.full((rows, cols), -1)
+    for direction in range(8):
+        row_offset, col_offset = ROW_OFFSETS[direction], COL_OFFSETS[direction]
+        neighbour = values[1 + row_offset:1 + row_offset + rows, 1 + col_offset:1 + col_offset + cols]
+        with np.errstate(invalid='ignore'):
+            drop = (centre - neighbour) / distances[direction]
+            steeper = drop > steepest
+        steepest[steeper] = drop[steeper]
+        directions[steeper] = direction
+        off_dem[np.isnan(neighbour) & (off_dem < 0)] = direction
+    directions = np.where(directions < 0, off_dem, directions)
+    directions[np.isnan(centre)] = -1
+    return directions, directions >= 0
+
+
+def resolve_flats(flat_indices, flat_directions, columns):
+    """
+    Gives the cells of flats a direction by searching outwards, one ring of cells at a time, from the flat cells
+    that already flow to a draining cell. Flat cells next to each other always have the same elevation
+    :param flat_indices: The sorted raster index (row * columns + column) of each flat cell
+    :param flat_directions: The direction of each flat cell, or -1 where it has none yet
+    :param columns: The number of columns in the raster
+    :return: The direction of each flat cell, which is still -1 for cells with no way off the flat
+    """
+    flat_directions = flat_directions.copy()
+    flat_cols = flat_indices % columns
+    frontier = np.flatnonzero(flat_directions >= 0)
+    while len(frontier) > 0:
+        reached = []
+        for direction in range(8):
+            col_offset = COL_OFFSETS[direction]
+            neighbours = flat_indices[frontier] + ROW_OFFSETS[direction] * columns + col_offset
+            position = np.minimum(np.searchsorted(flat_indices, neighbours), len(flat_indices) - 1)
+            new = ((flat_indices[position] == neighbours) & (flat_directions[position] < 0) &
+                   (flat_cols[frontier] + col_offset >= 0) & (flat_cols[frontier] + col_offset < columns))
+            position = np.unique(position[new])
+            # the neighbour flows back the opposite way, to the frontier cell
+            flat_directions[position] = 7 - direction
+            reached.append(position)
+        frontier = np.concatenate(reached)
+    return flat_directions
+
+
+def flow_encoding(ds):
+    """
+    :param ds: A GDAL dataset of flow directions
+    :return: The encoding declared in the dataset's metadata, or None if it declares none
+    """
+    return ds.GetMetadataItem("FLOW_DIR_ENCODING")
+
+
+def direction_lookup(ds):
+    """
+    :param ds: A GDAL dataset of flow directions
+    :return: A 256 long array from each byte code of the dataset's encoding to its direction index, which is -1 for
+    codes that are not a direction. Rasters that declare no encoding are taken as ESRI if any code is over 8
+    """
+    encoding = flow_encoding(ds)
+    if encoding is None:
+        band = ds.GetRasterBand(1)
+        no_data = band.GetNoDataValue()
+        largest = max(np.max(np.where(block == no_data, 0, block)) for block in
+                      (band.ReadAsArray(col0, row0, col1 - col0, row1 - row0)
+                       for row0, row1, col0, col1 in tiles(ds.RasterYSize, ds.RasterXSize)))
+        encoding = 'ESRI' if largest > 8 else 'TAUDEM'
+    lookup = np.full(256, -1, np.int8)
+    lookup[FLOW_ENCODINGS[encoding]] = np.arange(8)
+    return lookup
+
+
+def downstream_cells(directions, valid):
+    """
+    :param directions: A block of direction indices, -1 where a cell has no direction
+    :param valid: Whether each cell of the block has data
+    :return: The flat index in the block of the cell each cell flows to, which is -1 where it flows out of the
+    block or nowhere, whether each cell flows anywhere, and the row and column each cell flows to, relative to
+    the block
+    """
+    rows, cols = np.indices(directions.shape)
+    flows = valid & (directions >= 0)
+    safe_directions = np.maximum(directions, 0)
+    target_rows = rows + ROW_OFFSETS[safe_directions]
+    target_cols = cols + COL_OFFSETS[safe_directions]
+    inside = (flows & (target_rows >= 0) & (target_rows < directions.shape[0]) &
+              (target_cols >= 0) & (target_cols < directions.shape[1]))
+    inside[inside] &= valid[target_rows[inside], target_cols[inside]]
+    downstream = np.where(inside, target_rows * directions.shape[1] + target_cols, -1).astype(np.int32).ravel()
+    return downstream, flows, target_rows, target_cols
+
+
+def accumulate(downstream, weights):
+    """
+    Accumulates weights downstream in linear time. Cells are taken in topological order, a wave at a time: each wave
+    is the cells that nothing still unprocessed flows into, found by counting down the number of cells flowing into
+    each cell
+    :param downstream: The index of the cell each cell flows to, or -1
+    :param weights: The weight of each cell, which is 0 for cells without data
+    :return: The total weight of each cell and everything upstream of it, and the list of waves, from upstream down
+    """
+    total = np.asarray(weights, np.float64).copy()
+    flows = downstream >= 0
+    # counted in 32 bits, since cells on tile edges can take the flow of thousands of other edge cells
+    in_degree = np.bincount(downstream[flows], minlength=len(downstream)).astype(np.int32)
+    frontier = np.flatnonzero(in_degree == 0)
+    waves = []
+    while len(frontier) > 0:
+        waves.append(frontier)
+        frontier = frontier[flows[frontier]]
+        targets, target_index = np.unique(downstream[frontier], return_inverse=True)
+        total[targets] += np.bincount(target_index, weights=total[frontier], minlength=len(targets))
+        in_degree[targets] -= np.bincount(target_index, minlength=len(targets)).astype(np.int32)
+        frontier = targets[in_degree[targets] == 0]
+    return total, waves
+
+
+def drainage_area(flow_dir, out_drainage_area):
+    """
+    Calculates the drainage area of every cell, in square km, from a D8 flow direction raster. As with
+    FlowAccumulation, a cell's own area is not counted. Each tile is accumulated on its own, the flow out of each
+    tile is then passed between the tiles as a graph of the cells on their edges, and each tile is accumulated again
+    with its inflows added
+    :param flow_dir: The path of the flow direction raster, in meters
+    :param out_drainage_area: The path of the drainage area raster to write
+    :return: The path of the drainage area raster
+    """
+    ds = gdal.Open(flow_dir)
+    band = ds.GetRasterBand(1)
+    lookup = direction_lookup(ds)
+    no_data = band.GetNoDataValue()
+    columns = ds.RasterXSize
+    cell_area = abs(ds.GetGeoTransform()[1] * ds.GetGeoTransform()[5]) / 1000000.0
+    tile_list = tiles(ds.RasterYSize, ds.RasterXSize)
+
+    def read_tile(row0, row1, col0, col1):
+        codes = band.ReadAsArray(col0, row0, col1 - col0, row1 - row0)
+        valid = codes != no_data if no_data is not None else np.ones(codes.shape, bool)
+        return lookup[codes], valid
+
+    # the cells that flow out of each tile, and the cell of the tile edge each edge cell's flow leaves from
+    exit_cells = []
+    exit_targets = []
+    exit_totals = []
+    edge_cells = []
+    edge_terminals = []
+    for row0, row1, col0, col1 in tile_list:
+        directions, valid = read_tile(row0, row1, col0, col1)
+        downstream, flows, target_rows, target_cols = downstream_cells(directions, valid)
+        total, waves = accumulate(downstream, valid.ravel())
+
+        tile_rows, tile_cols = np.indices(directions.shape)
+        global_cells = ((tile_rows + row0) * columns + tile_cols + col0).ravel()
+        global_rows = (target_rows + row0).ravel()
+        global_cols = (target_cols + col0).ravel()
+        leaves = ((downstream < 0) & flows.ravel() &
+                  (global_rows >= 0) & (global_rows < ds.RasterYSize) & (global_cols >= 0) & (global_cols < columns))
+        exit_cells.append(global_cells[leaves])
+        exit_targets.append(global_rows[leaves] * columns + global_cols[leaves])
+        exit_totals.append(total[leaves])
+
+        # the last cell in the tile on each cell's flow path, found from the bottom of the path up
+        terminal = np.arange(len(downstream))
+        for wave in reversed(waves):
+            inside = downstream[wave] >= 0
+            terminal[wave[inside]] = terminal[downstream[wave[inside]]]
+        edge = np.zeros(directions.shape, bool)
+        edge[[0, -1], :] = True
+        edge[:, [0, -1]] = True
+        edge = edge.ravel() & valid.ravel()
+        edge_cells.append(global_cells[edge])
+        edge_terminals.append(global_cells[terminal[edge]])
+
+    exit_cells = np.concatenate(exit_cells)
+    exit_targets = np.concatenate(exit_targets)
+    exit_totals = np.concatenate(exit_totals)
+    edge_cells = np.concatenate(edge_cells)
+    edge_terminals = np.concatenate(edge_terminals)
+
+    # the flow out of each exit cell enters another tile at an edge cell and leaves it at that cell's terminal,
+    # which is either another exit cell or where the flow stops
+    inflows = {}
+    if len(exit_cells) > 0:
+        order = np.argsort(edge_cells)
+        edge_cells = edge_cells[order]
+        edge_terminals = edge_terminals[order]
+        position = np.minimum(np.searchsorted(edge_cells, exit_targets), len(edge_cells) - 1)
+        entered = edge_cells[position] == exit_targets
+        terminals = np.where(entered, edge_terminals[position], -1)
+        exit_order = np.argsort(exit_cells)
+        exit_position = np.minimum(np.searchsorted(exit_cells[exit_order], terminals), len(exit_cells) - 1)
+        next_exit = np.where(exit_cells[exit_order][exit_position] == terminals, exit_order[exit_position], -1)
+        exit_totals = accumulate(next_exit, exit_totals)[0]
+
+        targets, target_index = np.unique(exit_targets[entered], return_inverse=True)
+        inflows = dict(zip(targets.tolist(), np.bincount(target_index, weights=exit_totals[entered]).tolist()))
+    inflow_cells = np.array(sorted(inflows), np.int64)
+    inflow_values = np.array([inflows[cell] for cell in inflow_cells.tolist()])
+
+    out_ds = create_like(ds, out_drainage_area)
+    out_band = out_ds.GetRasterBand(1)
+    for row0, row1, col0, col1 in tile_list:
+        directions, valid = read_tile(row0, row1, col0, col1)
+        downstream = downstream_cells(directions, valid)[0]
+        weights = valid.ravel().astype(np.float64)
+        inflow_rows = inflow_cells // columns
+        inflow_cols = inflow_cells % columns
+        in_tile = (inflow_rows >= row0) & (inflow_rows < row1) & (inflow_cols >= col0) & (inflow_cols < col1)
+        weights[(inflow_rows[in_tile] - row0) * (col1 - col0) + inflow_cols[in_tile] - col0] += inflow_values[in_tile]
+        total = accumulate(downstream, weights)[0].reshape(directions.shape)
+        area = np.where(valid, (total - 1) * cell_area, NO_DATA)
+        out_band.WriteArray(area.astype(np.float32), col0, row0)
+
+    out_band.FlushCache()
+    out_ds = None
+    ds = None
+    return out_drainage_area
@@ -9,6 +9,12 @@
 
 
 import arcpy
+import numpy as np
+import heapq
+import os
+import shutil
+import sys
+import tempfile
 
 
 class TestException(Exception):
@@ -30,16 +36,872 @@ def test_reach_id_is_unique(network):
             reach_ids.append(reach_id)
 
 
-def report_exceptions(exceptions):
+def test_fis_engine_matches_skfuzzy(sample_size=200):
     """
-    Reports the exceptions found during testing
-    :param exceptions: The list of exceptions found during testing
+    Makes sure that the numpy FIS engine gives the same output as skfuzzy for the vegetation and combined FIS,
+    within FIS_Engine.SKFUZZY_TOLERANCE, on a fixed sample of inputs spread over the universe of each input
+    :param sample_size: How many sets of inputs to run through skfuzzy for each FIS
     :return:
     """
-    if len(exceptions) == 0:
-        arcpy.AddMessage("All tests passed")
-    else:
-        arcpy.AddMessage("The following exceptions were raised during testing:")
-        for exception in exceptions:
-            arcpy.AddError(exception)
-            arcpy.AddMessage("")
\ No newline at end of file
+    import FIS_Engine
+    import Veg_FIS
+    import Comb_FIS
+    random = np.random.RandomState(0)
+    veg_values = [random.uniform(0, 4, sample_size), random.uniform(0, 4, sample_size)]
+    comb_values = [random.uniform(0, 45, sample_size), random.uniform(0, 3000, sample_size),
+                   random.uniform(0, 250, sample_size), random.uniform(0, 0.3, sample_size)]
+    for name, fis, values in [("vegetation", Veg_FIS.build_veg_fis(), veg_values),
+                              ("combined", Comb_FIS.build_comb_fis(), comb_values)]:
+        difference = FIS_Engine.compare_with_skfuzzy(fis, values, sample_size)
+        if difference > FIS_Engine.SKFUZZY_TOLERANCE:
+            raise TestException("The " + name + " FIS engine differs from skfuzzy by up to " + str(difference) +
+                                " dams/km")
+
+
+def test_sweep_matches_comb_fis(reach_count=500):
+    """
+    Makes sure that each scenario of a combined FIS sweep gives the same capacity as running combFIS with that
+    scenario's parameters on its own
+    :param reach_count: The number of made up reaches
+    :return:
+    """
+    import Comb_FIS
+    random = np.random.RandomState(7)
+    veg_array = random.uniform(-1, 46, reach_count)
+    igeoda_array = random.uniform(0, 1000, reach_count)
+    inputs = Comb_FIS.clipInputs(veg_array.copy(), random.uniform(-10, 3000, reach_count),
+                                 random.uniform(-10, 250, reach_count), random.uniform(0, 0.3, reach_count))
+    scenarios = [{'name': 'default', 'max_DA_thresh': 500},
+                 {'name': 'wide', 'max_DA_thresh': 800, 'sp2': {'persists': [0, 0, 1500, 1800]},
+                  'splow': {'can': [0, 0, 100, 175]}}]
+
+    for scenario_set in [scenarios[:1], scenarios]:
+        systems = [Comb_FIS.build_comb_fis(scenario.get('sp2'), scenario.get('splow')) for scenario in scenario_set]
+        columns = Comb_FIS.sweepCapacity(scenario_set, systems, veg_array, [value.copy() for value in inputs],
+                                         igeoda_array)
+        for scenario, comb_fis, column in zip(scenario_set, systems, columns):
+            decided = igeoda_array >= float(scenario['max_DA_thresh'])
+            out = Comb_FIS.inferCapacity(comb_fis, [value.copy() for value in inputs], decided)[0]
+            expected = Comb_FIS.applyLimits(out, veg_array, igeoda_array, scenario['max_DA_thresh'])
+            if not np.allclose(column, expected):
+                raise TestException("The " + scenario['name'] + " sweep scenario differs from combFIS for " +
+                                    str(np.sum(~np.isclose(column, expected))) + " of " + str(reach_count) +
+                                    " reaches")
+
+
+def test_monte_carlo_matches_deterministic(reach_count=300, samples=20):
+    """
+    Makes sure that a Monte Carlo ensemble with no spread in any input gives every percentile as the capacity that
+    Veg_FIS, iHyd and combFIS find, including when discharge is recalculated from drainage area, and that the
+    percentiles of an ensemble with spread are in order
+    :param reach_count: The number of made up reaches
+    :param samples: The number of ensemble members for each reach
+    :return:
+    """
+    import Comb_FIS
+    import Veg_FIS
+    import iHyd
+    random = np.random.RandomState(8)
+    curves = iHyd.readRegionalCurves(iHyd.REGIONAL_CURVES)
+    regions = random.choice(sorted(curves), reach_count).astype(np.float64)
+    table = np.zeros(reach_count, [(field, np.float64) for field in ['iVeg_100EX', 'iVeg_30EX', 'iGeo_Slope',
+                                                                      'iGeo_DA', 'iHyd_QLow', 'iHyd_Q2']])
+    table['iVeg_100EX'] = random.uniform(-0.5, 4.5, reach_count)
+    table['iVeg_30EX'] = random.uniform(-0.5, 4.5, reach_count)
+    table['iGeo_Slope'] = random.uniform(0, 0.3, reach_count)
+    table['iGeo_DA'] = random.uniform(0, 1500, reach_count)
+    table['iHyd_QLow'], table['iHyd_Q2'] = iHyd.calcDischarge(table['iGeo_DA'], regions, curves, False)
+    max_DA_thresh = 1000
+
+    # the deterministic capacity, as Veg_FIS, iHyd and combFIS find it
+    veg_fis = Veg_FIS.build_veg_fis()
+    ovc_array, activations = veg_fis.infer_unique([np.clip(table['iVeg_100EX'], 0, 4),
+                                                   np.clip(table['iVeg_30EX'], 0, 4)])[:2]
+    ovc_array[veg_fis.fires_only(activations, 'none')] = 0.0
+    q2_array = np.where(table['iHyd_Q2'] < table['iHyd_QLow'], table['iHyd_QLow'] + 0.001, table['iHyd_Q2'])
+    inputs = Comb_FIS.clipInputs(ovc_array.copy(), iHyd.calcStreamPower(table['iGeo_Slope'], q2_array),
+                                 iHyd.calcStreamPower(table['iGeo_Slope'], table['iHyd_QLow']),
+                                 table['iGeo_Slope'].copy())
+    out = Comb_FIS.inferCapacity(Comb_FIS.build_comb_fis(), inputs, table['iGeo_DA'] >= max_DA_thresh)[0]
+    expected = Comb_FIS.applyLimits(out, ovc_array, table['iGeo_DA'], max_DA_thresh)
+
+    no_spread = dict((field, ('normal', 0.0)) for field in table.dtype.names)
+    for name, error_models, kwargs in [("", no_spread, {}),
+                                       (" with discharge from drainage area", no_spread,
+                                        {'curves': curves, 'regions': regions})]:
+        result = Comb_FIS.ensemblePercentiles(table, 'ex', max_DA_thresh, error_models, samples, [5, 50, 95],
+                                              random, **kwargs)
+        if not np.allclose(result, expected[:, None]):
+            raise TestException("An ensemble with no spread" + name + " differs from the deterministic capacity for "
+                                + str(np.sum(~np.all(np.isclose(result, expected[:, None]), axis=1))) + " reaches")
+
+    error_models = {'iVeg_100EX': ('normal', 0.5), 'iGeo_Slope': ('lognormal', 0.25), 'iGeo_DA': ('lognormal', 0.1),
+                    'iHyd_Q2': ('lognormal', 0.3)}
+    result = Comb_FIS.ensemblePercentiles(table, 'ex', max_DA_thresh, error_models, samples, [5, 50, 95], random,
+                                          curves=curves, regions=regions)
+    if np.any(result[:, 0] > result[:, 1]) or np.any(result[:, 1] > result[:, 2]):
+        raise TestException("The ensemble percentiles are out of order for " +
+                            str(np.sum((result[:, 0] > result[:, 1]) | (result[:, 1] > result[:, 2]))) + " reaches")
+    if np.all(result[:, 0] == result[:, 2]):
+        raise TestException("An ensemble with spread gives the same capacity at every percentile")
+
+
+def test_regional_curves_match_baseline():
+    """
+    Makes sure that regional curves can only be arithmetic of DAsqm, and that every curve in RegionalCurves.csv gives
+    the same discharge as the equations that used to be written into iHyd
+    :return:
+    """
+    import iHyd
+    for equation in ["__import__('os')", "DAsqm.real", "abs(DAsqm)", "DAsqm if DAsqm else 1", "True * DAsqm",
+                     "[DAsqm]", "lambda: 1"]:
+        try:
+            iHyd.parseCurve(equation, 0)
+        except Exception:
+            continue
+        raise TestException("The regional curve " + equation + " was not rejected")
+
+    baseline = {101: (lambda DAsqm: 0.019875 * (DAsqm ** 0.6634) * (10 ** (0.6068 * 2.04)),
+                      lambda DAsqm: 14.5 * DAsqm ** 0.328),
+                102: (lambda DAsqm: 4.2758 * (DAsqm ** 0.299),
+                      lambda DAsqm: 22.2 * (DAsqm ** 0.608) * ((42 - 40) ** 0.1)),
+                24: (lambda DAsqm: 0.000133 * (DAsqm ** 1.05) * (15.3 ** 2.1),
+                     lambda DAsqm: 0.000258 * (DAsqm ** 0.893) * (15.3 ** 3.15)),
+                0: (lambda DAsqm: (DAsqm ** 0.2098) + 1,
+                    lambda DAsqm: 14.7 * (DAsqm ** 0.815))}
+    curves = iHyd.readRegionalCurves(iHyd.REGIONAL_CURVES)
+    DAsqm = np.concatenate([[0.0, 1.0], np.random.RandomState(9).uniform(0, 600, 100)])
+    for region, (description, qlow_curve, q2_curve) in curves.items():
+        if region not in baseline:
+            raise TestException("Region " + str(region) + " has no baseline equations to check against")
+        for name, curve, equation in [("Qlow", qlow_curve, baseline[region][0]),
+                                      ("Q2", q2_curve, baseline[region][1])]:
+            if not np.allclose(iHyd.evaluateCurve(curve, DAsqm), equation(DAsqm)):
+                raise TestException("The " + name + " curve for region " + str(region) +
+                                    " differs from the baseline equation")
+
+
+def test_locate_points_matches_even_odd(point_count=2000):
+    """
+    Makes sure that finding the region of each point with the spatial index gives the same region as testing every
+    point against every ring of every polygon, on random polygons with holes, including polygons reaching well
+    outside the points
+    :param point_count: The number of made up points
+    :return:
+    """
+    import iHyd
+    random = np.random.RandomState(10)
+    x = random.uniform(0, 100, point_count)
+    y = random.uniform(0, 100, point_count)
+    polygons = []
+    for code, (centre_x, centre_y, radius) in enumerate([(20, 20, 15), (60, 50, 30), (50, 50, 200), (130, 40, 50),
+                                                         (90, 90, 8)]):
+        rings = []
+        for ring_radius in [radius, radius * 0.4]:
+            angles = np.sort(random.uniform(0, 2 * np.pi, 12))
+            radii = ring_radius * random.uniform(0.6, 1.0, 12)
+            rings.append(np.column_stack((centre_x + radii * np.cos(angles), centre_y + radii * np.sin(angles))))
+        vertices = np.concatenate(rings)
+        extent = (vertices[:, 0].min(), vertices[:, 1].min(), vertices[:, 0].max(), vertices[:, 1].max())
+        polygons.append((float(code + 1), extent, rings))
+    found = iHyd.locatePoints(x, y, polygons)
+
+    expected = np.full(point_count, np.nan)
+    for point in range(point_count):
+        for code, extent, rings in polygons:
+            inside = False
+            for ring in rings:
+                for i in range(len(ring)):
+                    (x1, y1), (x2, y2) = ring[i], ring[(i + 1) % len(ring)]
+                    if (y1 > y[point]) != (y2 > y[point]) and x[point] < x1 + (y[point] - y1) * (x2 - x1) / (y2 - y1):
+                        inside = not inside
+            if inside:
+                expected[point] = code
+                break
+    same = (found == expected) | (np.isnan(found) & np.isnan(expected))
+    if not same.all():
+        raise TestException("The region found for " + str(np.sum(~same)) + " of " + str(point_count) +
+                            " points differs from the even-odd test")
+
+
+def test_conflict_score_matches_loops():
+    """
+    Makes sure that the conflict components score the iPC fields the same as the reach by reach loops they replaced,
+    including values on the thresholds, negative values and missing values
+    :return:
+    """
+    import Conflict_Potential
+    thresholds = [30.0, 100.0, 20.0, 100.0, 20.0, 100.0, 30.0, 100.0]
+    random = np.random.RandomState(6)
+    distance_values = np.concatenate((random.uniform(-10, 150, 200), [0.0, 20.0, 30.0, 100.0, -1.0, np.nan]))
+    lu_values = np.concatenate((random.uniform(-0.2, 1.5, 200), [0.0, 0.33, 0.66, 1.0, -1.0, np.nan]))
+    fields = ["iPC_RoadX", "iPC_RoadAd", "iPC_Canal", "iPC_RR", "iPC_LU"]
+    inputs = np.zeros(len(distance_values), [(field, np.float64) for field in fields])
+    for i, field in enumerate(fields[:-1]):
+        inputs[field] = np.roll(distance_values, 40 * i)
+    inputs["iPC_LU"] = lu_values
+
+    def distance_score(value, low, high):
+        m, b = Conflict_Potential.slopeInt(low, high)
+        if 0 <= value <= low:
+            return 0.99
+        elif low < value <= high:
+            return m * value + b
+        return 0.01
+
+    def lu_score(value):
+        if value >= 1.0:
+            return 0.99
+        elif 0.66 <= value < 1.0:
+            return 0.75
+        elif 0.33 <= value < 0.66:
+            return 0.5
+        elif 0 < value < 0.33:
+            return 0.25
+        return 0.01
+
+    expected = {"iPC_LU": np.array([lu_score(value) for value in inputs["iPC_LU"]])}
+    for i, field in enumerate(fields[:-1]):
+        low, high = thresholds[2 * i], thresholds[2 * i + 1]
+        expected[field] = np.array([distance_score(value, low, high) for value in inputs[field]])
+
+    components = Conflict_Potential.conflictComponents(*thresholds)
+    for component in components:
+        scores = component.score(inputs[component.field])
+        if not np.allclose(scores, expected[component.field]):
+            raise TestException("The " + component.field + " scores differ from the loop scores for " +
+                                str(np.sum(~np.isclose(scores, expected[component.field]))) + " reaches")
+    scores = Conflict_Potential.scoreConflict(inputs, components)
+    if not np.allclose(scores, np.fmax.reduce([expected[field] for field in fields])):
+        raise TestException("The oPC_Score is not the largest of the component scores")
+
+
+def test_opbrc_table_matches_if_chain():
+    """
+    Makes sure that the oPBRC decision table classifies reaches the same as the if/elif chain it replaced, on values
+    at and around every threshold, and on missing values
+    :return:
+    """
+    import Conservation_Restoration as cr
+    capacities = [0.0, 0.5, 1.0, 3.0, 5.0, 10.0, 15.0, 20.0, np.nan]
+    scores = [0.0, 0.25, 0.5, 0.75, 0.9, np.nan]
+    land_uses = [0.0, 0.5, 0.8]
+    values = np.array([(ex, pt, score, lu, 0.0) for ex in capacities for pt in capacities for score in scores
+                       for lu in land_uses],
+                      [("oCC_EX", np.float64), ("oCC_PT", np.float64), ("oPC_Score", np.float64),
+                       ("iPC_ModLU", np.float64), ("iPC_HighLU", np.float64)])
+
+    def if_chain(ex, pt, score, lu):
+        if ex <= 1:
+            if pt <= 1:
+                return cr.UNSUITABLE_NATURAL
+            elif score > 0.75:
+                return cr.UNSUITABLE_ANTHRO
+            elif pt <= 5:
+                return cr.QUICK_RETURN
+            elif score > 0.25:
+                return cr.LONG_TERM
+            elif lu > 0.5:
+                return cr.LONG_TERM
+            return cr.QUICK_RETURN
+        elif ex <= 5:
+            if score > 0.75:
+                return cr.UNSUITABLE_ANTHRO
+            elif pt > 5:
+                return cr.LOW_HANGING_FRUIT
+            elif score <= 0.25:
+                return cr.QUICK_RETURN
+            elif lu > 0.5:
+                return cr.LONG_TERM
+            return cr.LOW_SOURCE
+        elif ex <= 15:
+            if score > 0.75:
+                return cr.UNSUITABLE_ANTHRO
+            elif pt > 15:
+                return cr.LOW_HANGING_FRUIT if score <= 0.25 else cr.HIGH_SOURCE
+            elif score <= 0.25:
+                return cr.LOW_HANGING_FRUIT
+            elif lu > 0.5:
+                return cr.LONG_TERM
+            return cr.QUICK_RETURN
+        elif ex > 15:
+            if score <= 0.25:
+                return cr.LOW_HANGING_FRUIT
+            elif score > 0.75:
+                return cr.UNSUITABLE_ANTHRO
+            elif lu > 0.5:
+                return cr.HIGH_SOURCE
+            return cr.QUICK_RETURN
+        return cr.NOT_PREDICTED
+
+    labels = cr.OPBRC_TABLE.label(cr.OPBRC_TABLE.classify(values))
+    for row, label in zip(values, labels):
+        expected = if_chain(row["oCC_EX"], row["oCC_PT"], row["oPC_Score"], row["iPC_ModLU"] + row["iPC_HighLU"])
+        if label != expected:
+            raise TestException("oCC_EX " + str(row["oCC_EX"]) + ", oCC_PT " + str(row["oCC_PT"]) + ", oPC_Score " +
+                                str(row["oPC_Score"]) + " and land use " + str(row["iPC_ModLU"]) + " is classed " +
+                                label + ", not " + expected)
+
+
+def test_dam_counts_match_all_pairs(reach_count=40, dam_count=1500):
+    """
+    Makes sure that the indexed nearest segment search gives each dam the same reach as measuring it against every
+    segment, including dams beyond the snap distance, dams outside the network's extent and a dam halfway between
+    two reaches, and that reaches with no length or no potential capacity get a density and proportion of 0
+    :param reach_count: The number of made up reaches, besides the two that a dam is halfway between
+    :param dam_count: The number of dams scattered over and around the network
+    :return:
+    """
+    import Summary_Report
+    random = np.random.RandomState(11)
+    tolerance = Summary_Report.SNAP_DISTANCE
+    segments = []
+    for reach in range(reach_count):
+        vertices = random.uniform(0, 2000, 2) + np.cumsum(random.uniform(-150, 150, (6, 2)), axis=0)
+        segments.extend(np.column_stack((vertices[:-1], vertices[1:], np.full(5, reach))))
+    segments.extend([(3000, 0, 3100, 0, reach_count), (3000, 40, 3100, 40, reach_count + 1)])
+    segments = np.array(segments, np.float64)
+
+    # dams scattered around the network, dams up to 45 m off a reach, and one 20 m from two reaches
+    along = random.randint(0, len(segments) - 2, dam_count)
+    t = random.uniform(0, 1, dam_count)[:, None]
+    near = segments[along, :2] + t * (segments[along, 2:4] - segments[along, :2])
+    dams = np.concatenate((random.uniform(-200, 2200, (dam_count, 2)),
+                           near + random.uniform(-45, 45, (dam_count, 2)), [(3050.0, 20.0)]))
+
+    lengths = np.bincount(segments[:, 4].astype(np.int64), np.hypot(segments[:, 2] - segments[:, 0],
+                                                                     segments[:, 3] - segments[:, 1]))
+    lengths[:3] = 0
+    oCC_PT = random.uniform(0, 20, len(lengths))
+    oCC_PT[2:5] = 0
+    damCount, damDensity, damPercentCapacity = Summary_Report.countDams(dams, segments, lengths, oCC_PT, tolerance)
+
+    pairs = np.arange(len(dams) * len(segments))
+    distances = Summary_Report.pointSegmentDistance(dams[pairs // len(segments)],
+                                                    segments[pairs % len(segments), :4]).reshape(len(dams), -1)
+    nearest = np.where(distances.min(axis=1) <= tolerance, np.argmin(distances, axis=1), -1)
+    found = Summary_Report.findNearestSegments(dams, segments[:, :4], tolerance)
+    if not np.array_equal(found, nearest):
+        raise TestException("The nearest segment of " + str(np.sum(found != nearest)) + " of " + str(len(dams)) +
+                            " dams differs from the nearest of all segments")
+    if found[-1] != len(segments) - 2:
+        raise TestException("The dam halfway between two reaches is not given to the first of them")
+
+    expected = np.bincount(segments[nearest[nearest >= 0], 4].astype(np.int64), minlength=len(lengths))
+    if not np.array_equal(damCount, expected):
+        raise TestException("The dam counts of " + str(np.sum(damCount != expected)) + " reaches differ from the " +
+                            "counts of all pairs")
+    if expected[:5].min() == 0:
+        raise TestException("The reaches with no length or no potential capacity need dams on them to test")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected_density = np.where(lengths != 0, expected * 1000 / lengths, 0)
+        expected_proportion = np.where(oCC_PT != 0, expected / oCC_PT, 0)
+    if not np.allclose(damDensity, expected_density) or not np.allclose(damPercentCapacity, expected_proportion):
+        raise TestException("The dam density or proportion of capacity differs from the dam counts")
+
+
+def test_tiled_smoothing_matches_focal_mean(size=45, tile_cells=16, radius=45.0):
+    """
+    Makes sure that smoothing a DEM tile by tile gives the same 3x3 mean as smoothing the whole DEM at once, across
+    tile edges and around NoData, and that smoothing only near points gives the same values within the radius of
+    every point, including points on tile corners
+    :param size: The width and height of the DEM in cells
+    :param tile_cells: The tile width to smooth with, which should be much smaller than the DEM
+    :param radius: The distance around the points that must be smoothed
+    :return:
+    """
+    import Terrain_Engine
+    import Zonal_Engine
+    random = np.random.RandomState(12)
+    dem = random.uniform(0, 100, (size, size)).round(2)
+    dem[random.rand(size, size) < 0.05] = Terrain_Engine.NO_DATA
+    dem[:, -1] = Terrain_Engine.NO_DATA
+    cell_size = 10.0
+    # a point on a tile corner, points on the DEM's corners, and a point whose radius reaches into the tile above
+    points = np.array([(tile_cells * cell_size, -tile_cells * cell_size), (5.0, -5.0), (435.0, -5.0),
+                       (5.0, -435.0), ((2 * tile_cells + 3.5) * cell_size, -(2 * tile_cells + 3.5) * cell_size)])
+
+    # the mean of the 3x3 window around each cell of the whole DEM at once, ignoring NoData
+    padded = np.pad(np.where(dem == Terrain_Engine.NO_DATA, np.nan, dem), 1, 'constant', constant_values=np.nan)
+    windows = np.array([padded[row:row + size, col:col + size] for row in range(3) for col in range(3)])
+    counts = np.sum(~np.isnan(windows), axis=0)
+    expected = np.nansum(windows, axis=0) / np.maximum(counts, 1)
+    expected[dem == Terrain_Engine.NO_DATA] = Terrain_Engine.NO_DATA
+
+    temp_dir = tempfile.mkdtemp()
+    old_tile_cells = Terrain_Engine.TILE_CELLS
+    try:
+        in_dem = write_test_raster(os.path.join(temp_dir, "dem.tif"), dem, Terrain_Engine.NO_DATA, cell_size)
+        Terrain_Engine.TILE_CELLS = tile_cells
+        smoothed = read_test_raster(Terrain_Engine.smooth_dem(in_dem, os.path.join(temp_dir, "smoothed.tif")))
+        near_points = read_test_raster(Terrain_Engine.smooth_dem(in_dem, os.path.join(temp_dir, "near_points.tif"),
+                                                                 points, radius))
+    finally:
+        Terrain_Engine.TILE_CELLS = old_tile_cells
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if not np.allclose(smoothed, expected, atol=1e-3):
+        raise TestException("The tiled smoothing differs from the 3x3 mean in " +
+                            str(np.sum(~np.isclose(smoothed, expected, atol=1e-3))) + " cells")
+    x, y = cell_centres(Zonal_Engine.RasterGrid(0.0, 0.0, cell_size, cell_size, size, size))
+    near = np.zeros((size, size), bool)
+    for point_x, point_y in points:
+        near |= (x - point_x) ** 2 + (y - point_y) ** 2 <= radius ** 2
+    same = np.isclose(near_points, expected, atol=1e-3)
+    if not same[near].all():
+        raise TestException("Smoothing near the points differs from the 3x3 mean in " + str(np.sum(~same[near])) +
+                            " cells within the radius of a point")
+    if not (same | (near_points == Terrain_Engine.NO_DATA)).all():
+        raise TestException("Smoothing near the points gives values that differ from the 3x3 mean")
+
+
+def test_tiled_fill_matches_priority_flood(size=60, tile_cells=16):
+    """
+    Makes sure that filling a DEM tile by tile gives the same DEM as a plain priority-flood of the whole DEM, on a
+    random DEM with pits, flats and holes of NoData
+    :param size: The width and height of the DEM in cells
+    :param tile_cells: The tile width to fill with, which should be much smaller than the DEM
+    :return:
+    """
+    import Terrain_Engine
+    random = np.random.RandomState(1)
+    dem = (random.uniform(0, 10, (size, size)) + np.add.outer(np.arange(size), np.arange(size)) * 0.05).round(1)
+    dem[random.rand(size, size) < 0.03] = Terrain_Engine.NO_DATA
+    dem[size // 3:size // 2, size // 3:size // 2] = Terrain_Engine.NO_DATA
+    expected = priority_flood(dem, Terrain_Engine.NO_DATA)
+
+    temp_dir = tempfile.mkdtemp()
+    old_tile_cells = Terrain_Engine.TILE_CELLS
+    try:
+        in_dem = write_test_raster(os.path.join(temp_dir, "dem.tif"), dem, Terrain_Engine.NO_DATA)
+        Terrain_Engine.TILE_CELLS = tile_cells
+        filled = read_test_raster(Terrain_Engine.fill_depressions(in_dem, os.path.join(temp_dir, "filled.tif")))
+    finally:
+        Terrain_Engine.TILE_CELLS = old_tile_cells
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    if not np.array_equal(filled == Terrain_Engine.NO_DATA, dem == Terrain_Engine.NO_DATA):
+        raise TestException("The filled DEM has NoData in different cells to the DEM")
+    difference = np.abs(filled - expected)[dem != Terrain_Engine.NO_DATA].max()
+    if difference > 1e-4:
+        raise TestException("The tiled fill differs from priority-flood by up to " + str(difference) + " m")
+
+
+def test_tiled_drainage_area_matches_single_tile(size=60, tile_cells=16):
+    """
+    Makes sure that the drainage area accumulated tile by tile is the same as when the raster is one tile, and that
+    both count every cell upstream of each cell, by following the flow from every cell
+    :param size: The width and height of the DEM in cells
+    :param tile_cells: The tile width to accumulate with, which should be much smaller than the DEM
+    :return:
+    """
+    import Terrain_Engine
+    random = np.random.RandomState(2)
+    dem = (random.uniform(0, 10, (size, size)) + np.add.outer(np.arange(size), np.arange(size)) * 0.05).round(1)
+    dem[random.rand(size, size) < 0.03] = Terrain_Engine.NO_DATA
+    cell_size = 10.0
+
+    temp_dir = tempfile.mkdtemp()
+    old_tile_cells = Terrain_Engine.TILE_CELLS
+    try:
+        in_dem = write_test_raster(os.path.join(temp_dir, "dem.tif"), dem, Terrain_Engine.NO_DATA, cell_size)
+        filled = Terrain_Engine.fill_depressions(in_dem, os.path.join(temp_dir, "filled.tif"))
+        flow_dir = Terrain_Engine.flow_direction(filled, os.path.join(temp_dir, "flow_dir.tif"))
+        directions = read_test_raster(flow_dir)
+        drainage_areas = []
+        for tiles in [size, tile_cells]:
+            Terrain_Engine.TILE_CELLS = tiles
+            out_path = os.path.join(temp_dir, "drainage_area_" + str(tiles) + ".tif")
+            drainage_areas.append(read_test_raster(Terrain_Engine.drainage_area(flow_dir, out_path)))
+    finally:
+        Terrain_Engine.TILE_CELLS = old_tile_cells
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # count the cells upstream of each cell by following the flow down from every cell
+    direction_of = dict((code, k) for k, code in enumerate(Terrain_Engine.FLOW_ENCODINGS['ESRI']))
+    valid = directions != Terrain_Engine.FLOW_NO_DATA
+    upstream = np.zeros((size, size))
+    for row, col in zip(*np.nonzero(valid)):
+        while directions[row, col] in direction_of:
+            k = direction_of[directions[row, col]]
+            row, col = row + Terrain_Engine.ROW_OFFSETS[k], col + Terrain_Engine.COL_OFFSETS[k]
+            if not (0 <= row < size and 0 <= col < size and valid[row, col]):
+                break
+            upstream[row, col] += 1
+    expected = upstream * cell_size ** 2 / 1000000.0
+
+    for name, drainage_area in zip(["single tile", "tiled"], drainage_areas):
+        if not np.allclose(drainage_area[valid], expected[valid], rtol=1e-5):
+            raise TestException("The " + name + " drainage area differs from the cells counted upstream")
+
+
+def test_accumulate_counts_many_inflows(chains=256):
+    """
+    Makes sure that flow accumulation waits for every inflow of a cell, when more inflows than fit in a byte arrive
+    over several waves, as where the cells leaving many tiles drain to one tile edge cell
+    :param chains: The number of two cell chains that drain to the sink, besides one cell draining straight to it
+    :return:
+    """
+    import Terrain_Engine
+    # cell 1 is the sink, which drains to the outlet at cell 0
+    downstream = np.full(3 + 2 * chains, -1)
+    downstream[1] = 0
+    downstream[2] = 1
+    downstream[3::2] = np.arange(4, 3 + 2 * chains, 2)
+    downstream[4::2] = 1
+    total = Terrain_Engine.accumulate(downstream, np.ones(len(downstream)))[0]
+
+    expected = np.ones(len(downstream))
+    for cell in range(1, len(downstream)):
+        while downstream[cell] >= 0:
+            cell = downstream[cell]
+            expected[cell] += 1
+    if not np.array_equal(total, expected):
+        raise TestException("The outlet accumulates " + str(total[0]) + " cells, not " + str(expected[0]))
+
+
+def test_cell_index_matches_dense_sampling(window_cells=7):
+    """
+    Makes sure that the cell index finds the cells whose centres are inside each polygon, and that the zonal
+    statistics read through it, in small windows, match those of the cells tested one by one
+    :param window_cells: The window width to read the raster in
+    :return:
+    """
+    import Zonal_Engine
+    random = np.random.RandomState(3)
+    grid = Zonal_Engine.RasterGrid(0.0, 300.0, 5.0, 5.0, 60, 70)
+    edges = random_polygon_edges(random, 25, grid)
+    cell_index = Zonal_Engine.CellIndex(np.arange(25), *Zonal_Engine.rasterize_edges(edges, grid))
+    inside = polygons_contain(edges, 25, *cell_centres(grid))
+
+    values = random.uniform(0, 10, (grid.rows, grid.cols))
+    values[random.rand(grid.rows, grid.cols) < 0.1] = np.nan
+
+    old_window_cells = Zonal_Engine.WINDOW_CELLS
+    try:
+        Zonal_Engine.WINDOW_CELLS = window_cells
+        stats = cell_index.stats(values, Zonal_Engine.STAT_TYPES, grid)
+    finally:
+        Zonal_Engine.WINDOW_CELLS = old_window_cells
+
+    for zone in range(25):
+        cells = np.zeros((grid.rows, grid.cols), bool)
+        for row, col_start, col_end in zip(cell_index.rows[cell_index.zones == zone],
+                                           cell_index.col_starts[cell_index.zones == zone],
+                                           cell_index.col_ends[cell_index.zones == zone]):
+            cells[row, col_start:col_end] = True
+        if not np.array_equal(cells, inside[zone]):
+            raise TestException("The cell index of zone " + str(zone) + " has cells whose centres are outside it")
+
+        zone_values = values[inside[zone] & ~np.isnan(values)]
+        expected = dict(zip(Zonal_Engine.STAT_TYPES, [zone_values.mean(), zone_values.min(), zone_values.max(),
+                                                      zone_values.sum()] if len(zone_values) > 0 else [np.nan] * 4))
+        for stat_type in Zonal_Engine.STAT_TYPES:
+            if not np.allclose(stats[stat_type][zone], expected[stat_type], equal_nan=True):
+                raise TestException("The " + stat_type + " of zone " + str(zone) + " is " +
+                                    str(stats[stat_type][zone]) + ", not " + str(expected[stat_type]))
+
+
+def test_cell_index_cache_keeps_used_indexes():
+    """
+    Makes sure that pruning the cell index cache deletes the indexes not used since the run started, and nothing
+    else in the folder
+    :return:
+    """
+    import time
+    import Zonal_Engine
+    cache_folder = tempfile.mkdtemp()
+    try:
+        run_start = time.time()
+        for file_name, age in [("cellindex_old.npz", 3600), ("cellindex_used.npz", -1), ("notes.txt", 3600)]:
+            path = os.path.join(cache_folder, file_name)
+            open(path, 'w').close()
+            os.utime(path, (run_start - age, run_start - age))
+        pruned = Zonal_Engine.CellIndex.prune_cache(cache_folder, run_start)
+        remaining = sorted(os.listdir(cache_folder))
+    finally:
+        shutil.rmtree(cache_folder)
+    if pruned != 1 or remaining != ["cellindex_used.npz", "notes.txt"]:
+        raise TestException("Pruning the cell index cache left " + ", ".join(remaining))
+
+
+def test_line_maximums_match_dense_sampling(tile_cells=7, chunk_cells=5):
+    """
+    Makes sure that the maximum along each line is the maximum of the cells its segments pass through, found by
+    clipping every segment to every cell, and of the cells whose centres are within the tolerance of it, for lines
+    of several segments, single points, and lines running off the raster
+    :param tile_cells: The tile width to read the raster in
+    :param chunk_cells: The number of cells to test at once
+    :return:
+    """
+    import Zonal_Engine
+    random = np.random.RandomState(4)
+    grid = Zonal_Engine.RasterGrid(0.0, 300.0, 5.0, 5.0, 60, 70)
+    values = random.uniform(0, 100, (grid.rows, grid.cols))
+    values[random.rand(grid.rows, grid.cols) < 0.05] = np.nan
+
+    segments = []
+    segment_lines = []
+    for line in range(40):
+        vertices = np.cumsum(random.uniform(-20, 20, (4, 2)), axis=0) + random.uniform(-20, 370, 2)
+        if line % 5 == 0:
+            vertices = vertices[:1].repeat(2, axis=0)
+        segments.extend(np.hstack((vertices[:-1], vertices[1:])))
+        segment_lines.extend([line] * (len(vertices) - 1))
+    segments = np.array(segments)
+    segment_lines = np.array(segment_lines)
+
+    x, y = cell_centres(grid)
+    data = ~np.isnan(values)
+    for tolerance in [0.0, 7.5]:
+        old_cells = Zonal_Engine.TILE_CELLS, Zonal_Engine.LINE_CHUNK_CELLS
+        try:
+            Zonal_Engine.TILE_CELLS, Zonal_Engine.LINE_CHUNK_CELLS = tile_cells, chunk_cells
+            maximums = Zonal_Engine.line_maximums(segments, segment_lines, 40, values, tolerance, grid)
+        finally:
+            Zonal_Engine.TILE_CELLS, Zonal_Engine.LINE_CHUNK_CELLS = old_cells
+
+        for line in range(40):
+            near = np.zeros((grid.rows, grid.cols), bool)
+            for segment in segments[segment_lines == line]:
+                near |= segment_crosses_cells(segment, grid)
+                near |= Zonal_Engine.segment_distance(x, y, segment) <= tolerance
+            expected = values[near & data].max() if (near & data).any() else np.nan
+            if not np.allclose(maximums[line], expected, equal_nan=True):
+                raise TestException("The maximum along line " + str(line) + " with a tolerance of " +
+                                    str(tolerance) + " is " + str(maximums[line]) + ", not " + str(expected))
+
+
+def test_segment_index_matches_all_pairs():
+    """
+    Makes sure that the distances found through the segment index, to lines and points, from single points, clusters
+    of points and buffer zones, are the minimum distance to all of the segments
+    :return:
+    """
+    import Distance_Engine
+    import Zonal_Engine
+    random = np.random.RandomState(5)
+    segments = []
+    for line in range(30):
+        vertices = np.cumsum(random.uniform(-50, 50, (5, 2)), axis=0) + random.uniform(0, 1000, 2)
+        segments.extend(np.hstack((vertices[:-1], vertices[1:])))
+    points = random.uniform(0, 1000, (10, 2))
+    segments = np.vstack((segments, np.hstack((points, points))))
+    segment_index = Distance_Engine.SegmentIndex(segments)
+
+    def all_pairs(points):
+        return Zonal_Engine.segment_distance(points[:, :1], points[:, 1:], segments[None]).min(axis=1)
+
+    queries = random.uniform(-500, 1500, (200, 2))
+    nearest = np.array([segment_index.nearest(x, y) for x, y in queries])
+    if not np.allclose(nearest, all_pairs(queries)):
+        raise TestException("The nearest segment distances differ from the all-pairs distances")
+    for cluster in range(20):
+        points = random.uniform(-500, 1500, 2) + random.uniform(-40, 40, (50, 2))
+        if not np.allclose(segment_index.distances(points), all_pairs(points)):
+            raise TestException("The distances of a cluster of points differ from the all-pairs distances")
+
+    grid = Zonal_Engine.RasterGrid(-100.0, 1100.0, 10.0, 10.0, 120, 120)
+    edges = random_polygon_edges(random, 15, grid)
+    cell_index = Zonal_Engine.CellIndex(np.arange(15), *Zonal_Engine.rasterize_edges(edges, grid))
+    inside = polygons_contain(edges, 15, *cell_centres(grid))
+    x, y = cell_centres(grid)
+    for stat_type in ['MINIMUM', 'MEAN']:
+        distances = Distance_Engine.zone_distances(segment_index, cell_index, grid, stat_type)
+        for zone in range(15):
+            zone_distances = all_pairs(np.column_stack((x[inside[zone]], y[inside[zone]])))
+            expected = zone_distances.min() if stat_type == 'MINIMUM' else zone_distances.mean()
+            if not np.isclose(distances[zone], expected):
+                raise TestException("The " + stat_type + " distance of zone " + str(zone) + " is " +
+                                    str(distances[zone]) + ", not " + str(expected))
+
+
+def test_class_counts_match_dense_sampling(window_cells=7):
+    """
+    Makes sure that the class counts read through the cell index, in small windows, match the classes of the cells
+    whose centres are inside each polygon, with NoData and values of no class left uncounted
+    :param window_cells: The window width to read the raster in
+    :return:
+    """
+    import Zonal_Engine
+    random = np.random.RandomState(13)
+    grid = Zonal_Engine.RasterGrid(0.0, 300.0, 5.0, 5.0, 60, 70)
+    edges = random_polygon_edges(random, 25, grid)
+    cell_index = Zonal_Engine.CellIndex(np.arange(25), *Zonal_Engine.rasterize_edges(edges, grid))
+    inside = polygons_contain(edges, 25, *cell_centres(grid))
+
+    classes = np.floor(random.uniform(0, 4, (grid.rows, grid.cols)))
+    classes[random.rand(grid.rows, grid.cols) < 0.1] = np.nan
+    class_values = {0.0: 0, 1.0: 1, 3.0: 2}
+
+    old_window_cells = Zonal_Engine.WINDOW_CELLS
+    try:
+        Zonal_Engine.WINDOW_CELLS = window_cells
+        counts = cell_index.class_counts(classes, class_values, grid)
+    finally:
+        Zonal_Engine.WINDOW_CELLS = old_window_cells
+
+    for zone in range(25):
+        zone_classes = classes[inside[zone]]
+        expected_counts = [np.sum(zone_classes == value) for value in sorted(class_values, key=class_values.get)]
+        if list(counts[zone]) != expected_counts:
+            raise TestException("The class counts of zone " + str(zone) + " are " + str(list(counts[zone])) +
+                                ", not " + str(expected_counts))
+
+
+def priority_flood(dem, no_data):
+    """
+    Fills a DEM with a plain priority-flood of the whole DEM at once, from the cells next to its edge or NoData
+    :param dem: The DEM array
+    :param no_data: The NoData value of the DEM
+    :return: The filled DEM array
+    """
+    padded = np.pad(np.where(dem == no_data, np.nan, dem.astype(np.float64)), 1, 'constant', constant_values=np.nan)
+    closed = np.isnan(padded)
+    filled = padded.copy()
+    heap = []
+    for row, col in zip(*np.nonzero(~closed)):
+        if closed[row - 1:row + 2, col - 1:col + 2].any():
+            heap.append((filled[row, col], row, col))
+    for level, row, col in heap:
+        closed[row, col] = True
+    heapq.heapify(heap)
+    while heap:
+        level, row, col = heapq.heappop(heap)
+        for next_row in range(row - 1, row + 2):
+            for next_col in range(col - 1, col + 2):
+                if not closed[next_row, next_col]:
+                    closed[next_row, next_col] = True
+                    filled[next_row, next_col] = max(filled[next_row, next_col], level)
+                    heapq.heappush(heap, (filled[next_row, next_col], next_row, next_col))
+    return np.where(np.isnan(filled), no_data, filled)[1:-1, 1:-1]
+
+
+def write_test_raster(path, values, no_data, cell_size=1.0):
+    """
+    Writes an array to a GeoTIFF with its top left corner at the origin
+    :return: The path of the GeoTIFF
+    """
+    from osgeo import gdal
+    ds = gdal.GetDriverByName("GTiff").Create(path, values.shape[1], values.shape[0], 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((0.0, cell_size, 0.0, 0.0, 0.0, -cell_size))
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(no_data)
+    band.WriteArray(values.astype(np.float32))
+    band.FlushCache()
+    return path
+
+
+def read_test_raster(path):
+    """
+    :return: The array of the first band of a raster
+    """
+    from osgeo import gdal
+    return gdal.Open(path).GetRasterBand(1).ReadAsArray()
+
+
+def cell_centres(grid):
+    """
+    :return: Arrays of the x and y coordinates of the centre of every cell of a RasterGrid
+    """
+    cols, rows = np.meshgrid(np.arange(grid.cols), np.arange(grid.rows))
+    return grid.x_min + (cols + 0.5) * grid.cell_width, grid.y_max - (rows + 0.5) * grid.cell_height
+
+
+def random_polygon_edges(random, count, grid):
+    """
+    Makes star shaped polygons with random vertices, some of them overlapping each other or the edge of the grid
+    :return: An (n, 5) array of the polygons' edges, as x1, y1, x2, y2 and zone
+    """
+    edges = []
+    width = grid.cols * grid.cell_width
+    height = grid.rows * grid.cell_height
+    for zone in range(count):
+        angles = np.sort(random.uniform(0, 2 * np.pi, 7))
+        radii = random.uniform(0.03, 0.15, 7) * min(width, height)
+        centre = (grid.x_min + random.uniform(-0.05, 1.05) * width, grid.y_max - random.uniform(-0.05, 1.05) * height)
+        ring = np.column_stack((centre[0] + radii * np.cos(angles), centre[1] + radii * np.sin(angles)))
+        ring = np.vstack((ring, ring[:1]))
+        edges.append(np.column_stack((ring[:-1], ring[1:], np.full(len(ring) - 1, zone))))
+    return np.concatenate(edges)
+
+
+def polygons_contain(edges, count, x, y):
+    """
+    Tests whether points are inside each zone's polygons by the even-odd rule, one edge at a time
+    :return: A (count,) + x.shape array of whether each zone contains each point
+    """
+    inside = np.zeros((count,) + x.shape, bool)
+    for x1, y1, x2, y2, zone in edges:
+        if y1 == y2:
+            continue
+        crosses = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        inside[int(zone)] ^= crosses
+    return inside
+
+
+def segment_crosses_cells(segment, grid):
+    """
+    Clips a segment to every cell of a RasterGrid
+    :return: A (rows, cols) array of whether the segment passes through each cell
+    """
+    x0, y0, x1, y1 = segment
+    cols, rows = np.meshgrid(np.arange(grid.cols), np.arange(grid.rows))
+    start = np.zeros(rows.shape)
+    end = np.ones(rows.shape)
+    for position, change, low, high in [(x0, x1 - x0, grid.x_min + cols * grid.cell_width,
+                                         grid.x_min + (cols + 1) * grid.cell_width),
+                                        (y0, y1 - y0, grid.y_max - (rows + 1) * grid.cell_height,
+                                         grid.y_max - rows * grid.cell_height)]:
+        if change == 0:
+            outside = (position < low) | (position >= high)
+            start[outside] = np.inf
+        else:
+            first, second = (low - position) / change, (high - position) / change
+            start = np.maximum(start, np.minimum(first, second))
+            end = np.minimum(end, np.maximum(first, second))
+    return start <= end
+
+
+# tests that check the engines on made up data, so need no BRAT project. The terrain tests also need GDAL
+ENGINE_TESTS = [
+    test_fis_engine_matches_skfuzzy,
+    test_sweep_matches_comb_fis,
+    test_monte_carlo_matches_deterministic,
+    test_regional_curves_match_baseline,
+    test_locate_points_matches_even_odd,
+    test_conflict_score_matches_loops,
+    test_opbrc_table_matches_if_chain,
+    test_dam_counts_match_all_pairs,
+    test_tiled_smoothing_matches_focal_mean,
+    test_tiled_fill_matches_priority_flood,
+    test_tiled_drainage_area_matches_single_tile,
+    test_accumulate_counts_many_inflows,
+    test_cell_index_matches_dense_sampling,
+    test_cell_index_cache_keeps_used_indexes,
+    test_line_maximums_match_dense_sampling,
+    test_segment_index_matches_all_pairs,
+    test_class_counts_match_dense_sampling,
+]
+
+
+def run_engine_tests():
+    """
+    Runs every test in ENGINE_TESTS
+    :return: The list of exceptions raised by failing tests
+    """
+    test_exceptions = []
+    for test in ENGINE_TESTS:
+        try:
+            test()
+        except TestException as e:
+            test_exceptions.append(test.__name__ + ": " + str(e))
+    return test_exceptions
+
+
+if __name__ == '__main__':
+    exceptions = run_engine_tests()
+    for exception in exceptions:
+        print(exception)
+    print(str(len(ENGINE_TESTS) - len(exceptions)) + " of " + str(len(ENGINE_TESTS)) + " engine tests passed")
+    sys.exit(1 if exceptions else 0)
@@ -10,17 +10,81 @@
 # -------------------------------------------------------------------------------
 
 import arcpy
-import skfuzzy as fuzz
-from skfuzzy import control as ctrl
 import numpy as np
 import os
 import sys
-
-
-def main(in_network):
-
+from FIS_Engine import FuzzyVariable, FuzzyInferenceSystem, ResponseSurface
+
+
+# membership functions shared by the riparian (100 m) and streamside (30 m) vegetation suitability inputs
+VEG_TERMS = [
+    ('unsuitable', 'trapmf', [0, 0, 0.1, 1]),
+    ('barely', 'trimf', [0.1, 1, 2]),
+    ('moderately', 'trimf', [1, 2, 3]),
+    ('suitable', 'trimf', [2, 3, 4]),
+    ('preferred', 'trimf', [3, 4, 4])]
+
+DENSITY_TERMS = [
+    ('none', 'trimf', [0, 0, 0.1]),
+    ('rare', 'trapmf', [0, 0.1, 0.5, 1.5]),
+    ('occasional', 'trapmf', [0.5, 1.5, 4, 8]),
+    ('frequent', 'trapmf', [4, 8, 12, 25]),
+    ('pervasive', 'trapmf', [12, 25, 45, 45])]
+
+# fis rule table: (riparian, streamside, density)
+VEG_RULES = [
+    ('unsuitable', 'unsuitable', 'none'),
+    ('barely', 'unsuitable', 'rare'),
+    ('moderately', 'unsuitable', 'rare'),
+    ('suitable', 'unsuitable', 'occasional'),
+    ('preferred', 'unsuitable', 'occasional'),
+    ('unsuitable', 'barely', 'rare'),
+    ('barely', 'barely', 'rare'),  # matBRAT has consequnt as 'occasional'
+    ('moderately', 'barely', 'occasional'),
+    ('suitable', 'barely', 'occasional'),
+    ('preferred', 'barely', 'occasional'),
+    ('unsuitable', 'moderately', 'rare'),
+    ('barely', 'moderately', 'occasional'),
+    ('moderately', 'moderately', 'occasional'),
+    ('suitable', 'moderately', 'frequent'),
+    ('preferred', 'moderately', 'frequent'),
+    ('unsuitable', 'suitable', 'occasional'),
+    ('barely', 'suitable', 'occasional'),
+    ('moderately', 'suitable', 'frequent'),
+    ('suitable', 'suitable', 'frequent'),
+    ('preferred', 'suitable', 'pervasive'),
+    ('unsuitable', 'preferred', 'occasional'),
+    ('barely', 'preferred', 'frequent'),
+    ('moderately', 'preferred', 'pervasive'),
+    ('suitable', 'preferred', 'pervasive'),
+    ('preferred', 'preferred', 'pervasive')]
+
+
+def main(in_network, surface_step=None, decimals=None):
+    """
+    Runs the vegetation FIS for both potential and existing vegetation
+    :param in_network: The BRAT network, with iVeg_* attributes
+    :param surface_step: If given, outputs are interpolated from a cached response surface with this grid
+    spacing instead of evaluating the FIS for every reach
+    :param decimals: If given, inputs are rounded to this many decimal places, so more reaches share inputs and
+    the FIS is run fewer times. Not used with surface_step
+    :return:
+    """
     scratch = 'in_memory'
 
+    veg_fis = build_veg_fis()
+    surface = None
+    if surface_step not in (None, ""):
+        if decimals is not None:
+            arcpy.AddWarning("Input precision is ignored when a response surface grid spacing is given")
+        # the scratch folder is writable even when the toolbox is installed somewhere read only
+        surface_folder = os.path.join(arcpy.env.scratchFolder, 'FISSurfaces')
+        surface = ResponseSurface.load_or_build(veg_fis, float(surface_step), surface_folder)
+        arcpy.AddMessage("Vegetation FIS response surface: maximum interpolation error of " +
+                         str(round(surface.max_error, 6)) + " dams/km, " + str(surface.category_changes) +
+                         " of " + str((len(surface.axes[0]) - 1) * (len(surface.axes[1]) - 1)) +
+                         " checked points changed capacity category")
+
     # vegetation capacity fis function
     def vegFIS(model_run):
 
@@ -64,69 +128,18 @@ def main(in_network):
         for item in items:
             del item
 
-        # create antecedent (input) and consequent (output) objects to hold universe variables and membership functions
-        riparian = ctrl.Antecedent(np.arange(0, 4, 0.01), 'input1')
-        streamside = ctrl.Antecedent(np.arange(0, 4, 0.01), 'input2')
-        density = ctrl.Consequent(np.arange(0, 45, 0.01), 'result')
-
-        # build membership functions for each antecedent and consequent object
-        riparian['unsuitable'] = fuzz.trapmf(riparian.universe, [0, 0, 0.1, 1])
-        riparian['barely'] = fuzz.trimf(riparian.universe, [0.1, 1, 2])
-        riparian['moderately'] = fuzz.trimf(riparian.universe, [1, 2, 3])
-        riparian['suitable'] = fuzz.trimf(riparian.universe, [2, 3, 4])
-        riparian['preferred'] = fuzz.trimf(riparian.universe, [3, 4, 4])
-
-        streamside['unsuitable'] = fuzz.trapmf(streamside.universe, [0, 0, 0.1, 1])
-        streamside['barely'] = fuzz.trimf(streamside.universe, [0.1, 1, 2])
-        streamside['moderately'] = fuzz.trimf(streamside.universe, [1, 2, 3])
-        streamside['suitable'] = fuzz.trimf(streamside.universe, [2, 3, 4])
-        streamside['preferred'] = fuzz.trimf(streamside.universe, [3, 4, 4])
-
-        density['none'] = fuzz.trimf(density.universe, [0, 0, 0.1])
-        density['rare'] = fuzz.trapmf(density.universe, [0, 0.1, 0.5, 1.5])
-        density['occasional'] = fuzz.trapmf(density.universe, [0.5, 1.5, 4, 8])
-        density['frequent'] = fuzz.trapmf(density.universe, [4, 8, 12, 25])
-        density['pervasive'] = fuzz.trapmf(density.universe, [12, 25, 45, 45])
-
-        # build fis rule table
-        rule1 = ctrl.Rule(riparian['unsuitable'] & streamside['unsuitable'], density['none'])
-        rule2 = ctrl.Rule(riparian['barely'] & streamside['unsuitable'], density['rare'])
-        rule3 = ctrl.Rule(riparian['moderately'] & streamside['unsuitable'], density['rare'])
-        rule4 = ctrl.Rule(riparian['suitable'] & streamside['unsuitable'], density['occasional'])
-        rule5 = ctrl.Rule(riparian['preferred'] & streamside['unsuitable'], density['occasional'])
-        rule6 = ctrl.Rule(riparian['unsuitable'] & streamside['barely'], density['rare'])
-        rule7 = ctrl.Rule(riparian['barely'] & streamside['barely'], density['rare']) # matBRAT has consequnt as 'occasional'
-        rule8 = ctrl.Rule(riparian['moderately'] & streamside['barely'], density['occasional'])
-        rule9 = ctrl.Rule(riparian['suitable'] & streamside['barely'], density['occasional'])
-        rule10 = ctrl.Rule(riparian['preferred'] & streamside['barely'], density['occasional'])
-        rule11 = ctrl.Rule(riparian['unsuitable'] & streamside['moderately'], density['rare'])
-        rule12 = ctrl.Rule(riparian['barely'] & streamside['moderately'], density['occasional'])
-        rule13 = ctrl.Rule(riparian['moderately'] & streamside['moderately'], density['occasional'])
-        rule14 = ctrl.Rule(riparian['suitable'] & streamside['moderately'], density['frequent'])
-        rule15 = ctrl.Rule(riparian['preferred'] & streamside['moderately'], density['frequent'])
-        rule16 = ctrl.Rule(riparian['unsuitable'] & streamside['suitable'], density['occasional'])
-        rule17 = ctrl.Rule(riparian['barely'] & streamside['suitable'], density['occasional'])
-        rule18 = ctrl.Rule(riparian['moderately'] & streamside['suitable'], density['frequent'])
-        rule19 = ctrl.Rule(riparian['suitable'] & streamside['suitable'], density['frequent'])
-        rule20 = ctrl.Rule(riparian['preferred'] & streamside['suitable'], density['pervasive'])
-        rule21 = ctrl.Rule(riparian['unsuitable'] & streamside['preferred'], density['occasional'])
-        rule22 = ctrl.Rule(riparian['barely'] & streamside['preferred'], density['frequent'])
-        rule23 = ctrl.Rule(riparian['moderately'] & streamside['preferred'], density['pervasive'])
-        rule24 = ctrl.Rule(riparian['suitable'] & streamside['preferred'], density['pervasive'])
-        rule25 = ctrl.Rule(riparian['preferred'] & streamside['preferred'], density['pervasive'])
-
-        # FIS
-        veg_ctrl = ctrl.ControlSystem([rule1, rule2, rule3, rule4, rule5, rule6, rule7, rule8, rule9, rule10, rule11,
-                                       rule12, rule13, rule14, rule15, rule16, rule17, rule18, rule19, rule20, rule21, rule22, rule23, rule24, rule25])
-        veg_fis = ctrl.ControlSystemSimulation(veg_ctrl)
-
         # run fuzzy inference system on inputs and defuzzify output
-        out = np.zeros(len(riparian_array))
-        for i in range(len(out)):
-            veg_fis.input['input1'] = riparian_array[i]
-            veg_fis.input['input2'] = streamside_array[i]
-            veg_fis.compute()
-            out[i] = veg_fis.output['result']
+        if surface is not None:
+            out = surface.interpolate(riparian_array, streamside_array)
+            activations = veg_fis.activations(veg_fis.memberships([riparian_array, streamside_array]))
+        else:
+            out, activations, unique_count = veg_fis.infer_unique([riparian_array, streamside_array], decimals)
+            arcpy.AddMessage(out_field + ": ran the FIS for " + str(unique_count) + " distinct inputs across " +
+                             str(len(out)) + " reaches (" + str(round(float(len(out)) / max(unique_count, 1), 1)) +
+                             " reaches per run)")
+
+        # set ovc_* to 0 if output falls fully in 'none' category
+        out[veg_fis.fires_only(activations, 'none')] = 0.0
 
         # save fuzzy inference system output as table
         columns = np.column_stack((segid_array, out))
@@ -154,27 +167,10 @@ def main(in_network):
                     pass
         tblDict.clear()
 
-        # calculate defuzzified centroid value for density 'none' MF group
-        # this will be used to re-classify output values that fall in this group
-        # important: will need to update the array (x) and MF values (mfx) if the
-        #            density 'none' values are changed in the model
-        x = np.arange(0, 45, 0.01)
-        mfx = fuzz.trimf(x, [0, 0, 0.1])
-        defuzz_centroid = round(fuzz.defuzz(x, mfx, 'centroid'), 6)
-
-        # update vegetation capacity (ovc_*) values in stream network
-        # set ovc_* to 0 if output falls fully in 'none' category
-
-        with arcpy.da.UpdateCursor(in_network, [out_field]) as cursor:
-            for row in cursor:
-                if round(row[0], 6) == defuzz_centroid:
-                    row[0] = 0.0
-                cursor.updateRow(row)
-
         # delete temporary tables and arrays
         arcpy.Delete_management(out_table)
         arcpy.Delete_management(ovc_table)
-        items = [columns, out, x, mfx, defuzz_centroid]
+        items = [columns, out, activations]
         for item in items:
             del item
 
@@ -185,6 +181,17 @@ def main(in_network):
     makeLayers(in_network)
 
 
+def build_veg_fis():
+    """
+    Builds the vegetation fuzzy inference system
+    :return: A FuzzyInferenceSystem taking the riparian and streamside vegetation suitability
+    """
+    riparian = FuzzyVariable('input1', (0, 4, 0.01), VEG_TERMS)
+    streamside = FuzzyVariable('input2', (0, 4, 0.01), VEG_TERMS)
+    density = FuzzyVariable('result', (0, 45, 0.01), DENSITY_TERMS)
+    return FuzzyInferenceSystem([riparian, streamside], density, VEG_RULES)
+
+
 def makeLayers(inputNetwork):
     """
     Makes the layers for the modified output
@@ -277,4 +284,6 @@ def findAvailableNum(folderRoot):
 
 
 if __name__ == '__main__':
-    main(sys.argv[1])
+    main(sys.argv[1],
+         sys.argv[2] if len(sys.argv) > 2 else None,
+         sys.argv[3] if len(sys.argv) > 3 else None)
@@ -0,0 +1,700 @@
+# -------------------------------------------------------------------------------
+# Name:        Zonal Engine
+# Purpose:     Calculates raster statistics within each reach buffer from an index of the cells each buffer
+#              covers, so overlapping buffers need no special handling
+#
+# Created:     10/2026
+# Licence:     <your licence>
+# -------------------------------------------------------------------------------
+
+import arcpy
+import numpy as np
+import hashlib
+import os
+
+# width and height in cells of the windows the raster is read in; bounds the memory used while calculating
+# statistics, however wide the raster is
+WINDOW_CELLS = 1024
+
+STAT_TYPES = ['MEAN', 'MINIMUM', 'MAXIMUM', 'SUM']
+
+# width in cells of the tiles the raster is read in around points
+TILE_CELLS = 512
+
+# most cells tested against the line segments at once in line_maximums; bounds the memory used
+LINE_CHUNK_CELLS = 1000000
+
+# changes whenever the way cells are indexed changes, so that old cached indexes are not used
+INDEX_VERSION = 1
+
+
+class RasterGrid(object):
+    def __init__(self, x_min, y_max, cell_width, cell_height, rows, cols, spatial_reference=None):
+        """
+        The cell layout of a raster
+        :param x_min: The x coordinate of the left edge of the raster
+        :param y_max: The y coordinate of the top edge of the raster
+        :param cell_width: The width of a cell
+        :param cell_height: The height of a cell
+        :param rows: The number of rows of cells
+        :param cols: The number of columns of cells
+        :param spatial_reference: The arcpy SpatialReference of the raster
+        """
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        self.cell_width = float(cell_width)
+        self.cell_height = float(cell_height)
+        self.rows = int(rows)
+        self.cols = int(cols)
+        self.spatial_reference = spatial_reference
+
+    @classmethod
+    def from_raster(cls, ras):
+        """
+        :param ras: A raster path or arcpy Raster
+        :return: The RasterGrid of the raster
+        """
+        raster = as_raster(ras)
+        if isinstance(raster, np.ndarray):
+            raise Exception("An array of raster values needs the RasterGrid it is on")
+        return cls(raster.extent.XMin, raster.extent.YMax, raster.meanCellWidth, raster.meanCellHeight,
+                   raster.height, raster.width, raster.spatialReference)
+
+    def definition(self):
+        """
+        :return: A tuple that is the same for any two rasters with the same cells
+        """
+        spatial_reference = self.spatial_reference.exportToString() if self.spatial_reference else ''
+        return (self.x_min, self.y_max, self.cell_width, self.cell_height, self.rows, self.cols, spatial_reference)
+
+
+class CellIndex(object):
+    def __init__(self, reach_ids, zones, rows, col_starts, col_ends):
+        """
+        The raster cells whose centres fall in each reach buffer, stored as runs of cells along raster rows
+        :param reach_ids: The ReachID of each zone
+        :param zones: The zone (index into reach_ids) of each run
+        :param rows: The raster row of each run
+        :param col_starts: The first column of each run
+        :param col_ends: The column after the last column of each run
+        """
+        self.reach_ids = np.asarray(reach_ids)
+        self.zones = np.asarray(zones, np.int64)
+        self.rows = np.asarray(rows, np.int64)
+        self.col_starts = np.asarray(col_starts, np.int64)
+        self.col_ends = np.asarray(col_ends, np.int64)
+
+    @classmethod
+    def build(cls, buffer, grid):
+        """
+        Rasterizes every buffer onto the grid
+        :param buffer: The buffer polygons, with a ReachID field
+        :param grid: The RasterGrid to index cells of
+        :return: The CellIndex
+        """
+        reach_ids, edges = read_edges(buffer, grid)
+        return cls(reach_ids, *rasterize_edges(edges, grid))
+
+    @classmethod
+    def load_or_build(cls, buffer, grid, cache_folder):
+        """
+        Loads the index for these buffers and grid from the cache folder, or builds it and saves it there. Indexes
+        are keyed by a hash of the buffer geometry, ReachIDs and grid definition, so any raster on the same grid
+        reuses the index, and a changed network or grid gets a new one
+        :param buffer: The buffer polygons, with a ReachID field
+        :param grid: The RasterGrid to index cells of
+        :param cache_folder: The folder to keep indexes in
+        :return: The CellIndex
+        """
+        reach_ids, edges = read_edges(buffer, grid)
+        key = index_key(reach_ids, edges, grid)
+        index_file = os.path.join(cache_folder, "cellindex_" + key + ".npz")
+        if os.path.exists(index_file):
+            # marks the index as used, so that prune_cache keeps it
+            os.utime(index_file, None)
+            saved = np.load(index_file)
+            return cls(saved['reach_ids'], saved['zones'], saved['rows'], saved['col_starts'], saved['col_ends'])
+
+        index = cls(reach_ids, *rasterize_edges(edges, grid))
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        np.savez(index_file, reach_ids=index.reach_ids, zones=index.zones, rows=index.rows,
+                 col_starts=index.col_starts, col_ends=index.col_ends)
+        return index
+
+    @staticmethod
+    def prune_cache(cache_folder, used_since):
+        """
+        Deletes the indexes in the cache folder that have not been loaded or saved since the given time, such as
+        those of a network that has since changed, so the folder only keeps the indexes of the latest run
+        :param cache_folder: The folder indexes are kept in
+        :param used_since: The time.time() that the run started
+        :return: The number of indexes deleted
+        """
+        if not os.path.isdir(cache_folder):
+            return 0
+        pruned = 0
+        for file_name in os.listdir(cache_folder):
+            index_file = os.path.join(cache_folder, file_name)
+            if file_name.startswith("cellindex_") and file_name.endswith(".npz") and \
+                    os.path.getmtime(index_file) < used_since:
+                os.remove(index_file)
+                pruned += 1
+        return pruned
+
+    def cell_count(self):
+        """
+        :return: The number of cells in each zone
+        """
+        return np.bincount(self.zones, weights=self.col_ends - self.col_starts,
+                           minlength=len(self.reach_ids)).astype(np.int64)
+
+    def windows(self):
+        """
+        Splits the runs at the edges of square windows of WINDOW_CELLS cells, and groups them by window, so that
+        the raster can be read one window at a time
+        :return: A generator of the zones, rows, first columns and end columns of the runs in each window
+        """
+        if len(self.rows) == 0:
+            return
+        first_windows = self.col_starts // WINDOW_CELLS
+        counts = np.maximum((self.col_ends - 1) // WINDOW_CELLS - first_windows + 1, 0)
+        runs = np.repeat(np.arange(len(self.rows)), counts)
+        window_cols = np.repeat(first_windows, counts) + np.arange(counts.sum()) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        rows = self.rows[runs]
+        col_starts = np.maximum(self.col_starts[runs], window_cols * WINDOW_CELLS)
+        col_ends = np.minimum(self.col_ends[runs], (window_cols + 1) * WINDOW_CELLS)
+
+        keys = (rows // WINDOW_CELLS) * (window_cols.max() + 1) + window_cols
+        order = np.argsort(keys, kind='mergesort')
+        for window in np.split(order, np.flatnonzero(np.diff(keys[order])) + 1):
+            yield self.zones[runs[window]], rows[window], col_starts[window], col_ends[window]
+
+    def stats(self, ras, stat_types, grid=None):
+        """
+        Calculates statistics of the raster values within every zone, ignoring NoData, reading the raster one
+        window at a time
+        :param ras: A raster path, arcpy Raster, or array with NoData as nan, on the grid the index was built for
+        :param stat_types: A list of STAT_TYPES to calculate
+        :param grid: The RasterGrid of the raster, if already known. Needed for an array
+        :return: A dictionary of stat type to an array with a value for every zone, which is nan where the zone
+        has no data
+        """
+        for stat_type in stat_types:
+            if stat_type not in STAT_TYPES:
+                raise Exception("Unknown zonal statistic " + stat_type)
+        raster = as_raster(ras)
+        if grid is None:
+            grid = RasterGrid.from_raster(raster)
+
+        zone_count = len(self.reach_ids)
+        sums = np.zeros(zone_count)
+        counts = np.zeros(zone_count)
+        minimums = np.full(zone_count, np.inf)
+        maximums = np.full(zone_count, -np.inf)
+        if len(self.rows) == 0:
+            return finish_stats(stat_types, sums, counts, minimums, maximums)
+
+        for zones, rows, col_starts, col_ends in self.windows():
+            row0 = rows.min()
+            col0 = col_starts.min()
+            values = read_window(raster, grid, row0, rows.max() + 1, col0, col_ends.max())
+            band_rows = rows - row0
+            starts = col_starts - col0
+            ends = col_ends - col0
+
+            # sums and counts of each run from cumulative sums along each row
+            valid = ~np.isnan(values)
+            blank = np.zeros((values.shape[0], 1))
+            cumulative_sums = np.hstack((blank, np.cumsum(np.where(valid, values, 0.0), axis=1)))
+            cumulative_counts = np.hstack((blank, np.cumsum(valid, axis=1)))
+            sums += np.bincount(zones, weights=cumulative_sums[band_rows, ends] - cumulative_sums[band_rows, starts],
+                                minlength=zone_count)
+            counts += np.bincount(zones, minlength=zone_count,
+                                  weights=cumulative_counts[band_rows, ends] - cumulative_counts[band_rows, starts])
+            flat_starts = band_rows * values.shape[1] + starts
+            flat_ends = band_rows * values.shape[1] + ends
+
+            # minimum and maximum of each run, from reduceat over (start, end) pairs
+            bounds = np.column_stack((flat_starts, flat_ends)).ravel()
+            if 'MINIMUM' in stat_types:
+                run_minimums = np.minimum.reduceat(np.append(np.where(valid, values, np.inf), np.inf), bounds)[::2]
+                np.minimum.at(minimums, zones, run_minimums)
+            if 'MAXIMUM' in stat_types:
+                run_maximums = np.maximum.reduceat(np.append(np.where(valid, values, -np.inf), -np.inf), bounds)[::2]
+                np.maximum.at(maximums, zones, run_maximums)
+
+        return finish_stats(stat_types, sums, counts, minimums, maximums)
+
+    def class_counts(self, ras, class_values, grid=None):
+        """
+        Counts the cells of each class within every zone, reading the raster one window at a time
+        :param ras: A raster path, arcpy Raster, or array with NoData as nan, on the grid the index was built for
+        :param class_values: A dictionary of raster value to class code, where class codes run from 0. Cells with
+        values not in the dictionary, or NoData, are not counted
+        :param grid: The RasterGrid of the raster, if already known. Needed for an array
+        :return: A (zones, classes) array of the number of cells of each class in each zone
+        """
+        raster = as_raster(ras)
+        if grid is None:
+            grid = RasterGrid.from_raster(raster)
+
+        zone_count = len(self.reach_ids)
+        class_count = max(class_values.values()) + 1 if class_values else 0
+        counts = np.zeros(zone_count * class_count, np.int64)
+        if len(self.rows) == 0 or class_count == 0:
+            return counts.reshape(zone_count, class_count)
+        known_values = np.array(sorted(class_values), np.float64)
+        known_codes = np.array([class_values[value] for value in sorted(class_values)], np.int64)
+
+        for zones, rows, col_starts, col_ends in self.windows():
+            row0 = rows.min()
+            col0 = col_starts.min()
+            values = read_window(raster, grid, row0, rows.max() + 1, col0, col_ends.max())
+
+            # class code of every cell in the window, or -1 where it has no class
+            positions = np.minimum(np.searchsorted(known_values, values), len(known_values) - 1)
+            codes = np.where(known_values[positions] == values, known_codes[positions], -1).ravel()
+
+            # every cell of every run, as flat positions in the window
+            lengths = col_ends - col_starts
+            run_starts = (rows - row0) * values.shape[1] + col_starts - col0
+            cells = np.repeat(run_starts, lengths) + np.arange(lengths.sum()) - \
+                np.repeat(np.cumsum(lengths) - lengths, lengths)
+            cell_zones = np.repeat(zones, lengths)
+            cell_codes = codes[cells]
+            has_class = cell_codes >= 0
+            counts += np.bincount(cell_zones[has_class] * class_count + cell_codes[has_class],
+                                  minlength=zone_count * class_count)
+
+        return counts.reshape(zone_count, class_count)
+
+
+def disk_stencil(radius, grid):
+    """
+    Finds the cell offsets that can hold a cell centre within the radius of a point in the centre cell. The stencil
+    is a cell wider than the disk all round, since the point can be anywhere in its cell
+    :param radius: The radius of the disk, in map units
+    :param grid: The RasterGrid
+    :return: Arrays of the row and column offsets
+    """
+    row_reach = int(np.ceil(radius / grid.cell_height)) + 1
+    col_reach = int(np.ceil(radius / grid.cell_width)) + 1
+    row_offsets, col_offsets = np.mgrid[-row_reach:row_reach + 1, -col_reach:col_reach + 1]
+    # the nearest a cell centre at these offsets can be to a point in the centre cell
+    dy = np.maximum(np.abs(row_offsets) - 1, 0) * grid.cell_height
+    dx = np.maximum(np.abs(col_offsets) - 1, 0) * grid.cell_width
+    within = dx ** 2 + dy ** 2 <= radius ** 2
+    return row_offsets[within], col_offsets[within]
+
+
+def point_minimums(points, ras, radius, grid=None):
+    """
+    Finds the minimum raster value of the cells whose centres are within the radius of each point, as
+    ZonalStatisticsAsTable would from buffers around the points. The raster is read in tiles around the points,
+    so only the cells near them are read, and every point in a tile is tested against the same stencil of cell
+    offsets at once
+    :param points: (n, 2) array of point coordinates, in the raster's coordinate system
+    :param ras: A raster path, arcpy Raster, or array with NoData as nan
+    :param radius: The radius around each point, in map units
+    :param grid: The RasterGrid of the raster, if already known. Needed for an array
+    :return: An array of the minimum near each point, which is nan where there is no data near a point
+    """
+    raster = as_raster(ras)
+    if grid is None:
+        grid = RasterGrid.from_raster(raster)
+    minimums = np.full(len(points), np.nan)
+    if len(points) == 0:
+        return minimums
+
+    row_offsets, col_offsets = disk_stencil(radius, grid)
+    point_rows = np.floor((grid.y_max - points[:, 1]) / grid.cell_height).astype(np.int64)
+    point_cols = np.floor((points[:, 0] - grid.x_min) / grid.cell_width).astype(np.int64)
+    reach = max(np.abs(row_offsets).max(), np.abs(col_offsets).max())
+    on_grid = ((point_rows >= -reach) & (point_rows < grid.rows + reach) &
+               (point_cols >= -reach) & (point_cols < grid.cols + reach))
+
+    # points are grouped by the tile their cell is in
+    tile_cols = grid.cols // TILE_CELLS + 3
+    tiles = (point_rows // TILE_CELLS + 1) * tile_cols + point_cols // TILE_CELLS + 1
+    order = np.flatnonzero(on_grid)[np.argsort(tiles[on_grid], kind='mergesort')]
+    tile_starts = np.flatnonzero(np.diff(np.append(-1, tiles[order])))
+    for start, end in zip(tile_starts, np.append(tile_starts[1:], len(order))):
+        band = order[start:end]
+        rows = point_rows[band][:, None] + row_offsets
+        cols = point_cols[band][:, None] + col_offsets
+        row0 = max(rows.min(), 0)
+        row1 = min(rows.max() + 1, grid.rows)
+        col0 = max(cols.min(), 0)
+        col1 = min(cols.max() + 1, grid.cols)
+        if row1 <= row0 or col1 <= col0:
+            continue
+        values = read_window(raster, grid, row0, row1, col0, col1)
+
+        # the exact test of each stencil cell's centre against each point
+        y_centres = grid.y_max - (rows + 0.5) * grid.cell_height
+        x_centres = grid.x_min + (cols + 0.5) * grid.cell_width
+        near = ((x_centres - points[band, 0][:, None]) ** 2 + (y_centres - points[band, 1][:, None]) ** 2 <=
+                radius ** 2)
+        near &= (rows >= row0) & (rows < row1) & (cols >= col0) & (cols < col1)
+        cell_values = values[np.clip(rows - row0, 0, row1 - row0 - 1), np.clip(cols - col0, 0, col1 - col0 - 1)]
+        cell_values = np.where(near & ~np.isnan(cell_values), cell_values, np.inf)
+        band_minimums = cell_values.min(axis=1)
+        minimums[band] = np.where(np.isinf(band_minimums), np.nan, band_minimums)
+    return minimums
+
+
+def line_maximums(segments, segment_lines, line_count, ras, tolerance=0.0, grid=None):
+    """
+    Finds the maximum raster value of the cells each line passes through, and of the cells whose centres are within
+    the tolerance of it. Each segment is traced through the grid from where it crosses the grid lines, and the
+    raster is read in tiles around the traced cells
+    :param segments: (n, 4) array of the start and end coordinates of every line segment, in the raster's
+    coordinate system
+    :param segment_lines: The line (0 to line_count - 1) of each segment
+    :param line_count: The number of lines
+    :param ras: A raster path, arcpy Raster, or array with NoData as nan
+    :param tolerance: The distance from the line that cells are also taken from, in map units
+    :param grid: The RasterGrid of the raster, if already known. Needed for an array
+    :return: An array of the maximum along each line, which is nan where a line has no data
+    """
+    raster = as_raster(ras)
+    if grid is None:
+        grid = RasterGrid.from_raster(raster)
+    maximums = np.full(line_count, -np.inf)
+    segment_lines = np.asarray(segment_lines, np.int64)
+    x0, y0, x1, y1 = segments[:, 0], segments[:, 1], segments[:, 2], segments[:, 3]
+
+    # the fractions along each segment where it crosses a column or row boundary, between its two ends
+    col0 = np.floor((x0 - grid.x_min) / grid.cell_width).astype(np.int64)
+    col1 = np.floor((x1 - grid.x_min) / grid.cell_width).astype(np.int64)
+    row0 = np.floor((grid.y_max - y0) / grid.cell_height).astype(np.int64)
+    row1 = np.floor((grid.y_max - y1) / grid.cell_height).astype(np.int64)
+    col_crossings = np.abs(col1 - col0)
+    row_crossings = np.abs(row1 - row0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        segment = np.repeat(np.arange(len(segments)), col_crossings)
+        boundary = np.minimum(col0, col1)[segment] + 1 + np.arange(col_crossings.sum()) - \
+            np.repeat(np.cumsum(col_crossings) - col_crossings, col_crossings)
+        col_fractions = (grid.x_min + boundary * grid.cell_width - x0[segment]) / (x1 - x0)[segment]
+        row_segment = np.repeat(np.arange(len(segments)), row_crossings)
+        boundary = np.minimum(row0, row1)[row_segment] + 1 + np.arange(row_crossings.sum()) - \
+            np.repeat(np.cumsum(row_crossings) - row_crossings, row_crossings)
+        row_fractions = (grid.y_max - boundary * grid.cell_height - y0[row_segment]) / (y1 - y0)[row_segment]
+    ends = np.arange(len(segments))
+    segment = np.concatenate((ends, ends, segment, row_segment))
+    fraction = np.concatenate((np.zeros(len(segments)), np.ones(len(segments)), col_fractions, row_fractions))
+    order = np.lexsort((fraction, segment))
+    segment = segment[order]
+    fraction = fraction[order]
+
+    # each piece between two crossings lies in one cell, which holds the piece's middle
+    piece = segment[1:] == segment[:-1]
+    segment = segment[1:][piece]
+    middle = 0.5 * (fraction[1:] + fraction[:-1])[piece]
+    x = x0[segment] + middle * (x1 - x0)[segment]
+    y = y0[segment] + middle * (y1 - y0)[segment]
+    lines = segment_lines[segment]
+    rows = np.floor((grid.y_max - y) / grid.cell_height).astype(np.int64)
+    cols = np.floor((x - grid.x_min) / grid.cell_width).astype(np.int64)
+
+    # cells near a traced cell whose centres are within the tolerance of its segment
+    if tolerance > 0:
+        row_offsets, col_offsets = disk_stencil(tolerance, grid)
+    else:
+        row_offsets, col_offsets = np.zeros(1, np.int64), np.zeros(1, np.int64)
+    centre = np.flatnonzero((row_offsets == 0) & (col_offsets == 0))
+    reach = max(np.abs(row_offsets).max(), np.abs(col_offsets).max())
+    near_grid = np.flatnonzero((rows >= -reach) & (rows < grid.rows + reach) &
+                               (cols >= -reach) & (cols < grid.cols + reach))
+
+    # pieces are taken a tile at a time, in chunks small enough that the cells near them fit in memory
+    chunk_size = max(LINE_CHUNK_CELLS // len(row_offsets), 1)
+    tiles = ((rows[near_grid] + reach) // TILE_CELLS) * ((grid.cols + 2 * reach) // TILE_CELLS + 1) + \
+        (cols[near_grid] + reach) // TILE_CELLS
+    order = np.argsort(tiles, kind='mergesort')
+    tile_starts = np.flatnonzero(np.diff(np.append(-1, tiles[order])))
+    order = near_grid[order]
+    chunk_starts = np.union1d(tile_starts, np.arange(0, len(order), chunk_size))
+    for start, end in zip(chunk_starts, np.append(chunk_starts[1:], len(order))):
+        chunk = order[start:end]
+        near_rows = rows[chunk][:, None] + row_offsets
+        near_cols = cols[chunk][:, None] + col_offsets
+        if tolerance > 0:
+            near = segment_distance(grid.x_min + (near_cols + 0.5) * grid.cell_width,
+                                    grid.y_max - (near_rows + 0.5) * grid.cell_height,
+                                    segments[segment[chunk]][:, None, :]) <= tolerance
+            near[:, centre] = True
+        else:
+            near = np.ones(near_rows.shape, bool)
+        near &= (near_rows >= 0) & (near_rows < grid.rows) & (near_cols >= 0) & (near_cols < grid.cols)
+        if not near.any():
+            continue
+        chunk_lines = np.repeat(lines[chunk], near.sum(axis=1))
+        chunk_rows = near_rows[near]
+        chunk_cols = near_cols[near]
+
+        # each cell is read once per line, however many pieces it is near
+        row0, row1 = chunk_rows.min(), chunk_rows.max() + 1
+        col0, col1 = chunk_cols.min(), chunk_cols.max() + 1
+        cells = np.unique((chunk_lines * (row1 - row0) + chunk_rows - row0) * (col1 - col0) + chunk_cols - col0)
+        chunk_lines = cells // ((row1 - row0) * (col1 - col0))
+        values = read_window(raster, grid, row0, row1, col0, col1).ravel()[cells % ((row1 - row0) * (col1 - col0))]
+        has_data = ~np.isnan(values)
+        np.maximum.at(maximums, chunk_lines[has_data], values[has_data])
+
+    return np.where(np.isinf(maximums), np.nan, maximums)
+
+
+def segment_distance(x, y, segments):
+    """
+    :param x: The x coordinates of points
+    :param y: The y coordinates of points
+    :param segments: Array whose last axis is the start and end coordinates of a segment, broadcast against the points
+    :return: The distance from each point to its segment
+    """
+    x0, y0, x1, y1 = segments[..., 0], segments[..., 1], segments[..., 2], segments[..., 3]
+    length_squared = (x1 - x0) ** 2 + (y1 - y0) ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        along = np.clip(((x - x0) * (x1 - x0) + (y - y0) * (y1 - y0)) / length_squared, 0.0, 1.0)
+    along = np.where(length_squared > 0, along, 0.0)
+    return np.hypot(x - (x0 + along * (x1 - x0)), y - (y0 + along * (y1 - y0)))
+
+
+def overlap_groups(buffer):
+    """
+    Splits the buffers into groups in which no two buffers overlap or touch, for tools such as
+    ZonalStatisticsAsTable that need non-overlapping zones. Buffers are candidates for overlapping when their
+    extents overlap, and the candidates are then tested exactly
+    :param buffer: The buffer polygons, with a ReachID field
+    :return: A list of lists of ReachIDs, one per group
+    """
+    reach_ids = []
+    shapes = []
+    with arcpy.da.SearchCursor(buffer, ['ReachID', 'SHAPE@']) as cursor:
+        for row in cursor:
+            if row[1] is not None:
+                reach_ids.append(row[0])
+                shapes.append(row[1])
+    if not shapes:
+        return []
+    extents = np.array([(shape.extent.XMin, shape.extent.YMin, shape.extent.XMax, shape.extent.YMax)
+                        for shape in shapes])
+
+    neighbours = [set() for shape in shapes]
+    for first, second in overlapping_extents(extents):
+        if not shapes[first].disjoint(shapes[second]):
+            neighbours[first].add(second)
+            neighbours[second].add(first)
+
+    # buffers with a ReachID split over several features must be in the same group, so the features of a ReachID
+    # are merged into one vertex of the graph
+    vertex_of = {}
+    for feature, reach_id in enumerate(reach_ids):
+        vertex_of.setdefault(reach_id, len(vertex_of))
+    graph = [set() for reach_id in vertex_of]
+    for feature, feature_neighbours in enumerate(neighbours):
+        vertex = vertex_of[reach_ids[feature]]
+        graph[vertex].update(vertex_of[reach_ids[neighbour]] for neighbour in feature_neighbours)
+        graph[vertex].discard(vertex)
+
+    colours = colour_graph(graph)
+    vertex_reach_ids = sorted(vertex_of, key=vertex_of.get)
+    groups = [[] for colour in range(max(colours) + 1)]
+    for vertex, colour in enumerate(colours):
+        groups[colour].append(vertex_reach_ids[vertex])
+    return groups
+
+
+def overlapping_extents(extents):
+    """
+    Finds every pair of overlapping extents by sorting them on their left edge, so each extent is only compared
+    with the extents that start within its own x range
+    :param extents: (n, 4) array of XMin, YMin, XMax, YMax
+    :return: (m, 2) array of the indices of each overlapping pair
+    """
+    order = np.argsort(extents[:, 0], kind='mergesort')
+    x_mins = extents[order, 0]
+    starts = np.arange(len(order)) + 1
+    ends = np.searchsorted(x_mins, extents[order, 2], side='right')
+    counts = np.maximum(ends - starts, 0)
+
+    first = np.repeat(np.arange(len(order)), counts)
+    second = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    first = order[first]
+    second = order[second]
+    overlaps = (extents[first, 1] <= extents[second, 3]) & (extents[second, 1] <= extents[first, 3])
+    return np.column_stack((first[overlaps], second[overlaps]))
+
+
+def colour_graph(graph):
+    """
+    Greedily colours a graph so that no two neighbours share a colour, visiting vertices from most to fewest
+    neighbours, which needs at most one more colour than the most neighbours any vertex has
+    :param graph: A list of the set of neighbours of each vertex
+    :return: A list of the colour of each vertex, numbered from 0
+    """
+    colours = [-1] * len(graph)
+    for vertex in sorted(range(len(graph)), key=lambda v: len(graph[v]), reverse=True):
+        used = set(colours[neighbour] for neighbour in graph[vertex])
+        colour = 0
+        while colour in used:
+            colour += 1
+        colours[vertex] = colour
+    return colours
+
+
+def finish_stats(stat_types, sums, counts, minimums, maximums):
+    """
+    :return: A dictionary of stat type to an array with a value for every zone, which is nan where the zone
+    has no data
+    """
+    has_data = counts > 0
+    stats = {}
+    for stat_type in stat_types:
+        if stat_type == 'MEAN':
+            stats[stat_type] = np.where(has_data, sums / np.maximum(counts, 1), np.nan)
+        elif stat_type == 'SUM':
+            stats[stat_type] = np.where(has_data, sums, np.nan)
+        elif stat_type == 'MINIMUM':
+            stats[stat_type] = np.where(has_data, minimums, np.nan)
+        elif stat_type == 'MAXIMUM':
+            stats[stat_type] = np.where(has_data, maximums, np.nan)
+    return stats
+
+
+def read_edges(buffer, grid):
+    """
+    Reads the ring edges of every buffer, in the grid's coordinate system
+    :param buffer: The buffer polygons, with a ReachID field
+    :param grid: The RasterGrid
+    :return: The list of ReachIDs, and an (n, 5) array of edges as x1, y1, x2, y2 and zone (index into the list)
+    """
+    zone_of = {}
+    edges = []
+    with arcpy.da.SearchCursor(buffer, ['ReachID', 'SHAPE@'], spatial_reference=grid.spatial_reference) as cursor:
+        for row in cursor:
+            if row[1] is None:
+                continue
+            zone = zone_of.setdefault(row[0], len(zone_of))
+            for ring in polygon_rings(row[1]):
+                edges.append(np.column_stack((ring[:-1], ring[1:], np.full(len(ring) - 1, zone))))
+    reach_ids = sorted(zone_of, key=zone_of.get)
+    edges = np.concatenate(edges) if edges else np.zeros((0, 5))
+    return reach_ids, edges
+
+
+def index_key(reach_ids, edges, grid):
+    """
+    :return: A hex digest that identifies the cell index of these edges on this grid
+    """
+    key = hashlib.sha1()
+    key.update(repr(INDEX_VERSION).encode())
+    key.update(repr(grid.definition()).encode())
+    key.update(np.asarray(reach_ids, np.int64).tobytes())
+    key.update(np.ascontiguousarray(edges, np.float64).tobytes())
+    return key.hexdigest()
+
+
+def rasterize_edges(edges, grid):
+    """
+    Finds the cells whose centres fall inside each zone's polygons, by the even-odd rule, as runs along rows
+    :param edges: (n, 5) array of polygon ring edges, as x1, y1, x2, y2 and zone
+    :param grid: The RasterGrid
+    :return: The zone, row, first column and column after the last column of each run
+    """
+    x1, y1, x2, y2 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    zone = edges[:, 4].astype(np.int64)
+
+    # an edge crosses the centre line of a row when its ends are on either side of it. Rows near the edge's y
+    # range are candidates, and the exact test keeps the crossings of each closed ring even on every row
+    first_row = np.floor((grid.y_max - np.maximum(y1, y2)) / grid.cell_height - 0.5).astype(np.int64)
+    last_row = np.floor((grid.y_max - np.minimum(y1, y2)) / grid.cell_height - 0.5).astype(np.int64) + 1
+    first_row = np.maximum(first_row, 0)
+    last_row = np.minimum(last_row, grid.rows - 1)
+    candidate_counts = np.maximum(last_row - first_row + 1, 0)
+
+    edge = np.repeat(np.arange(len(edges)), candidate_counts)
+    row = np.repeat(first_row, candidate_counts) + np.arange(candidate_counts.sum()) - \
+        np.repeat(np.cumsum(candidate_counts) - candidate_counts, candidate_counts)
+    y_centre = grid.y_max - (row + 0.5) * grid.cell_height
+    crosses = (y1[edge] > y_centre) != (y2[edge] > y_centre)
+    edge = edge[crosses]
+    row = row[crosses]
+    y_centre = y_centre[crosses]
+    x_cross = x1[edge] + (y_centre - y1[edge]) * (x2[edge] - x1[edge]) / (y2[edge] - y1[edge])
+
+    # crossings along each row of each zone alternate between entering and leaving the zone
+    zone = zone[edge]
+    order = np.lexsort((x_cross, row, zone))
+    enter = order[0::2]
+    leave = order[1::2]
+
+    col_starts = np.ceil((x_cross[enter] - grid.x_min) / grid.cell_width - 0.5).astype(np.int64)
+    col_ends = np.ceil((x_cross[leave] - grid.x_min) / grid.cell_width - 0.5).astype(np.int64)
+    col_starts = np.clip(col_starts, 0, grid.cols)
+    col_ends = np.clip(col_ends, 0, grid.cols)
+    keep = col_ends > col_starts
+    return zone[enter][keep], row[enter][keep], col_starts[keep], col_ends[keep]
+
+
+def polygon_rings(geometry):
+    """
+    :param geometry: An arcpy Polygon
+    :return: A list of (n, 2) arrays of the vertices of each ring, with the first vertex repeated at the end
+    """
+    rings = []
+    for part in geometry:
+        ring = []
+        for point in part:
+            # a null point separates the outer ring of a part from its holes
+            if point is None:
+                if ring:
+                    rings.append(close_ring(ring))
+                ring = []
+            else:
+                ring.append((point.X, point.Y))
+        if ring:
+            rings.append(close_ring(ring))
+    return rings
+
+
+def close_ring(ring):
+    ring = np.asarray(ring, np.float64)
+    if len(ring) > 0 and not np.array_equal(ring[0], ring[-1]):
+        ring = np.vstack((ring, ring[:1]))
+    return ring
+
+
+def as_raster(ras):
+    """
+    :param ras: A raster path, arcpy Raster, or array with NoData as nan
+    :return: An arcpy Raster, or the array
+    """
+    if isinstance(ras, (arcpy.Raster, np.ndarray)):
+        return ras
+    return arcpy.Raster(ras)
+
+
+def read_window(raster, grid, row0, row1, col0, col1):
+    """
+    Reads a block of cells from the raster as floats, with NoData as nan
+    :param raster: An arcpy Raster, or an array with NoData as nan
+    :param grid: The RasterGrid of the raster
+    :param row0: The first row to read
+    :param row1: The row after the last row to read
+    :param col0: The first column to read
+    :param col1: The column after the last column to read
+    :return: A (row1 - row0, col1 - col0) array
+    """
+    if isinstance(raster, np.ndarray):
+        return raster[row0:row1, col0:col1].astype(np.float64)
+    lower_left = arcpy.Point(grid.x_min + col0 * grid.cell_width, grid.y_max - row1 * grid.cell_height)
+    no_data = raster.noDataValue
+    values = arcpy.RasterToNumPyArray(raster, lower_left, int(col1 - col0), int(row1 - row0),
+                                      no_data if no_data is not None else 0)
+    values = values.astype(np.float64)
+    if no_data is not None:
+        values[values == no_data] = np.nan
+    return values
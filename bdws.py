@@ -2,6 +2,7 @@ from osgeo import gdal, ogr
 import numpy as np
 import os
 import math
+import Terrain_Engine
 
 class BDLoG:
     def __init__(self, brat, dem , fac, outDir, bratCap, stat = None):
@@ -427,7 +428,7 @@ class BDSWEA:
         Initialization of the Beaver Dam Surface Water Estimation Algorithm class.
 
         :param dem: Path of DEM for area of interest.
-        :param fdir: Path to flow direction raster, should be concurrent with DEM.
+        :param fdir: Path to flow direction raster, should be concurrent with DEM. If None, it is derived from the DEM.
         :param fac: Path to binary raster representing the stream network with a value of 1 (generally a thresholded flow accumulation).
         :param id: Path to raster of pond ID, calculated with BDLoG class.
         :param outDir: Path where output files will be generated.
@@ -465,7 +466,7 @@ class BDSWEA:
         Set class variables.
 
         :param dem: Path to DEM.
-        :param fdir: Path to flow direction raster.
+        :param fdir: Path to flow direction raster, or None to derive it from the DEM.
         :param fac: Path to binary raster representing the stream network with a value of 1 (generally a thresholded flow accumulation).
         :param id: Path to dam ID raster.
         :param shp: Path to shapefile of dam locations.
@@ -475,6 +476,9 @@ class BDSWEA:
         self.count = 0
         self.demDS = gdal.Open(dem)
         self.dem = self.demDS.GetRasterBand(1).ReadAsArray()
+        if fdir is None:
+            filled = Terrain_Engine.fill_depressions(dem, self.outDir + "/filledDEM.tif")
+            fdir = Terrain_Engine.flow_direction(filled, self.outDir + "/flowDir.tif", 'ESRI')
         self.fdirDS = gdal.Open(fdir)
         self.fdir = self.fdirDS.GetRasterBand(1).ReadAsArray()
         self.facDS = gdal.Open(fac)
@@ -488,8 +492,13 @@ class BDSWEA:
         self.prj = self.demDS.GetProjection()
         self.MAX_COUNT = math.ceil(self.MAX_POND_AREA / abs(self.geot[1] * self.geot[5]) / 1)
         self.driverTiff = gdal.GetDriverByName("GTiff")
-        max = np.max(self.fdir)
-        if max > 8:
+        encoding = Terrain_Engine.flow_encoding(self.fdirDS)
+        if encoding == 'ESRI':
+            self.FLOW_DIR = self.FLOW_DIR_ESRI
+        elif encoding == 'TAUDEM':
+            self.FLOW_DIR = self.FLOW_DIR_TAUDEM
+        # rasters that do not declare an encoding are guessed from their largest value
+        elif np.max(self.fdir) > 8:
             self.FLOW_DIR = self.FLOW_DIR_ESRI
         else:
             self.FLOW_DIR = self.FLOW_DIR_TAUDEM
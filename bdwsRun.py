@@ -3,16 +3,26 @@ from bdflopy import BDflopy
 import arcpy
 import os
 
+# the flow direction raster the BRAT table builder writes in the Flow folder next to the DEM it used
+FLOW_DIRECTION_NAME = os.path.join("Flow", "FlowDir.tif")
+
 def main(projectRoot, bratPath, demPath, flowAcc, flowDir, horizontalKFN, verticalKFN, fieldCapacity, modflowexe):
     arcpy.AddMessage("Running BDLoG...")
     projectFolder = makeFolder(projectRoot, "BDWS_Project")
     inputsFolder = makeFolder(projectFolder, "Inputs")
     outDir = makeFolder(projectFolder, "Output")
     bratCap = 1.0 #proportion (0-1) of maximum estimted dam capacity (from BRAT) for scenario
+    if not flowDir:
+        flowDir = defaultFlowDirection(demPath)
+        if flowDir:
+            arcpy.AddMessage("Using the BRAT flow direction raster " + flowDir)
     bratPath = copyIntoFolder(bratPath, inputsFolder, "BRAT")
     demPath = copyIntoFolder(demPath, inputsFolder, "DEM")
     flowAcc = copyIntoFolder(flowAcc, inputsFolder, "FlowAccumulation")
-    flowDir = copyIntoFolder(flowDir, inputsFolder, "FlowDir")
+    if flowDir:
+        flowDir = copyIntoFolder(flowDir, inputsFolder, "FlowDir")
+    else:
+        flowDir = None # derived from the DEM by BDSWEA
     if horizontalKFN:
         horizontalKFN = copyIntoFolder(horizontalKFN, inputsFolder, "HorizontalKSAT")
     if verticalKFN:
@@ -49,6 +59,20 @@ def main(projectRoot, bratPath, demPath, flowAcc, flowDir, horizontalKFN, vertic
         arcpy.AddMessage("done")
 
 
+def defaultFlowDirection(demPath):
+    """
+    Finds the flow direction raster that the BRAT table builder made from a DEM
+    :param demPath: The path of the DEM
+    :return: The path of the flow direction raster, or None if there is none
+    """
+    if not demPath:
+        return None
+    flowDir = os.path.join(os.path.dirname(demPath), FLOW_DIRECTION_NAME)
+    if os.path.exists(flowDir):
+        return flowDir
+    return None
+
+
 def copyIntoFolder(thingToCopy, copyFolderRoot, copyFolderName):
     copyFolder = makeFolder(copyFolderRoot, findAvailableNum(copyFolderRoot) + '_' + copyFolderName)
     copyPath = os.path.join(copyFolder, os.path.basename(thingToCopy))
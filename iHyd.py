@@ -11,114 +11,345 @@
 
 import arcpy
 import numpy as np
+import ast
+import csv
+import numbers
 import os
 import sys
 
+REGIONAL_CURVES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "RegionalCurves.csv")
+DEFAULT_REGION = 0
+REGION_INDEX_CELLS = 64
+
+# the only syntax a regional curve equation may use: numbers, DAsqm, brackets and arithmetic
+CURVE_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power
+}
+CURVE_UNARY_OPERATORS = {
+    ast.UAdd: np.positive,
+    ast.USub: np.negative
+}
+NUMBER_NODES = tuple(getattr(ast, name) for name in ('Num', 'Constant') if hasattr(ast, name))
+
 
 def main(
     in_network,
-    region):
+    region,
+    region_field=None,
+    region_polygons=None,
+    curves_file=None):
+    """
+    Adds discharge and stream power attributes to the network
+    :param in_network: The BRAT network, with iGeo_DA and iGeo_Slope attributes
+    :param region: The hydrologic region code used for every reach, or for reaches without a region of their own
+    :param region_field: If given, the field holding each reach's region code. Read from region_polygons if given,
+    and from the network otherwise
+    :param region_polygons: If given, a polygon layer of hydrologic regions. Each reach takes the region its
+    midpoint falls in
+    :param curves_file: The csv file of regional curve equations. Defaults to RegionalCurves.csv next to this file
+    :return:
+    """
+    arcpy.env.overwriteOutput = True
 
-    scratch = 'in_memory'
+    # read the reach ids and inputs in one pass
+    inputs = arcpy.da.FeatureClassToNumPyArray(in_network, ["ReachID", "iGeo_DA", "iGeo_Slope"])
+    segid = np.asarray(inputs["ReachID"], np.int64)
+    DA = np.asarray(inputs["iGeo_DA"], np.float64)
+    slope = np.asarray(inputs["iGeo_Slope"], np.float64)
 
-    arcpy.env.overwriteOutput = True
+    if region is None:
+        region = DEFAULT_REGION
+    curves = readRegionalCurves(curves_file if curves_file else REGIONAL_CURVES)
+    regions = findRegions(in_network, segid, float(region), region_field, region_polygons)
+
+    arcpy.AddMessage("Calculating Qlow, Q2 and stream power...")
+
+    Qlow, Q2 = calcDischarge(DA, regions, curves)
+
+    # check that Q2 is greater than Qlow
+    # if not, re-calculate Q2 as Qlow + 0.001
+    Q2 = np.where(Q2 < Qlow, Qlow + 0.001, Q2)
+
+    SPLow = calcStreamPower(slope, Qlow)
+    SP2 = calcStreamPower(slope, Q2)
+
+    arcpy.AddMessage("Adding Qlow, Q2 and stream power to network...")
+
+    out_fields = ["iHyd_QLow", "iHyd_Q2", "iHyd_SPLow", "iHyd_SP2"]
+    for field in out_fields:
+        arcpy.AddField_management(in_network, field, "DOUBLE")
+
+    # write all of the outputs in one pass, joined to the network on ReachID
+    out_rows = dict(zip(segid.tolist(), np.column_stack((Qlow, Q2, SPLow, SP2)).tolist()))
+    with arcpy.da.UpdateCursor(in_network, ["ReachID"] + out_fields) as cursor:
+        for row in cursor:
+            values = out_rows.get(row[0])
+            if values is not None:
+                cursor.updateRow([row[0]] + values)
+
+    makeLayers(in_network)
 
-    # create segid array for joining output to input network
-    segid_np = arcpy.da.FeatureClassToNumPyArray(in_network, "ReachID")
-    segid = np.asarray(segid_np, np.int64)
 
-    # create array for input network drainage area ("iGeo_DA")
-    DA_array = arcpy.da.FeatureClassToNumPyArray(in_network, "iGeo_DA")
-    DA = np.asarray(DA_array, np.float32)
+def calcStreamPower(slope, discharge):
+    """
+    Calculates stream power, where stream power = density of water (1000 kg/m3) * acceleration due to gravity
+    (9.80665 m/s2) * discharge (m3/s) * channel slope
+    note: we assume that discharge was calculated in cubic feet per second and handle conversion to cubic meters per
+    second (e.g., discharge * 0.028316846592)
+    :param slope: Channel slope
+    :param discharge: Discharge, in cubic feet per second
+    :return: Stream power, in watts per meter
+    """
+    return (1000 * 9.80665) * slope * (discharge * 0.028316846592)
 
+def readRegionalCurves(curves_file):
+    """
+    Reads the regional curve equations for Qlow (baseflow) and Q2 (annual peak streamflow). Each row of the csv
+    gives a region code, a description, and the Qlow and Q2 equations as expressions of drainage area in square
+    miles ("DAsqm"), e.g. "14.7 * (DAsqm ** 0.815)". Add in regional curve equations there
+    :param curves_file: The path to the csv file
+    :return: A dictionary of region code to (description, Qlow equation, Q2 equation), with the equations parsed
+    """
+    curves = {}
+    with open(curves_file, 'rb') as csv_file:
+        for row in csv.DictReader(csv_file):
+            curves[float(row['Region'])] = (row['Description'], parseCurve(row['Qlow'], row['Region']),
+                                            parseCurve(row['Q2'], row['Region']))
+    if DEFAULT_REGION not in curves:
+        raise Exception("The regional curves in " + curves_file + " need a row for the default region " +
+                        str(DEFAULT_REGION))
+    return curves
+
+
+def parseCurve(equation, region):
+    """
+    Parses a regional curve equation, checking that it only uses numbers, DAsqm, brackets and arithmetic, so
+    that the curves file can't run any other code
+    :param equation: The equation, as an expression of "DAsqm"
+    :param region: The region the equation is for, to report errors with
+    :return: The parsed expression
+    """
+    try:
+        expression = ast.parse(equation.strip(), mode='eval').body
+    except SyntaxError:
+        raise Exception("The regional curve for region " + str(region) + " is not a valid equation: " + equation)
+    for node in ast.walk(expression):
+        if isinstance(node, ast.BinOp) and type(node.op) in CURVE_OPERATORS:
+            continue
+        if isinstance(node, ast.UnaryOp) and type(node.op) in CURVE_UNARY_OPERATORS:
+            continue
+        if isinstance(node, NUMBER_NODES) and isRealNumber(curveNumber(node)):
+            continue
+        if isinstance(node, ast.Name) and node.id == 'DAsqm':
+            continue
+        if isinstance(node, (ast.operator, ast.unaryop, ast.expr_context)):
+            continue
+        raise Exception("The regional curve for region " + str(region) + " can only use numbers, DAsqm, " +
+                        "brackets and the + - * / ** operators: " + equation)
+    return expression
+
+
+def curveNumber(node):
+    """
+    :param node: A number node of a parsed equation
+    :return: The number
+    """
+    return node.n if hasattr(node, 'n') else node.value
+
+
+def isRealNumber(value):
+    """
+    :return: True if the value is a real number, and not a boolean
+    """
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def evaluateCurve(expression, DAsqm):
+    """
+    Evaluates a parsed regional curve equation for an array of drainage areas
+    :param expression: The equation, from parseCurve()
+    :param DAsqm: Drainage area in square miles
+    :return: Discharge, in cubic feet per second
+    """
+    if isinstance(expression, ast.BinOp):
+        return CURVE_OPERATORS[type(expression.op)](evaluateCurve(expression.left, DAsqm),
+                                                    evaluateCurve(expression.right, DAsqm))
+    if isinstance(expression, ast.UnaryOp):
+        return CURVE_UNARY_OPERATORS[type(expression.op)](evaluateCurve(expression.operand, DAsqm))
+    if isinstance(expression, ast.Name):
+        return np.asarray(DAsqm, np.float64)
+    return float(curveNumber(expression)) * np.ones_like(DAsqm, np.float64)
+
+
+def calcDischarge(DA, regions, curves, is_verbose=True):
+    """
+    Calculates Qlow and Q2 for every reach, evaluating each region's curves once for all of the reaches in it
+    :param DA: Drainage area, in square kilometers
+    :param regions: The region code of each reach
+    :param curves: The regional curves, from readRegionalCurves()
+    :param is_verbose: If true, reports how many reaches are in each region
+    :return: Qlow and Q2 arrays
+    """
     # convert drainage area (in square kilometers) to square miles
     # note: this assumes that streamflow equations are in US customary units (e.g., inches, feet)
-    DAsqm = np.zeros_like(DA)
     DAsqm = DA * 0.3861021585424458
 
-    # create Qlow and Q2
-    Qlow = np.zeros_like(DA)
-    Q2 = np.zeros_like(DA)
+    Qlow = np.zeros_like(DAsqm)
+    Q2 = np.zeros_like(DAsqm)
 
-    arcpy.AddMessage("Adding Qlow and Q2 to network...")
+    for code in np.unique(regions):
+        in_region = regions == code
+        if code not in curves and is_verbose:
+            arcpy.AddWarning(str(np.count_nonzero(in_region)) + " reaches are in region %g" % code +
+                             ", which has no regional curves, using the default curves")
+        description, qlow_equation, q2_equation = curves.get(code, curves[DEFAULT_REGION])
+        if is_verbose:
+            arcpy.AddMessage("Region %g (" % code + description + "): " + str(np.count_nonzero(in_region)) +
+                             " reaches")
+        Qlow[in_region] = evaluateCurve(qlow_equation, DAsqm[in_region])
+        Q2[in_region] = evaluateCurve(q2_equation, DAsqm[in_region])
 
-    if region is None:
-        region = 0
+    return Qlow, Q2
 
-    # --regional curve equations for Qlow (baseflow) and Q2 (annual peak streamflow)--
-    # # # Add in regional curve equations here # # #
-    if float(region) == 101:  # example 1 (box elder county)
-        Qlow = 0.019875 * (DAsqm ** 0.6634) * (10 ** (0.6068 * 2.04))
-        Q2 = 14.5 * DAsqm ** 0.328
 
-    elif float(region) == 102:  # example 2 (upper green generic)
-        Qlow = 4.2758 * (DAsqm ** 0.299)
-        Q2 = 22.2 * (DAsqm ** 0.608) * ((42 - 40) ** 0.1)
+def findRegions(in_network, segid, region, region_field, region_polygons):
+    """
+    Finds the hydrologic region of every reach
+    :param in_network: The BRAT network
+    :param segid: The ReachID of each reach
+    :param region: The region code for reaches without a region of their own
+    :param region_field: The field holding region codes, on region_polygons if given and on the network otherwise
+    :param region_polygons: The polygon layer of hydrologic regions
+    :return: An array of region codes, in the same order as segid
+    """
+    regions = np.full(len(segid), region, np.float64)
+    if region_polygons is not None and region_field is None:
+        raise Exception("A hydrologic region field is needed to read region codes from the region polygons")
+    if region_field is None:
+        return regions
+
+    if region_polygons is None:
+        codes = arcpy.da.FeatureClassToNumPyArray(in_network, ["ReachID", region_field], null_value=-9999)
+        lookup = dict(zip(codes["ReachID"], codes[region_field]))
+        found = np.array([lookup[reach] for reach in segid], np.float64)
+        has_region = found != -9999
+    else:
+        reach_ids, x, y = findMidpoints(in_network)
+        index = dict((reach, i) for i, reach in enumerate(reach_ids))
+        order = np.array([index[reach] for reach in segid])
+        spatial_ref = arcpy.Describe(in_network).spatialReference
+        found = locatePoints(x[order], y[order], readPolygons(region_polygons, region_field, spatial_ref))
+        has_region = ~np.isnan(found)
 
-    elif float(region) == 24:  # oregon region 5
-        Qlow = 0.000133 * (DAsqm ** 1.05) * (15.3 ** 2.1)
-        Q2 = 0.000258 * (DAsqm ** 0.893) * (15.3 ** 3.15)
+    regions[has_region] = found[has_region]
+    if not has_region.all():
+        arcpy.AddWarning(str(np.count_nonzero(~has_region)) + " reaches have no region, using region %g" % region)
+    return regions
 
-    else:
-        Qlow = (DAsqm ** 0.2098) + 1
-        Q2 = 14.7 * (DAsqm ** 0.815)
-
-    # save segid, Qlow, Q2 as single table
-    columns = np.column_stack((segid, Qlow, Q2))
-    tmp_table = os.path.dirname(in_network) + "/ihyd_Q_Table.txt"
-    np.savetxt(tmp_table, columns, delimiter = ",", header = "ReachID, iHyd_QLow, iHyd_Q2", comments = "")
-    ihyd_table = scratch + "/ihyd_table"
-    arcpy.CopyRows_management(tmp_table, ihyd_table)
-
-    # join Qlow and Q2 output to the flowline network
-    # create empty dictionary to hold input table field values
-    tblDict = {}
-    # add values to dictionary
-    with arcpy.da.SearchCursor(ihyd_table, ['ReachID', "iHyd_QLow", "iHyd_Q2"]) as cursor:
-        for row in cursor:
-            tblDict[row[0]] = [row[1], row[2]]
-    # populate flowline network out field
-    arcpy.AddField_management(in_network, "iHyd_QLow", 'DOUBLE')
-    arcpy.AddField_management(in_network, "iHyd_Q2", 'DOUBLE')
-    with arcpy.da.UpdateCursor(in_network, ['ReachID', "iHyd_QLow", "iHyd_Q2"]) as cursor:
-        for row in cursor:
-            try:
-                aKey = row[0]
-                row[1] = tblDict[aKey][0]
-                row[2] = tblDict[aKey][1]
-                cursor.updateRow(row)
-            except:
-                pass
-    tblDict.clear()
-
-    # delete temporary table
-    arcpy.Delete_management(tmp_table)
 
-    # check that Q2 is greater than Qlow
-    # if not, re-calculate Q2 as Qlow + 0.001
-    with arcpy.da.UpdateCursor(in_network, ["iHyd_QLow", "iHyd_Q2"]) as cursor:
-        for row in cursor:
-            if row[1] < row[0]:
-                row[1] = row[0] + 0.001
-            else:
-                pass
-            cursor.updateRow(row)
-
-    arcpy.AddMessage("Adding stream power to network...")
-
-    # calculate Qlow and Q2 stream power
-    # where stream power = density of water (1000 kg/m3) * acceleration due to gravity (9.80665 m/s2) * discharge (m3/s) * channel slope
-    # note: we assume that discharge ("iHyd_QLow", "iHyd_Q2") was calculated in cubic feet per second and handle conversion to cubic
-    #       meters per second (e.g., "iHyd_QLow" * 0.028316846592
-    arcpy.AddField_management(in_network, "iHyd_SPLow", "DOUBLE")
-    arcpy.AddField_management(in_network, "iHyd_SP2", "DOUBLE")
-    with arcpy.da.UpdateCursor(in_network, ["iGeo_Slope", "iHyd_QLow", "iHyd_SPLow", "iHyd_Q2", "iHyd_SP2"]) as cursor:
+def findMidpoints(in_network):
+    """
+    Finds the midpoint of every reach
+    :param in_network: The BRAT network
+    :return: Arrays of ReachID and midpoint x and y coordinates
+    """
+    reach_ids = []
+    x = []
+    y = []
+    with arcpy.da.SearchCursor(in_network, ["ReachID", "SHAPE@"]) as cursor:
         for row in cursor:
-            row[2] = (1000 * 9.80665) * row[0] * (row[1] * 0.028316846592)
-            row[4] = (1000 * 9.80665) * row[0] * (row[3] * 0.028316846592)
-            cursor.updateRow(row)
+            midpoint = row[1].positionAlongLine(0.5, True).firstPoint
+            reach_ids.append(row[0])
+            x.append(midpoint.X)
+            y.append(midpoint.Y)
+    return np.asarray(reach_ids), np.asarray(x, np.float64), np.asarray(y, np.float64)
 
-    makeLayers(in_network)
+
+def readPolygons(region_polygons, region_field, spatial_ref):
+    """
+    Reads the region polygons as vertex arrays
+    :param region_polygons: The polygon layer of hydrologic regions
+    :param region_field: The field holding the region code of each polygon
+    :param spatial_ref: The spatial reference to read the polygons in, which should be the network's
+    :return: A list of (region code, extent, list of ring vertex arrays)
+    """
+    polygons = []
+    with arcpy.da.SearchCursor(region_polygons, [region_field, "SHAPE@"], spatial_reference=spatial_ref) as cursor:
+        for row in cursor:
+            if row[0] is None or row[1] is None:
+                continue
+            extent = row[1].extent
+            rings = []
+            for part in row[1]:
+                ring = []
+                for point in part:
+                    # a null point separates the outer ring of a part from its holes
+                    if point is None:
+                        if ring:
+                            rings.append(np.asarray(ring, np.float64))
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+                if ring:
+                    rings.append(np.asarray(ring, np.float64))
+            polygons.append((float(row[0]), (extent.XMin, extent.YMin, extent.XMax, extent.YMax), rings))
+    return polygons
+
+
+def locatePoints(x, y, polygons):
+    """
+    Finds the polygon each point falls in. Points are binned into a grid so each polygon only tests the points in
+    the grid cells its extent covers, and those are tested all at once with the even-odd rule
+    :param x: Point x coordinates
+    :param y: Point y coordinates
+    :param polygons: The polygons, from readPolygons()
+    :return: The region code of the polygon each point falls in, or nan for points outside every polygon
+    """
+    found = np.full(len(x), np.nan)
+    if len(x) == 0:
+        return found
+
+    # spatial index: bucket the points into a grid over their extent
+    x_min, y_min = x.min(), y.min()
+    cell_size = max(x.max() - x_min, y.max() - y_min, 1.0) / REGION_INDEX_CELLS
+    col = np.minimum(((x - x_min) / cell_size).astype(np.int64), REGION_INDEX_CELLS - 1)
+    row = np.minimum(((y - y_min) / cell_size).astype(np.int64), REGION_INDEX_CELLS - 1)
+    cell = row * REGION_INDEX_CELLS + col
+    order = np.argsort(cell, kind='mergesort')
+    cell_starts = np.searchsorted(cell[order], np.arange(REGION_INDEX_CELLS * REGION_INDEX_CELLS + 1))
+
+    for code, (xmin, ymin, xmax, ymax), rings in polygons:
+        col_range = np.clip(((np.array([xmin, xmax]) - x_min) / cell_size).astype(np.int64), 0, REGION_INDEX_CELLS - 1)
+        row_range = np.clip(((np.array([ymin, ymax]) - y_min) / cell_size).astype(np.int64), 0, REGION_INDEX_CELLS - 1)
+        candidates = []
+        for r in range(row_range[0], row_range[1] + 1):
+            first = cell_starts[r * REGION_INDEX_CELLS + col_range[0]]
+            last = cell_starts[r * REGION_INDEX_CELLS + col_range[1] + 1]
+            candidates.append(order[first:last])
+        candidates = np.concatenate(candidates)
+        candidates = candidates[np.isnan(found[candidates])]
+        if len(candidates) == 0:
+            continue
+
+        px = x[candidates]
+        py = y[candidates]
+        inside = np.zeros(len(candidates), bool)
+        for ring in rings:
+            x1, y1 = ring[:, 0], ring[:, 1]
+            x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+            for i in range(len(ring)):
+                crosses = (y1[i] > py) != (y2[i] > py)
+                if not crosses.any():
+                    continue
+                x_cross = x1[i] + (py - y1[i]) * (x2[i] - x1[i]) / (y2[i] - y1[i])
+                inside ^= crosses & (px < x_cross)
+        found[candidates[inside]] = code
+
+    return found
 
 
 def makeLayers(inputNetwork):
@@ -215,4 +446,7 @@ def findAvailableNum(folderRoot):
 if __name__ == '__main__':
     main(
         sys.argv[1],
-        sys.argv[2])
+        sys.argv[2],
+        sys.argv[3] if len(sys.argv) > 3 else None,
+        sys.argv[4] if len(sys.argv) > 4 else None,
+        sys.argv[5] if len(sys.argv) > 5 else None)